@@ -0,0 +1,105 @@
+"""
+ASGI entrypoint, an alternative to serving ai_ta_backend.main:app under gunicorn gthread (see run-asgi.sh).
+
+/getTopContexts and /getTopContextsBatch are served natively with AsyncRetrievalService, so a request waiting on
+OpenAI or Qdrant holds a coroutine instead of one of the gthread worker's threads. Every other route falls through
+to the unchanged Flask app, run in a2wsgi's thread pool.
+"""
+import contextlib
+import logging
+import os
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Mount
+from starlette.routing import Route
+
+from ai_ta_backend.database.embedding_cache import EmbeddingCache
+from ai_ta_backend.database.search_policy import SearchPolicy
+from ai_ta_backend.main import app as flask_app
+from ai_ta_backend.main import build_batch_searches
+from ai_ta_backend.main import flask_injector
+from ai_ta_backend.service.async_retrieval_service import \
+    AsyncRetrievalService
+from ai_ta_backend.service.posthog_service import PosthogService
+from ai_ta_backend.service.retrieval_service import RetrievalService
+from ai_ta_backend.service.sentry_service import SentryService
+
+# Share the Flask app's singletons (retrieval service, embedding cache, Posthog, Sentry) so both halves report the same stats.
+injector = flask_injector.injector
+service = AsyncRetrievalService(
+    retrieval=injector.get(RetrievalService),
+    embedding_cache=injector.get(EmbeddingCache),
+    posthog=injector.get(PosthogService) if os.getenv("POSTHOG_API_KEY") else None,
+    sentry=injector.get(SentryService) if os.getenv("SENTRY_DSN") else None,
+)
+
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+
+
+async def getTopContexts(request: Request) -> JSONResponse:
+  """Same contract as main.py:getTopContexts."""
+  data = await request.json()
+  search_query: str = data.get('search_query', '')
+  course_name: str = data.get('course_name', '')
+  token_limit: int = data.get('token_limit', 3000)
+  doc_groups = data.get('doc_groups', [])
+  search_policy = data.get('search_policy', None)
+
+  if search_query == '' or course_name == '':
+    raise HTTPException(
+        status_code=400,
+        detail=
+        f"Missing one or more required parameters: 'search_query' and 'course_name' must be provided. Search query: `{search_query}`, Course name: `{course_name}`"
+    )
+
+  try:
+    SearchPolicy().with_overrides(search_policy)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e)) from e
+
+  found_documents = await service.agetTopContexts(search_query, course_name, token_limit, doc_groups, search_policy)
+  return JSONResponse(found_documents, headers=CORS_HEADERS)
+
+
+async def getTopContextsBatch(request: Request) -> JSONResponse:
+  """Same contract as main.py:getTopContextsBatch."""
+  data = await request.json()
+  searches = build_batch_searches(data)
+
+  if not searches or any(search['search_query'] == '' or search['course_name'] == '' for search in searches):
+    raise HTTPException(
+        status_code=400,
+        detail=
+        f"Missing one or more required parameters: 'search_queries' must be a non-empty list, and every query needs a 'search_query' and 'course_name'. Course name: `{data.get('course_name', '')}`"
+    )
+
+  try:
+    for search in searches:
+      SearchPolicy().with_overrides(search['search_policy'])
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e)) from e
+
+  found_documents = await service.agetTopContextsBatch(searches)
+  return JSONResponse(found_documents, headers=CORS_HEADERS)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+  await service.startup()
+  logging.info("ASGI retrieval service started")
+  yield
+  await service.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route('/getTopContexts', getTopContexts, methods=['POST']),
+        Route('/getTopContextsBatch', getTopContextsBatch, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=int(os.getenv('ASGI_WSGI_THREADS', 100)))),
+    ],
+    lifespan=lifespan,
+)
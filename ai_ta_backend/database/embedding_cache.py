@@ -0,0 +1,129 @@
+import array
+import hashlib
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from injector import inject
+from redis import Redis
+
+CACHE_KEY_PREFIX = "embedding_cache"
+
+
+class EmbeddingCache():
+  """
+  Two-tier cache for query embeddings, keyed by (model, normalized query text).
+
+  Tier 1 is an in-process LRU (size-bounded, with TTL). Tier 2 is an optional Redis cache shared by
+  every worker, reusing the INGEST_REDIS_* connection settings. Redis failures never fail a search,
+  they just fall through to the embeddings API. After a failure the Redis tier is skipped for
+  EMBEDDING_CACHE_REDIS_COOLDOWN_SEC, so an unreachable Redis doesn't add its timeout to every lookup.
+  """
+
+  @inject
+  def __init__(self):
+    self.max_size = int(os.getenv('EMBEDDING_CACHE_SIZE', 2048))
+    self.ttl_sec = int(os.getenv('EMBEDDING_CACHE_TTL_SEC', 24 * 60 * 60))
+    self._lru: OrderedDict[str, Tuple[float, List[float]]] = OrderedDict()
+    self._lock = threading.Lock()
+
+    self.hits = 0
+    self.redis_hits = 0
+    self.misses = 0
+
+    self.redis: Optional[Redis] = None
+    self.redis_cooldown_sec = float(os.getenv('EMBEDDING_CACHE_REDIS_COOLDOWN_SEC', 30))
+    self._redis_down_until = 0.0
+    if os.getenv('EMBEDDING_CACHE_REDIS', 'true').lower() == 'true' and os.getenv('INGEST_REDIS_HOST'):
+      try:
+        self.redis = Redis(
+            host=os.environ['INGEST_REDIS_HOST'],
+            port=int(os.getenv('INGEST_REDIS_PORT', 6379)),
+            password=os.getenv('INGEST_REDIS_PASSWORD'),
+            socket_timeout=0.25,
+            socket_connect_timeout=0.25,
+        )
+      except Exception as e:
+        logging.warning(f"Embedding cache: Redis tier disabled: {e}")
+        self.redis = None
+
+  @staticmethod
+  def normalize(text: str) -> str:
+    """Unicode-normalize and collapse whitespace, so trivially different queries share a key."""
+    return " ".join(unicodedata.normalize('NFKC', text).split())
+
+  def make_key(self, model: str, text: str) -> str:
+    digest = hashlib.sha256(f"{model}\x00{self.normalize(text)}".encode('utf-8')).hexdigest()
+    return f"{CACHE_KEY_PREFIX}:{model}:{digest}"
+
+  def get(self, model: str, text: str) -> Tuple[Optional[List[float]], Optional[str]]:
+    """
+    Look up an embedding. Returns (embedding, tier) where tier is 'lru', 'redis' or None on a miss.
+    """
+    key = self.make_key(model, text)
+    now = time.monotonic()
+    with self._lock:
+      entry = self._lru.get(key)
+      if entry is not None:
+        expires_at, embedding = entry
+        if expires_at > now:
+          self._lru.move_to_end(key)
+          self.hits += 1
+          return embedding, 'lru'
+        del self._lru[key]
+
+    if self._redis_available():
+      try:
+        raw = self.redis.get(key)
+      except Exception as e:
+        self._redis_failed('get', e)
+        raw = None
+      if raw:
+        embedding = array.array('f', raw).tolist()
+        self._put_local(key, embedding)
+        with self._lock:
+          self.hits += 1
+          self.redis_hits += 1
+        return embedding, 'redis'
+
+    with self._lock:
+      self.misses += 1
+    return None, None
+
+  def set(self, model: str, text: str, embedding: List[float]) -> None:
+    key = self.make_key(model, text)
+    self._put_local(key, embedding)
+    if self._redis_available():
+      try:
+        # float32 is what Qdrant stores anyway, and it's ~5x smaller than JSON.
+        self.redis.set(key, array.array('f', embedding).tobytes(), ex=self.ttl_sec)
+      except Exception as e:
+        self._redis_failed('set', e)
+
+  def _redis_available(self) -> bool:
+    return self.redis is not None and time.monotonic() >= self._redis_down_until
+
+  def _redis_failed(self, operation: str, e: Exception) -> None:
+    # Circuit breaker: a down Redis costs one socket timeout per cooldown, not one per lookup.
+    self._redis_down_until = time.monotonic() + self.redis_cooldown_sec
+    logging.info(f"Embedding cache: Redis {operation} failed, skipping shared tier for {self.redis_cooldown_sec:.0f}s. {e}")
+
+  def _put_local(self, key: str, embedding: List[float]) -> None:
+    with self._lock:
+      self._lru[key] = (time.monotonic() + self.ttl_sec, embedding)
+      self._lru.move_to_end(key)
+      while len(self._lru) > self.max_size:
+        self._lru.popitem(last=False)
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {
+          "embedding_cache_hits": self.hits,
+          "embedding_cache_redis_hits": self.redis_hits,
+          "embedding_cache_misses": self.misses,
+          "embedding_cache_size": len(self._lru),
+      }
@@ -1,15 +1,22 @@
 import logging
 import os
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
+import httpx
 from injector import inject
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.vectorstores import Qdrant
 from qdrant_client import models
 from qdrant_client import QdrantClient
 
-OPENAI_API_TYPE = "azure"  # "openai" or "azure"
+from ai_ta_backend.database.qdrant_schema import CollectionSchema
+from ai_ta_backend.database.qdrant_schema import get_schema_version
+from ai_ta_backend.database.qdrant_schema import SCHEMA_VERSION
+from ai_ta_backend.database.search_policy import FALLBACK_SEARCH_POLICY
+from ai_ta_backend.database.search_policy import resolve_search_policy
+from ai_ta_backend.database.search_policy import SearchPolicy
+from ai_ta_backend.utils.utils_tokenization import count_tokens_batch
 
+# Just enough payload to rank and token-pack search results, see RetrievalService two-phase retrieval.
+SEARCH_SUMMARY_PAYLOAD_FIELDS = ['num_tokens', 'readable_filename', 'pagenumber', 'pagenumber_or_timestamp', 'course_name']
 
 class VectorDatabase():
   """
@@ -27,18 +34,45 @@ class VectorDatabase():
         https=False,
         api_key=os.getenv('QDRANT_API_KEY'),
         timeout=20,
+        # Shared by every request thread (100 per gthread worker), so keep enough warm connections around.
+        limits=httpx.Limits(
+            max_connections=int(os.getenv('QDRANT_HTTP_MAX_CONNECTIONS', 100)),
+            max_keepalive_connections=int(os.getenv('QDRANT_HTTP_MAX_KEEPALIVE', 20)),
+        ),
     )
+    self._default_search_policy: Optional[SearchPolicy] = None
 
-    self.vectorstore = Qdrant(
-        client=self.qdrant_client,
-        collection_name=os.environ['QDRANT_COLLECTION_NAME'],
-        embeddings=OpenAIEmbeddings(openai_api_type=OPENAI_API_TYPE),
-    )
+  def default_search_policy(self) -> SearchPolicy:
+    """Search policy matching the collection's quantization config. Looked up once, then cached."""
+    if self._default_search_policy is None:
+      try:
+        info = self.qdrant_client.get_collection(os.environ['QDRANT_COLLECTION_NAME'])
+        self._default_search_policy = SearchPolicy.from_collection_info(info)
+        logging.info(f"Default search policy: {self._default_search_policy}")
+      except Exception as e:
+        # Don't cache, retry on the next search
+        logging.error(f"Failed to read the Qdrant collection config, using the fallback search policy: {e}")
+        return FALLBACK_SEARCH_POLICY
+    return self._default_search_policy
+
+  def resolve_search_policy(self, course_name: str, overrides: Optional[Dict] = None) -> SearchPolicy:
+    """Collection default, then per-course overrides, then per-request `overrides`. Raises ValueError on bad overrides."""
+    return resolve_search_policy(self.default_search_policy(), course_name, overrides)
 
-  def vector_search(self, search_query, course_name, doc_groups: List[str], user_query_embedding, top_n):
+  def vector_search(self,
+                    search_query,
+                    course_name,
+                    doc_groups: List[str],
+                    user_query_embedding,
+                    top_n,
+                    search_policy: Optional[SearchPolicy] = None,
+                    payload_fields: Optional[List[str]] = None):
     """
-    Search the vector database for a given query.
+    Search the vector database for a given query. Without a `search_policy`, uses the course's resolved policy
+    with `top_n` as the limit. `payload_fields` restricts the returned payload, default is the full payload.
     """
+    if search_policy is None:
+      search_policy = self.resolve_search_policy(course_name).with_overrides({'limit': top_n})
     must_conditions = self._create_search_conditions(course_name, doc_groups)
 
     # Filter for the must_conditions
@@ -50,14 +84,57 @@ class VectorDatabase():
         collection_name=os.environ['QDRANT_COLLECTION_NAME'],
         query_filter=myfilter,
         with_vectors=False,
+        with_payload=models.PayloadSelectorInclude(include=payload_fields) if payload_fields else True,
         query_vector=user_query_embedding,
-        limit=top_n,  # Return n closest points
+        limit=search_policy.limit,  # Return n closest points
         # In a system with high disk latency, the re-scoring step may become a bottleneck: https://qdrant.tech/documentation/guides/quantization/
-        search_params=models.SearchParams(quantization=models.QuantizationSearchParams(rescore=False)))
+        search_params=search_policy.search_params())
 
     return search_results
 
-  def _create_search_conditions(self, course_name, doc_groups: List[str]):
+  def vector_search_batch(self,
+                          searches: List[Tuple[str, List[str], List[float]]],
+                          top_n,
+                          search_policies: Optional[List[SearchPolicy]] = None,
+                          payload_fields: Optional[List[str]] = None):
+    """
+    Run several searches in one round trip. Each search is a (course_name, doc_groups, query_embedding) tuple,
+    and gets its own course/doc_group filter and search policy. Returns one list of results per search, in order.
+    """
+    if search_policies is None:
+      search_policies = [self.resolve_search_policy(course_name).with_overrides({'limit': top_n}) for course_name, _, _ in searches]
+    requests = [
+        models.SearchRequest(
+            vector=user_query_embedding,
+            filter=models.Filter(must=self._create_search_conditions(course_name, doc_groups)),
+            limit=search_policy.limit,
+            with_payload=models.PayloadSelectorInclude(include=payload_fields) if payload_fields else True,
+            with_vector=False,
+            params=search_policy.search_params(),
+        ) for (course_name, doc_groups, user_query_embedding), search_policy in zip(searches, search_policies)
+    ]
+    return self.qdrant_client.search_batch(
+        collection_name=os.environ['QDRANT_COLLECTION_NAME'],
+        requests=requests,
+    )
+
+  def retrieve_points(self, point_ids: List) -> Dict:
+    """
+    Fetch full payloads for the given point ids in one request. Returns {point_id: Record}; ids deleted since they
+    were found are missing.
+    """
+    if not point_ids:
+      return {}
+    records = self.qdrant_client.retrieve(
+        collection_name=os.environ['QDRANT_COLLECTION_NAME'],
+        ids=point_ids,
+        with_payload=True,
+        with_vectors=False,
+    )
+    return {record.id: record for record in records}
+
+  @staticmethod
+  def _create_search_conditions(course_name, doc_groups: List[str]):
     """
     Create search conditions for the vector search.
     """
@@ -75,6 +152,81 @@ class VectorDatabase():
 
     return must_conditions
 
+  def backfill_num_tokens(self, collection_name: str, batch_size: int = 256) -> int:
+    """
+    Scroll the collection and write a `num_tokens` payload field on every point that doesn't have one yet
+    (points ingested before token counts were stored). Safe to re-run. Returns the number of points updated.
+    """
+    missing_num_tokens = models.Filter(must=[models.IsEmptyCondition(is_empty=models.PayloadField(key='num_tokens'))])
+    num_updated = 0
+    offset = None
+    while True:
+      points, offset = self.qdrant_client.scroll(
+          collection_name=collection_name,
+          scroll_filter=missing_num_tokens,
+          limit=batch_size,
+          offset=offset,
+          with_payload=models.PayloadSelectorInclude(include=['page_content']),
+          with_vectors=False,
+      )
+      if points:
+        token_counts = count_tokens_batch([str((point.payload or {}).get('page_content', '')) for point in points])
+        self.qdrant_client.batch_update_points(
+            collection_name=collection_name,
+            update_operations=[
+                models.SetPayloadOperation(set_payload=models.SetPayload(payload={'num_tokens': num_tokens}, points=[point.id]))
+                for point, num_tokens in zip(points, token_counts)
+            ],
+        )
+        num_updated += len(points)
+        logging.info(f"Backfilled num_tokens for {num_updated} points in {collection_name}")
+      if offset is None:
+        break
+    return num_updated
+
+  def get_index_diagnostics(self, collection_name: str, course_name: str | None = None, course_limit: int = 100) -> dict:
+    """
+    Report payload index coverage for every filter key, the schema version, and point counts per course
+    (one course if `course_name` is given, else the `course_limit` largest courses).
+    """
+    info = self.qdrant_client.get_collection(collection_name)
+    points_count = info.points_count or 0
+
+    payload_indexes = {}
+    for field_name in CollectionSchema().payload_indexes:
+      index_info = info.payload_schema.get(field_name)
+      payload_indexes[field_name] = {
+          'indexed': index_info is not None,
+          'data_type': str(index_info.data_type.value) if index_info else None,
+          'is_tenant': bool(getattr(index_info.params, 'is_tenant', False)) if index_info else False,
+          'indexed_points': (index_info.points or 0) if index_info else 0,
+      }
+
+    if course_name:
+      course_filter = models.Filter(must=self._create_search_conditions(course_name, []))
+      courses = [{
+          'course_name': course_name,
+          'points': self.qdrant_client.count(collection_name=collection_name, count_filter=course_filter, exact=True).count,
+      }]
+    elif 'course_name' in info.payload_schema:
+      # Facets are served from the course_name index, without touching the points.
+      facet = self.qdrant_client.facet(collection_name=collection_name, key='course_name', limit=course_limit)
+      courses = [{'course_name': hit.value, 'points': hit.count} for hit in facet.hits]
+    else:
+      courses = None
+
+    return {
+        'collection_name': collection_name,
+        'status': str(info.status.value),
+        'points_count': points_count,
+        'indexed_vectors_count': info.indexed_vectors_count,
+        'schema_version': get_schema_version(self.qdrant_client, collection_name),
+        'expected_schema_version': SCHEMA_VERSION,
+        'payload_indexes': payload_indexes,
+        'missing_payload_indexes': [field_name for field_name, index in payload_indexes.items() if not index['indexed']],
+        'courses': courses,
+    }
+
   def delete_data(self, collection_name: str, key: str, value: str):
     """
     Delete data from the vector database.
@@ -0,0 +1,192 @@
+"""
+Idempotent bootstrap for the Qdrant collection, safe to run from every process at every start.
+
+The desired state is declarative (CollectionSchema, overridable with QDRANT_* env vars). Bootstrapping compares it to
+the live collection and only sends the difference, so once the collection is in shape startup is three cheap reads:
+  - create the collection only when absent (tolerating a concurrent create from another worker),
+  - refuse to start if the vector size or distance doesn't match (that would need a re-index, never done implicitly),
+  - update HNSW / quantization (only when QDRANT_QUANTIZATION is set) / on-disk settings that drifted, and create
+    missing payload indexes,
+  - run versioned one-off migrations for changes a diff can't express. The applied version is recorded as a
+    collection alias `<collection>-schema-v<N>`, so it lives with the collection itself.
+"""
+import logging
+import os
+import re
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Callable, Dict, Optional, Union
+
+from qdrant_client import models
+from qdrant_client import QdrantClient
+from qdrant_client.http.exceptions import UnexpectedResponse
+
+
+def _env_bool(key: str, default: str) -> bool:
+  return os.getenv(key, default).lower() == 'true'
+
+
+@dataclass(frozen=True)
+class CollectionSchema:
+  vector_size: int = 1536  # OpenAI text-embedding-ada-002
+  distance: models.Distance = models.Distance.COSINE
+  hnsw_m: int = field(default_factory=lambda: int(os.getenv('QDRANT_HNSW_M', 16)))
+  hnsw_ef_construct: int = field(default_factory=lambda: int(os.getenv('QDRANT_HNSW_EF_CONSTRUCT', 100)))
+  # scalar, binary or none. Opt-in: unset keeps an existing collection's quantization, and creates new ones without.
+  quantization: Optional[str] = field(default_factory=lambda: os.getenv('QDRANT_QUANTIZATION') or None)
+  on_disk: bool = field(default_factory=lambda: _env_bool('QDRANT_ON_DISK_VECTORS', 'false'))
+  # Every field used in a search filter (VectorDatabase) or a delete filter (VectorDatabase.delete_data, Ingest.delete_data).
+  # course_name is the tenant key: Qdrant co-locates each course's points on disk and builds per-course HNSW
+  # links, so course-filtered searches stay on the graph instead of falling back to a full scan.
+  payload_indexes: Dict[str, Union[models.PayloadSchemaType, models.KeywordIndexParams]] = field(
+      default_factory=lambda: {
+          'course_name': models.KeywordIndexParams(type=models.KeywordIndexType.KEYWORD, is_tenant=True),
+          'doc_groups': models.PayloadSchemaType.KEYWORD,
+          's3_path': models.PayloadSchemaType.KEYWORD,
+          'url': models.PayloadSchemaType.KEYWORD,
+      })
+
+  def quantization_config(self):
+    if self.quantization == 'scalar':
+      return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, always_ram=True))
+    if self.quantization == 'binary':
+      return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    if self.quantization in (None, 'none'):
+      return None
+    raise ValueError(f"Unknown QDRANT_QUANTIZATION: `{self.quantization}`. Expected scalar, binary or none.")
+
+
+def _migrate_course_name_to_tenant_index(client: QdrantClient, collection_name: str, schema: CollectionSchema) -> None:
+  """v2: index options can't be changed in place, so rebuild the course_name index with is_tenant."""
+  index_info = client.get_collection(collection_name).payload_schema.get('course_name')
+  if index_info is not None and getattr(index_info.params, 'is_tenant', False):
+    return
+  if index_info is not None:
+    client.delete_payload_index(collection_name=collection_name, field_name='course_name')
+  client.create_payload_index(collection_name=collection_name,
+                              field_name='course_name',
+                              field_schema=schema.payload_indexes['course_name'])
+
+
+# Versioned one-off migrations, keyed by the version they bring the collection to. Add a new entry (and bump
+# SCHEMA_VERSION) for anything the declarative diff can't do, e.g. changing the options of an existing index.
+MIGRATIONS: Dict[int, Callable[[QdrantClient, str, CollectionSchema], None]] = {
+    2: _migrate_course_name_to_tenant_index,
+}
+SCHEMA_VERSION = 2
+
+SCHEMA_ALIAS_PATTERN = r'^{collection}-schema-v(\d+)$'
+
+
+def ensure_collection(client: QdrantClient, collection_name: str, schema: CollectionSchema | None = None) -> None:
+  """Bring `collection_name` to the desired schema without ever dropping data."""
+  schema = schema or CollectionSchema()
+
+  if not client.collection_exists(collection_name):
+    _create_collection(client, collection_name, schema)
+
+  info = client.get_collection(collection_name)
+  _verify_vectors(collection_name, info, schema)
+  _apply_collection_diff(client, collection_name, info, schema)
+  apply_payload_indexes(client, collection_name, info, schema)
+  _apply_migrations(client, collection_name, schema)
+
+
+def _create_collection(client: QdrantClient, collection_name: str, schema: CollectionSchema) -> None:
+  logging.info(f"Creating Qdrant collection {collection_name}")
+  try:
+    client.create_collection(
+        collection_name=collection_name,
+        vectors_config=models.VectorParams(size=schema.vector_size, distance=schema.distance, on_disk=schema.on_disk),
+        hnsw_config=models.HnswConfigDiff(m=schema.hnsw_m, ef_construct=schema.hnsw_ef_construct),
+        quantization_config=schema.quantization_config(),
+    )
+  except (UnexpectedResponse, ValueError) as e:
+    # Another worker won the race (409 Conflict from the server, ValueError from local mode).
+    if isinstance(e, UnexpectedResponse) and e.status_code != 409:
+      raise
+    if not client.collection_exists(collection_name):
+      raise
+    logging.info(f"Qdrant collection {collection_name} was created concurrently, continuing")
+    return
+  # A brand new collection already has every migration's effect, just record the version.
+  _set_schema_version(client, collection_name, SCHEMA_VERSION)
+
+
+def _verify_vectors(collection_name: str, info: models.CollectionInfo, schema: CollectionSchema) -> None:
+  vectors = info.config.params.vectors
+  if not isinstance(vectors, models.VectorParams):
+    raise RuntimeError(f"Qdrant collection {collection_name} uses named vectors, expected a single unnamed vector")
+  if vectors.size != schema.vector_size or vectors.distance != schema.distance:
+    raise RuntimeError(f"Qdrant collection {collection_name} has vectors of size {vectors.size} / {vectors.distance}, "
+                       f"expected {schema.vector_size} / {schema.distance}. Re-index into a new collection to change this.")
+
+
+def _apply_collection_diff(client: QdrantClient, collection_name: str, info: models.CollectionInfo,
+                           schema: CollectionSchema) -> None:
+  update = {}
+
+  hnsw = info.config.hnsw_config
+  if hnsw.m != schema.hnsw_m or hnsw.ef_construct != schema.hnsw_ef_construct:
+    update['hnsw_config'] = models.HnswConfigDiff(m=schema.hnsw_m, ef_construct=schema.hnsw_ef_construct)
+
+  current_quantization = info.config.quantization_config
+  desired_quantization = schema.quantization_config()
+  if schema.quantization is not None and type(current_quantization) is not type(desired_quantization):
+    update['quantization_config'] = desired_quantization if desired_quantization is not None else models.Disabled.DISABLED
+
+  if bool(info.config.params.vectors.on_disk) != schema.on_disk:  # type: ignore
+    update['vectors_config'] = {'': models.VectorParamsDiff(on_disk=schema.on_disk)}
+
+  if update:
+    logging.info(f"Updating Qdrant collection {collection_name} config: {sorted(update)}")
+    client.update_collection(collection_name=collection_name, **update)
+
+
+def apply_payload_indexes(client: QdrantClient, collection_name: str, info: models.CollectionInfo,
+                          schema: CollectionSchema) -> None:
+  """Create any configured payload index that's missing. Existing indexes are left alone, see MIGRATIONS."""
+  for field_name, field_schema in schema.payload_indexes.items():
+    if field_name not in info.payload_schema:
+      logging.info(f"Creating payload index on {collection_name}.{field_name}")
+      client.create_payload_index(collection_name=collection_name, field_name=field_name, field_schema=field_schema)
+
+
+def get_schema_version(client: QdrantClient, collection_name: str) -> int:
+  """Collections created before schema versioning have no alias, and count as version 0."""
+  pattern = re.compile(SCHEMA_ALIAS_PATTERN.format(collection=re.escape(collection_name)))
+  versions = [
+      int(match.group(1))
+      for alias in client.get_collection_aliases(collection_name).aliases
+      if (match := pattern.match(alias.alias_name))
+  ]
+  return max(versions, default=0)
+
+
+def _set_schema_version(client: QdrantClient, collection_name: str, version: int) -> None:
+  previous_version = get_schema_version(client, collection_name)
+  operations: list = [
+      models.CreateAliasOperation(
+          create_alias=models.CreateAlias(collection_name=collection_name, alias_name=f"{collection_name}-schema-v{version}"))
+  ]
+  if previous_version:
+    operations.insert(
+        0, models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=f"{collection_name}-schema-v{previous_version}")))
+  client.update_collection_aliases(change_aliases_operations=operations)
+
+
+def _apply_migrations(client: QdrantClient, collection_name: str, schema: CollectionSchema) -> None:
+  current_version = get_schema_version(client, collection_name)
+  if current_version >= SCHEMA_VERSION:
+    return
+  for version in range(current_version + 1, SCHEMA_VERSION + 1):
+    if version in MIGRATIONS:
+      logging.info(f"Migrating Qdrant collection {collection_name} to schema v{version}")
+      MIGRATIONS[version](client, collection_name, schema)
+  try:
+    _set_schema_version(client, collection_name, SCHEMA_VERSION)
+  except UnexpectedResponse as e:
+    # Migrations are idempotent, so a worker that ran them concurrently and lost the alias swap is fine.
+    if get_schema_version(client, collection_name) < SCHEMA_VERSION:
+      raise
+    logging.info(f"Qdrant schema version was recorded concurrently: {e}")
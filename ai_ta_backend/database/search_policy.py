@@ -0,0 +1,110 @@
+"""
+How a vector search trades recall for latency: quantized vs full-precision vectors, rescoring, oversampling,
+HNSW ef and result limit.
+
+The default policy follows the collection config (see qdrant_schema.py). It can be overridden per course with
+SEARCH_POLICY_OVERRIDES (a JSON object, or SEARCH_POLICY_OVERRIDES_FILE pointing at one), keyed by course_name:
+  {"big-textbook-course": {"hnsw_ef": 256, "rescore": true, "oversampling": 2.0}}
+and per request with a `search_policy` object in the POST body. Later levels win, field by field.
+Use utils/search_policy_benchmark.py to pick values.
+"""
+import dataclasses
+import functools
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from qdrant_client import models
+
+QUANTIZATION_TYPES = ('scalar', 'binary', 'none')
+
+
+@dataclass(frozen=True)
+class SearchPolicy:
+  limit: int = 80
+  # Collection's quantization. Override with 'none' to search the full-precision vectors only.
+  quantization: str = 'none'
+  # Re-rank the quantized candidates with the original vectors. None leaves Qdrant's default.
+  rescore: Optional[bool] = None
+  # Fetch limit * oversampling quantized candidates before rescoring.
+  oversampling: Optional[float] = None
+  # HNSW beam size at query time. None leaves Qdrant's default (ef_construct).
+  hnsw_ef: Optional[int] = None
+  # Brute-force search, for ground truth.
+  exact: bool = False
+
+  @classmethod
+  def from_collection_info(cls, info: models.CollectionInfo) -> 'SearchPolicy':
+    quantization_config = info.config.quantization_config
+    if isinstance(quantization_config, models.ScalarQuantization):
+      # int8 keeps ~99% recall, skipping the rescore avoids reading the original vectors from disk.
+      return cls(quantization='scalar', rescore=False)
+    if isinstance(quantization_config, models.BinaryQuantization):
+      # 1 bit per dimension is too coarse to rank with, rescore a larger candidate set.
+      return cls(quantization='binary', rescore=True, oversampling=2.0)
+    return cls(quantization='none')
+
+  def with_overrides(self, overrides: Optional[Dict]) -> 'SearchPolicy':
+    """Return a copy with the given fields replaced. Raises ValueError on unknown fields or bad values."""
+    if not overrides:
+      return self
+    if not isinstance(overrides, dict):
+      raise ValueError(f"search_policy must be an object, got: `{overrides}`")
+    field_names = {f.name for f in dataclasses.fields(self)}
+    unknown = set(overrides) - field_names
+    if unknown:
+      raise ValueError(f"Unknown search_policy fields: {sorted(unknown)}. Expected any of: {sorted(field_names)}")
+
+    policy = dataclasses.replace(self, **overrides)
+    if not isinstance(policy.limit, int) or policy.limit <= 0:
+      raise ValueError(f"search_policy.limit must be a positive integer, got: `{policy.limit}`")
+    if policy.quantization not in QUANTIZATION_TYPES:
+      raise ValueError(f"search_policy.quantization must be one of {QUANTIZATION_TYPES}, got: `{policy.quantization}`")
+    if policy.rescore is not None and not isinstance(policy.rescore, bool):
+      raise ValueError(f"search_policy.rescore must be true, false or null, got: `{policy.rescore}`")
+    if policy.oversampling is not None and (not isinstance(policy.oversampling, (int, float)) or policy.oversampling < 1):
+      raise ValueError(f"search_policy.oversampling must be a number >= 1, got: `{policy.oversampling}`")
+    if policy.hnsw_ef is not None and (not isinstance(policy.hnsw_ef, int) or policy.hnsw_ef <= 0):
+      raise ValueError(f"search_policy.hnsw_ef must be a positive integer, got: `{policy.hnsw_ef}`")
+    if not isinstance(policy.exact, bool):
+      raise ValueError(f"search_policy.exact must be true or false, got: `{policy.exact}`")
+    return policy
+
+  def search_params(self) -> models.SearchParams:
+    if self.quantization == 'none':
+      # ignore=True is harmless on an unquantized collection, and skips the quantized index on a quantized one.
+      quantization = models.QuantizationSearchParams(ignore=True)
+    else:
+      quantization = models.QuantizationSearchParams(rescore=self.rescore, oversampling=self.oversampling)
+    return models.SearchParams(hnsw_ef=self.hnsw_ef, exact=self.exact, quantization=quantization)
+
+
+# Used while the collection's config can't be read: behave like a scalar-quantized collection.
+FALLBACK_SEARCH_POLICY = SearchPolicy(quantization='scalar', rescore=False)
+
+
+@functools.lru_cache(maxsize=1)
+def load_course_overrides() -> Dict[str, Dict]:
+  """Per-course policy overrides from SEARCH_POLICY_OVERRIDES_FILE or SEARCH_POLICY_OVERRIDES. Read once per process."""
+  try:
+    if os.getenv('SEARCH_POLICY_OVERRIDES_FILE'):
+      with open(os.environ['SEARCH_POLICY_OVERRIDES_FILE']) as f:
+        return json.load(f)
+    return json.loads(os.getenv('SEARCH_POLICY_OVERRIDES', '{}'))
+  except Exception as e:
+    logging.error(f"Ignoring invalid search policy overrides: {e}")
+    return {}
+
+
+def resolve_search_policy(default: SearchPolicy, course_name: str, request_overrides: Optional[Dict] = None) -> SearchPolicy:
+  """Collection default, then the course's overrides, then the request's."""
+  policy = default
+  course_overrides = load_course_overrides().get(course_name)
+  if course_overrides:
+    try:
+      policy = policy.with_overrides(course_overrides)
+    except ValueError as e:
+      logging.error(f"Ignoring invalid search policy override for course `{course_name}`: {e}")
+  return policy.with_overrides(request_overrides)
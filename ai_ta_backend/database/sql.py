@@ -3,10 +3,14 @@ Convert all Supabase queries to SQLAlchemy queries.
 """
 import os
 import logging
-from typing import List
+from typing import Dict, List, Optional, Sequence, Tuple
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import or_
 from sqlalchemy import text
+from sqlalchemy.orm import aliased
 
 from injector import inject
 
@@ -31,6 +35,46 @@ class SQLAlchemyDatabase:
         finally:
             self.db.session.close()
     
+    def getDistinctMaterialsForCourse(self, course_name: str, after_id: Optional[int] = None, limit: Optional[int] = None):
+        """
+        Distinct (s3_path, readable_filename, course_name, url, base_url) of a course, deduplicated in SQL and without
+        contexts: the first row (lowest id) of each, with its id and created_at, in id order. Pass the last id of a
+        page as `after_id` to get the next one. Keyset pagination on the primary key: a page reads only the rows
+        after `after_id`, and an indexed NOT EXISTS probe drops rows whose combination already appeared earlier.
+        """
+        try:
+            columns = (models.Document.s3_path, models.Document.readable_filename, models.Document.course_name,
+                       models.Document.url, models.Document.base_url)
+            earlier = aliased(models.Document)
+            earlier_duplicate = (self.db.select(earlier.id)
+                                 .where(earlier.course_name == models.Document.course_name,
+                                        earlier.id < models.Document.id,
+                                        # IS NOT DISTINCT FROM, spelled out so that the btree index can serve it
+                                        *(or_(getattr(earlier, column.key) == column,
+                                              and_(getattr(earlier, column.key).is_(None), column.is_(None)))
+                                          for column in columns))
+                                 .exists())
+            query = (self.db.select(models.Document.id, models.Document.created_at, *columns)
+                     .where(models.Document.course_name == course_name, ~earlier_duplicate)
+                     .order_by(models.Document.id))
+            if after_id is not None:
+                query = query.where(models.Document.id > after_id)
+            if limit is not None:
+                query = query.limit(limit)
+            result = [dict(row) for row in self.db.session.execute(query).mappings().all()]
+            return DatabaseResponse(data=result, count=len(result))
+        finally:
+            self.db.session.close()
+
+    def getMaterialsVersion(self, course_name: str) -> Tuple[Optional[int], int]:
+        """(max id, row count) of a course's documents: changes whenever a document is added or deleted."""
+        try:
+            query = self.db.select(func.max(models.Document.id), func.count()).where(models.Document.course_name == course_name)
+            max_id, count = self.db.session.execute(query).one()
+            return max_id, count
+        finally:
+            self.db.session.close()
+
     def getMaterialsForCourseAndS3Path(self, course_name: str, s3_path: str):
         try:
             query = self.db.select(models.Document).where(models.Document.course_name == course_name, models.Document.s3_path == s3_path)
@@ -51,6 +95,8 @@ class SQLAlchemyDatabase:
     
     def deleteMaterialsForCourseAndKeyAndValue(self, course_name: str, key: str, value: str):
         try:
+            self._deleteDocumentChunks(
+                self.db.select(models.Document.id).where(models.Document.course_name == course_name, getattr(models.Document, key) == value))
             query = self.db.delete(models.Document).where(models.Document.course_name == course_name, getattr(models.Document, key) == value)
             self.db.session.execute(query)
             self.db.session.commit()
@@ -59,6 +105,8 @@ class SQLAlchemyDatabase:
     
     def deleteMaterialsForCourseAndS3Path(self, course_name: str, s3_path: str):
         try:
+            self._deleteDocumentChunks(
+                self.db.select(models.Document.id).where(models.Document.course_name == course_name, models.Document.s3_path == s3_path))
             query = self.db.delete(models.Document).where(models.Document.course_name == course_name, models.Document.s3_path == s3_path)
             self.db.session.execute(query)
             self.db.session.commit()
@@ -74,29 +122,99 @@ class SQLAlchemyDatabase:
                 query = query.filter(models.Document.created_at <= to_date)
             result = self.db.session.execute(query).scalars().all()
             documents: List[models.Document] = [doc.to_dict() for doc in result]
-            return DatabaseResponse[models.Document](data=documents, count=len(result)).to_dict()
+            return DatabaseResponse[models.Document](data=documents, count=len(result))
         finally:
             self.db.session.close()
 
-    def getAllDocumentsForDownload(self, course_name: str, first_id: int):
+    def getAllDocumentsForDownload(self, course_name: str, first_id: int, limit: int = 100):
+        """Next batch of documents by id, with `contexts` filled from document_chunks in one query for the batch."""
         try:
-            query = self.db.select(models.Document).where(models.Document.course_name == course_name, models.Document.id >= first_id)
+            query = (self.db.select(models.Document)
+                     .where(models.Document.course_name == course_name, models.Document.id >= first_id)
+                     .order_by(models.Document.id)
+                     .limit(limit))
             result = self.db.session.execute(query).scalars().all()
             documents: List[models.Document] = [doc.to_dict() for doc in result]
-            return DatabaseResponse[models.Document](data=documents, count=len(result)).to_dict()
+            chunks_by_document = self._getChunksByDocument(self.db.select(models.DocumentChunk).where(
+                models.DocumentChunk.document_id.in_([doc['id'] for doc in documents])))
+            for doc in documents:
+                if doc['id'] in chunks_by_document:  # documents ingested before document_chunks keep their JSON contexts
+                    doc['contexts'] = chunks_by_document[doc['id']]
+            return DatabaseResponse[models.Document](data=documents, count=len(result))
         finally:
             self.db.session.close()
     
     def getDocsForIdsGte(self, course_name: str, first_id: int, fields: str = "*", limit: int = 100):
+        if fields == "*":
+            return self.getAllDocumentsForDownload(course_name, first_id, limit)
         try:
             fields_to_select = [getattr(models.Document, field) for field in fields.split(", ")]    
-            query = self.db.select(*fields_to_select).where(models.Document.course_name == course_name, models.Document.id >= first_id).limit(limit)
-            result = self.db.session.execute(query).scalars().all()
-            documents: List[models.Document] = [doc.to_dict() for doc in result]
-            return DatabaseResponse[models.Document](data=documents, count=len(result)).to_dict()
+            query = self.db.select(*fields_to_select).where(models.Document.course_name == course_name, models.Document.id >= first_id).order_by(models.Document.id).limit(limit)
+            documents = [dict(row) for row in self.db.session.execute(query).mappings().all()]
+            return DatabaseResponse[models.Document](data=documents, count=len(documents))
         finally:
             self.db.session.close()
     
+    # Document chunk queries
+
+    def getDocumentChunks(self,
+                          document_ids: Sequence[int] = (),
+                          chunk_ranges: Sequence[Tuple[int, int, int]] = (),
+                          pages: Sequence[Tuple[int, int]] = ()):
+        """
+        Chunk rows, in one query: every chunk of each of `document_ids`, chunks first..last (inclusive) of each
+        (document_id, first, last) in `chunk_ranges`, and every chunk of each (document_id, pagenumber) in `pages`.
+        Each condition is a range scan of the primary key or the (document_id, pagenumber) index.
+        Returns {document_id: [chunk dicts in chunk_index order]}.
+        """
+        conditions = []
+        if document_ids:
+            conditions.append(models.DocumentChunk.document_id.in_(document_ids))
+        conditions += [
+            and_(models.DocumentChunk.document_id == document_id, models.DocumentChunk.chunk_index.between(first, last))
+            for document_id, first, last in chunk_ranges
+        ]
+        conditions += [
+            and_(models.DocumentChunk.document_id == document_id, models.DocumentChunk.pagenumber == pagenumber)
+            for document_id, pagenumber in pages
+        ]
+        if not conditions:
+            return {}
+        try:
+            return self._getChunksByDocument(self.db.select(models.DocumentChunk).where(or_(*conditions)))
+        finally:
+            self.db.session.close()
+
+    def countDocumentChunks(self, document_id: int) -> int:
+        try:
+            query = self.db.select(func.count()).where(models.DocumentChunk.document_id == document_id)
+            return self.db.session.execute(query).scalar_one()
+        finally:
+            self.db.session.close()
+
+    def getDocumentsForCourseAndLocations(self, course_name: str, s3_paths: Sequence[str] = (), urls: Sequence[str] = ()):
+        """Document columns without `contexts`, for documents at any of the given S3 paths or URLs."""
+        try:
+            query = self.db.select(models.Document.id, models.Document.s3_path, models.Document.url,
+                                   models.Document.readable_filename, models.Document.base_url).where(
+                                       models.Document.course_name == course_name,
+                                       or_(models.Document.s3_path.in_(s3_paths), models.Document.url.in_(urls)))
+            result = [dict(row) for row in self.db.session.execute(query).mappings().all()]
+            return DatabaseResponse(data=result, count=len(result))
+        finally:
+            self.db.session.close()
+
+    def _getChunksByDocument(self, query) -> Dict[int, List[dict]]:
+        chunks_by_document: Dict[int, List[dict]] = {}
+        query = query.order_by(models.DocumentChunk.document_id, models.DocumentChunk.chunk_index)
+        for chunk in self.db.session.execute(query).scalars():
+            chunks_by_document.setdefault(chunk.document_id, []).append(chunk.to_dict())
+        return chunks_by_document
+
+    def _deleteDocumentChunks(self, document_ids):
+        # the foreign key cascades on Postgres, but not on SQLite (foreign keys are off by default)
+        self.db.session.execute(self.db.delete(models.DocumentChunk).where(models.DocumentChunk.document_id.in_(document_ids)))
+
     # Project-related queries
 
     def getProjectsMapForCourse(self, course_name: str):
@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import os
 import time
@@ -12,21 +13,24 @@ from flask import make_response
 from flask import request
 from flask import Response
 from flask import send_from_directory
+from flask import stream_with_context
 from flask_cors import CORS
 from flask_executor import Executor
 from flask_injector import FlaskInjector
-from flask_injector import RequestScope
 from injector import Binder
 from injector import SingletonScope
 from langchain_core.messages import HumanMessage
 from langchain_core.messages import SystemMessage
 from sqlalchemy import inspect, text
 import urllib3
-from qdrant_client import QdrantClient, models
+from qdrant_client import QdrantClient
 import boto3
 
 from ai_ta_backend.database.aws import AWSStorage
+from ai_ta_backend.database.embedding_cache import EmbeddingCache
 from ai_ta_backend.database.qdrant import VectorDatabase
+from ai_ta_backend.database.qdrant_schema import ensure_collection
+from ai_ta_backend.database.search_policy import SearchPolicy
 from ai_ta_backend.database.sql import SQLAlchemyDatabase
 from ai_ta_backend.executors.flask_executor import ExecutorInterface
 from ai_ta_backend.executors.flask_executor import FlaskExecutorAdapter
@@ -87,6 +91,9 @@ def getTopContexts(service: RetrievalService) -> Response:
   search_query
   token_limit
   doc_groups
+  search_policy (optional) object
+      Overrides for the course's vector search policy, any of: limit, quantization ('none' to skip the quantized
+      index), rescore, oversampling, hnsw_ef, exact. See database/search_policy.py.
   
   Returns
   -------
@@ -117,6 +124,7 @@ def getTopContexts(service: RetrievalService) -> Response:
   course_name: str = data.get('course_name', '')
   token_limit: int = data.get('token_limit', 3000)
   doc_groups: List[str] = data.get('doc_groups', [])
+  search_policy: dict | None = data.get('search_policy', None)
 
   logging.info(f"QDRANT URL {os.environ['QDRANT_URL']}")
   logging.info(f"QDRANT_API_KEY {os.environ['QDRANT_API_KEY']}")
@@ -129,30 +137,144 @@ def getTopContexts(service: RetrievalService) -> Response:
         f"Missing one or more required parameters: 'search_query' and 'course_name' must be provided. Search query: `{search_query}`, Course name: `{course_name}`"
     )
 
-  found_documents = service.getTopContexts(search_query, course_name, token_limit, doc_groups)
+  try:
+    SearchPolicy().with_overrides(search_policy)
+  except ValueError as e:
+    abort(400, description=str(e))
+
+  found_documents = service.getTopContexts(search_query, course_name, token_limit, doc_groups, search_policy)
 
   response = jsonify(found_documents)
   response.headers.add('Access-Control-Allow-Origin', '*')
   return response
 
 
+@app.route('/getTopContextsBatch', methods=['POST'])
+def getTopContextsBatch(service: RetrievalService) -> Response:
+  """Get most relevant contexts for many search queries at once (e.g. eval runs, multi-turn rewrites).
+  All queries are embedded in one request and searched with one Qdrant batch call.
+
+  ## POST body
+  search_queries: list of str, or list of objects with `search_query` and optional per-query
+                  `course_name`, `token_limit` and `doc_groups` overrides.
+  course_name: str, default for every query
+  token_limit: int, default for every query
+  doc_groups: list of str, default for every query
+  search_policy: object, default for every query (see /getTopContexts)
+
+  Returns
+  -------
+  JSON
+      A list with one /getTopContexts response per query, in the same order.
+  """
+  data = request.get_json()
+  searches = build_batch_searches(data)
+
+  if not searches or any(search['search_query'] == '' or search['course_name'] == '' for search in searches):
+    # proper web error "400 Bad request"
+    abort(
+        400,
+        description=
+        f"Missing one or more required parameters: 'search_queries' must be a non-empty list, and every query needs a 'search_query' and 'course_name'. Course name: `{data.get('course_name', '')}`"
+    )
+  try:
+    for search in searches:
+      SearchPolicy().with_overrides(search['search_policy'])
+  except ValueError as e:
+    abort(400, description=str(e))
+
+  found_documents = service.getTopContextsBatch(searches)
+
+  response = jsonify(found_documents)
+  response.headers.add('Access-Control-Allow-Origin', '*')
+  return response
+
+
+def build_batch_searches(data: dict) -> List[dict]:
+  """Expand a /getTopContextsBatch body into one search dict per query, applying the top-level defaults.
+  Shared with the ASGI entrypoint (asgi.py)."""
+  search_queries: List[str | dict] = data.get('search_queries', [])
+  course_name: str = data.get('course_name', '')
+  token_limit: int = data.get('token_limit', 3000)
+  doc_groups: List[str] = data.get('doc_groups', [])
+  search_policy: dict | None = data.get('search_policy', None)
+
+  searches = []
+  for query in search_queries:
+    if isinstance(query, str):
+      query = {'search_query': query}
+    searches.append({
+        'search_query': query.get('search_query', ''),
+        'course_name': query.get('course_name', course_name),
+        'token_limit': query.get('token_limit', token_limit),
+        'doc_groups': query.get('doc_groups', doc_groups),
+        'search_policy': query.get('search_policy', search_policy),
+    })
+  return searches
+
+
 @app.route('/getAll', methods=['GET'])
 def getAll(service: RetrievalService) -> Response:
   """Get all course materials based on the course_name
+
+  ## GET arguments
+  course_name: str
+  limit (optional) int: page size. The response then has `next_cursor`, null on the last page.
+  cursor (optional) int: `next_cursor` of the previous page.
+  stream (optional) bool: stream every material as the JSON is written, instead of building it in memory.
+
+  Responses carry an ETag, derived from the course's max document id and count; send it back as If-None-Match to
+  get a 304 when nothing was added or deleted.
   """
   logging.info("In getAll()")
   course_name: List[str] | str = request.args.get('course_name', default='', type=str)
+  limit: int | None = request.args.get('limit', default=None, type=int)
+  cursor: int | None = request.args.get('cursor', default=None, type=int)
+  stream: bool = request.args.get('stream', default='false', type=str).lower() == 'true'
 
   if course_name == '':
     # proper web error "400 Bad request"
     abort(400, description=f"Missing the one required parameter: 'course_name' must be provided. Course name: `{course_name}`")
 
-  distinct_dicts = service.getAll(course_name)
+  etag = hashlib.sha1(f"{course_name}|{service.getAllVersion(course_name)}|{limit}|{cursor}|{stream}".encode()).hexdigest()
+  if request.if_none_match.contains(etag):
+    response = Response(status=304)
+  elif stream:
+
+    def generate():
+      yield '{"distinct_files": ['
+      for i, material in enumerate(service.iterAll(course_name)):
+        yield (',' if i else '') + app.json.dumps(material)
+      yield ']}'
+
+    response = Response(stream_with_context(generate()), mimetype='application/json')
+  else:
+    distinct_dicts = service.getAll(course_name, after_id=cursor, limit=limit)
+    body = {"distinct_files": distinct_dicts}
+    if limit is not None:
+      body["next_cursor"] = distinct_dicts[-1]['id'] if len(distinct_dicts) == limit else None
+    response = jsonify(body)
+
+  response.set_etag(etag)
+  response.headers.add('Access-Control-Allow-Origin', '*')
+  return response
+
 
-  # Convert each Document class instance to a JSON-serializable dict
-  json_dicts = [d.to_dict() for d in distinct_dicts]
+@app.route('/getVectorIndexDiagnostics', methods=['GET'])
+def getVectorIndexDiagnostics(service: RetrievalService) -> Response:
+  """Report Qdrant payload index coverage for every filter key, the collection schema version,
+  and point counts per course.
 
-  response = jsonify({"distinct_files": json_dicts})
+  ## GET arguments
+  course_name (optional) str: only count this course.
+  course_limit (optional) int: number of courses to report, largest first. Defaults to 100.
+  """
+  course_name: str = request.args.get('course_name', default='', type=str)
+  course_limit: int = request.args.get('course_limit', default=100, type=int)
+
+  diagnostics = service.getVectorIndexDiagnostics(course_name or None, course_limit)
+
+  response = jsonify(diagnostics)
   response.headers.add('Access-Control-Allow-Origin', '*')
   return response
 
@@ -630,9 +752,12 @@ def configure(binder: Binder) -> None:
     logging.info("Binding to Workflow service")
     binder.bind(WorkflowService, to=WorkflowService, scope=SingletonScope)
 
+  # Process-wide query embedding cache (LRU, plus Redis when INGEST_REDIS_* is set)
+  binder.bind(EmbeddingCache, to=EmbeddingCache, scope=SingletonScope)
+
   if vector_bound and sql_bound and storage_bound:
     logging.info("Binding to Retrieval service")
-    binder.bind(RetrievalService, to=RetrievalService, scope=RequestScope)
+    binder.bind(RetrievalService, to=RetrievalService, scope=SingletonScope)
 
   # Always bind the executor and its adapters
   binder.bind(ExecutorInterface, to=FlaskExecutorAdapter(executor), scope=SingletonScope)
@@ -643,7 +768,7 @@ def configure(binder: Binder) -> None:
   # Initialize the databases - this runs at every app startup: be robust to re-running.
 
   # Qdrant
-  # Initialize Qdrant collection if it doesn't exist
+  # Create the collection if it doesn't exist, and bring its config & payload indexes up to date. Never drops data.
   try:
     qdrant_client = QdrantClient(
         url=os.getenv('QDRANT_URL', 'http://qdrant:6333'),
@@ -651,16 +776,11 @@ def configure(binder: Binder) -> None:
         api_key=os.getenv('QDRANT_API_KEY'),
         timeout=20,
     )
-    
-    # Create collection with OpenAI embedding dimensions
-    qdrant_client.recreate_collection(
-        collection_name=os.environ['QDRANT_COLLECTION_NAME'],
-        vectors_config=models.VectorParams(
-            size=1536,  # OpenAI embedding dimensions
-            distance=models.Distance.COSINE
-        )
-    )
+    ensure_collection(qdrant_client, os.environ['QDRANT_COLLECTION_NAME'])
     logging.info(f"Initialized Qdrant collection: {os.environ['QDRANT_COLLECTION_NAME']}")
+  except RuntimeError:
+    # vector size / distance mismatch: serving or ingesting against the wrong collection must not start
+    raise
   except Exception as e:
     logging.error(f"Failed to initialize Qdrant collection: {str(e)}")
 
@@ -699,7 +819,7 @@ def configure(binder: Binder) -> None:
     logging.error(f"Failed to initialize S3 bucket: {str(e)}")
 
 
-FlaskInjector(app=app, modules=[configure])
+flask_injector = FlaskInjector(app=app, modules=[configure])
 
 if __name__ == '__main__':
   app.run(debug=True, port=int(os.getenv("PORT", default=8000)))  # nosec -- reasonable bandit error suppression
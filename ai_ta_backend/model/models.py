@@ -7,13 +7,16 @@ from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
 from sqlalchemy import Index
+from sqlalchemy import Integer
 from sqlalchemy import JSON
+from sqlalchemy import LargeBinary
 from sqlalchemy import Text
 from sqlalchemy import VARCHAR
 from sqlalchemy import Float
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.dialects.postgresql import JSONB
 
+from sqlalchemy.orm import deferred
 from sqlalchemy.sql import func
 
 from uuid import uuid4
@@ -33,11 +36,18 @@ class Document(Base):
     url = Column(Text)
     contexts = Column(JSON, default=lambda: [{"text": "", "timestamp": "", "embedding": "", "pagenumber": ""}])
     base_url = Column(Text)
+    content_hash = Column(Text)  # SHA-256 of the normalized extracted text, for duplicate detection
+    # Only with DOCUMENTS_EMBEDDING_STORAGE=binary (otherwise vectors are in Qdrant only): float32, native byte
+    # order, chunk after chunk in chunk_index order. Read back with array.array('f', embeddings). Deferred, so
+    # loading documents never pulls the vectors unless asked for.
+    embeddings = deferred(Column(LargeBinary))
 
     __table_args__ = (
         Index('documents_course_name_idx', 'course_name', postgresql_using='hash'),
         Index('documents_created_at_idx', 'created_at', postgresql_using='btree'),
         Index('idx_doc_s3_path', 's3_path', postgresql_using='btree'),
+        Index('documents_course_name_content_hash_idx', 'course_name', 'content_hash', postgresql_using='btree'),
+        Index('documents_course_name_s3_path_url_id_idx', 'course_name', 's3_path', 'url', 'id', postgresql_using='btree'),
     )
 
     def to_dict(self):
@@ -49,7 +59,48 @@ class Document(Base):
             "course_name": self.course_name,
             "url": self.url,
             "contexts": self.contexts,
-            "base_url": self.base_url
+            "base_url": self.base_url,
+            "content_hash": self.content_hash
+        }
+
+class DocumentChunk(Base):
+    """One chunk of a document, replacing the per-document `contexts` JSON array for newly ingested documents."""
+    __tablename__ = 'document_chunks'
+    document_id = Column(BigInteger, ForeignKey('documents.id', ondelete='CASCADE'), primary_key=True)
+    chunk_index = Column(Integer, primary_key=True)
+    pagenumber = Column(Integer)
+    timestamp = Column(Text)
+    num_tokens = Column(Integer)
+    chunk_hash = Column(Text)
+    text = Column(Text)
+
+    __table_args__ = (
+        Index('document_chunks_document_id_pagenumber_idx', 'document_id', 'pagenumber', postgresql_using='btree'),
+    )
+
+    @staticmethod
+    def row_from_context(document_id: int, context: dict) -> dict:
+        """Row values for one entry of the `contexts` array that ingest builds."""
+        pagenumber = context.get('pagenumber')
+        return {
+            "document_id": document_id,
+            "chunk_index": context['chunk_index'],
+            "pagenumber": int(pagenumber) if str(pagenumber).isdigit() else None,
+            "timestamp": context.get('timestamp'),
+            "num_tokens": context.get('num_tokens'),
+            "chunk_hash": context.get('chunk_hash'),
+            "text": context['text'],
+        }
+
+    def to_dict(self):
+        """Same shape as an entry of `Document.contexts`."""
+        return {
+            "text": self.text,
+            "pagenumber": self.pagenumber if self.pagenumber is not None else '',
+            "timestamp": self.timestamp,
+            "chunk_index": self.chunk_index,
+            "num_tokens": self.num_tokens,
+            "chunk_hash": self.chunk_hash
         }
 
 class DocumentDocGroup(Base):
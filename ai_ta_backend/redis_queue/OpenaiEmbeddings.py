@@ -62,6 +62,16 @@ Inputs:
 - max_attempts : int, optional
     - number of times to retry a failed request before giving up
     - if omitted, will default to 5
+- max_inputs_per_request : int, optional
+    - embeddings only: pack up to this many inputs into one request (the API accepts arrays of up to 2048 inputs)
+    - results are unpacked again, so `results` still holds one [request, response] pair per input
+    - if omitted, will default to 1 (one request per input)
+- max_tokens_per_request : int, optional
+    - embeddings only: also stop packing a request once its inputs reach this many tokens
+    - if omitted, will default to 100,000 (the API rejects requests over 300,000 tokens)
+- max_concurrent_requests : int, optional
+    - most requests in flight at once, on top of the per-minute limits
+    - if omitted, will default to 100
 - logging_level : int, optional
     - level of logging to use; higher numbers will log fewer messages
     - 40 = ERROR; will log only when requests fail after all retries
@@ -75,14 +85,14 @@ The script is structured as follows:
     - Define main()
         - Initialize things
         - In main loop:
-            - Get next request if one is not already waiting for capacity
-            - Update available token & request capacity
-            - If enough capacity available, call API
-            - The loop pauses if a rate limit error is hit
-            - The loop breaks when no tasks remain
+            - Wait for a free concurrency slot, then start the next request as a task
+            - Each task waits for rate limit capacity (RateLimiter), calls the API, and retries with jittered backoff
+            - A rate limit error pauses every task until the time given by the response headers
+        - Wait for all tasks to finish
     - Define dataclasses
         - StatusTracker (stores script metadata counters; only one instance is created)
         - APIRequest (stores API inputs, outputs, metadata; one method to call API)
+        - RateLimiter (token buckets for requests and tokens per minute)
     - Define functions
         - api_endpoint_from_url (extracts API endpoint from request URL)
         - append_to_jsonl (writes to results file)
@@ -96,19 +106,23 @@ The script is structured as follows:
 # import tempfile
 # from langchain.llms import OpenAI
 import asyncio
+import atexit
 import json
 import logging
-
-# import os
+import os
+import random
 import re
+import threading
 import time
 
 # for storing API inputs, outputs, and metadata
 from dataclasses import dataclass, field
-from typing import Any, List
+from typing import Any, List, Optional
 
 import aiohttp  # for making API calls concurrently
-import tiktoken  # for counting tokens
+
+from ai_ta_backend.utils.utils_tokenization import count_tokens  # for counting tokens
+from ai_ta_backend.utils.utils_tokenization import count_tokens_batch
 
 # from langchain.embeddings.openai import OpenAIEmbeddings
 # from langchain.vectorstores import Qdrant
@@ -117,8 +131,18 @@ import tiktoken  # for counting tokens
 
 class OpenAIAPIProcessor:
 
-  def __init__(self, input_prompts_list, request_url, api_key, max_requests_per_minute, max_tokens_per_minute,
-               token_encoding_name, max_attempts, logging_level):
+  def __init__(self,
+               input_prompts_list,
+               request_url,
+               api_key,
+               max_requests_per_minute,
+               max_tokens_per_minute,
+               token_encoding_name,
+               max_attempts,
+               logging_level,
+               max_inputs_per_request=1,
+               max_tokens_per_request=100_000,
+               max_concurrent_requests=100):
     self.request_url = request_url
     self.api_key = api_key
     self.max_requests_per_minute = max_requests_per_minute
@@ -126,16 +150,30 @@ class OpenAIAPIProcessor:
     self.token_encoding_name = token_encoding_name
     self.max_attempts = max_attempts
     self.logging_level = logging_level
+    self.max_inputs_per_request = max_inputs_per_request
+    self.max_tokens_per_request = max_tokens_per_request
+    self.max_concurrent_requests = max_concurrent_requests
     self.input_prompts_list: List[dict] = input_prompts_list
     self.results = []
     self.cleaned_results: List[str] = []
 
+  def run(self):
+    """
+    Blocking version of process_api_requests_from_file, for sync callers (ingest). Runs on the process-wide
+    event loop thread, so every run in this worker process shares one pool of keep-alive connections.
+    """
+    return asyncio.run_coroutine_threadsafe(self.process_api_requests_from_file(), _shared_event_loop()).result()
+
   async def process_api_requests_from_file(self):
     """Processes API requests in parallel, throttling to stay under rate limits."""
-    # constants
-    seconds_to_pause_after_rate_limit_error = 15
-    seconds_to_sleep_each_loop = 0.001  # 1 ms limits max throughput to 1,000 requests per second
+    if asyncio.get_running_loop() is _shared_loop:
+      await self._process_api_requests(_get_shared_session())
+    else:
+      # Called from some other event loop: still one session (and connection pool) for the whole run
+      async with aiohttp.ClientSession(connector=_new_connector()) as session:
+        await self._process_api_requests(session)
 
+  async def _process_api_requests(self, session: aiohttp.ClientSession):
     # initialize logging
     logging.basicConfig(level=self.logging_level)
     logging.debug(f"Logging initialized at level {self.logging_level}")
@@ -145,106 +183,42 @@ class OpenAIAPIProcessor:
     request_header = {"Authorization": f"Bearer {self.api_key}"}
 
     # initialize trackers
-    queue_of_requests_to_retry = asyncio.Queue()
     task_id_generator = task_id_generator_function()  # generates integer IDs of 1, 2, 3, ...
     status_tracker = StatusTracker()  # single instance to track a collection of variables
-    next_request = None  # variable to hold the next request to call
-
-    # initialize available capacity counts
-    available_request_capacity = self.max_requests_per_minute
-    available_token_capacity = self.max_tokens_per_minute
-    last_update_time = time.time()
-
-    # initialize flags
-    file_not_finished = True  # after file is empty, we'll skip reading it
-    logging.debug("Initialization complete.")
-
-    requests = self.input_prompts_list.__iter__()
-
-    logging.debug("File opened. Entering main loop")
+    rate_limiter = RateLimiter(self.max_requests_per_minute, self.max_tokens_per_minute)
+    # bounds the requests in flight (and the requests read ahead of them)
+    concurrency_limit = asyncio.Semaphore(self.max_concurrent_requests)
+    logging.debug("Initialization complete. Entering main loop")
 
     task_list = []
+    # Nothing polls: the loop blocks on a free slot, each request then waits for rate limit capacity (for exactly
+    # as long as the token bucket needs to refill), and retries itself with backoff.
+    for request_json, token_consumption, packed_inputs in self._iter_requests(api_endpoint):
+      await concurrency_limit.acquire()
+      request = APIRequest(task_id=next(task_id_generator),
+                           request_json=request_json,
+                           token_consumption=token_consumption,
+                           attempts_left=self.max_attempts,
+                           metadata=request_json.pop("metadata", None),
+                           packed_inputs=packed_inputs)
+      status_tracker.num_tasks_started += 1
+      status_tracker.num_tasks_in_progress += 1
+      logging.debug(f"Reading request {request.task_id}: {request}")
+
+      task = asyncio.create_task(
+          request.call_api(
+              session=session,
+              request_url=self.request_url,
+              request_header=request_header,
+              rate_limiter=rate_limiter,
+              status_tracker=status_tracker,
+          ))
+      task.add_done_callback(lambda _: concurrency_limit.release())
+      task_list.append((task, request))
 
-    while True:
-      # get next request (if one is not already waiting for capacity)
-      if next_request is None:
-        if not queue_of_requests_to_retry.empty():
-          next_request = queue_of_requests_to_retry.get_nowait()
-          logging.debug(f"Retrying request {next_request.task_id}: {next_request}")
-        elif file_not_finished:
-          try:
-            # get new request
-            # request_json = json.loads(next(requests))
-            request_json = next(requests)
-
-            next_request = APIRequest(task_id=next(task_id_generator),
-                                      request_json=request_json,
-                                      token_consumption=num_tokens_consumed_from_request(
-                                          request_json, api_endpoint, self.token_encoding_name),
-                                      attempts_left=self.max_attempts,
-                                      metadata=request_json.pop("metadata", None))
-            status_tracker.num_tasks_started += 1
-            status_tracker.num_tasks_in_progress += 1
-            logging.debug(f"Reading request {next_request.task_id}: {next_request}")
-          except StopIteration:
-            # if file runs out, set flag to stop reading it
-            logging.debug("Read file exhausted")
-            file_not_finished = False
-
-      # update available capacity
-      current_time = time.time()
-      seconds_since_update = current_time - last_update_time
-      available_request_capacity = min(
-          available_request_capacity + self.max_requests_per_minute * seconds_since_update / 60.0,
-          self.max_requests_per_minute,
-      )
-      available_token_capacity = min(
-          available_token_capacity + self.max_tokens_per_minute * seconds_since_update / 60.0,
-          self.max_tokens_per_minute,
-      )
-      last_update_time = current_time
-
-      # if enough capacity available, call API
-      if next_request:
-        next_request_tokens = next_request.token_consumption
-        if (available_request_capacity >= 1 and available_token_capacity >= next_request_tokens):
-          # update counters
-          available_request_capacity -= 1
-          available_token_capacity -= next_request_tokens
-          next_request.attempts_left -= 1
-
-          # call API
-          # TODO: NOT SURE RESPONSE WILL WORK HERE
-          task = asyncio.create_task(
-              next_request.call_api(
-                  request_url=self.request_url,
-                  request_header=request_header,
-                  retry_queue=queue_of_requests_to_retry,
-                  status_tracker=status_tracker,
-              ))
-          task_list.append(task)
-          next_request = None  # reset next_request to empty
-
-          # print("status_tracker.num_tasks_in_progress", status_tracker.num_tasks_in_progress)
-          # one_task_result = task.result()
-          # print("one_task_result", one_task_result)
-
-      # if all tasks are finished, break
-      if status_tracker.num_tasks_in_progress == 0:
-        break
-
-      # main loop sleeps briefly so concurrent tasks can run
-      await asyncio.sleep(seconds_to_sleep_each_loop)
-
-      # if a rate limit error was hit recently, pause to cool down
-      seconds_since_rate_limit_error = (time.time() - status_tracker.time_of_last_rate_limit_error)
-      if seconds_since_rate_limit_error < seconds_to_pause_after_rate_limit_error:
-        remaining_seconds_to_pause = (seconds_to_pause_after_rate_limit_error - seconds_since_rate_limit_error)
-        await asyncio.sleep(remaining_seconds_to_pause)
-        # ^e.g., if pause is 15 seconds and final limit was hit 5 seconds ago
-        logging.warn(
-            f"Pausing to cool down until {time.ctime(status_tracker.time_of_last_rate_limit_error + seconds_to_pause_after_rate_limit_error)}"
-        )
+    # asyncio wait for task_list
+    if task_list:
+      await asyncio.wait([task for task, _ in task_list])
 
     # after finishing, log final status
     logging.info("""Parallel processing complete. About to return.""")
@@ -254,15 +228,119 @@ class OpenAIAPIProcessor:
       logging.warning(
           f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate.")
 
-    # asyncio wait for task_list
-    await asyncio.wait(task_list)
-
-    for task in task_list:
+    for task, request in task_list:
       openai_completion = task.result()
-      self.results.append(openai_completion)
+      if request.packed_inputs is not None:
+        self.results.extend(unpack_embeddings_result(request.packed_inputs, openai_completion))
+      else:
+        self.results.append(openai_completion)
 
     self.cleaned_results: List[str] = extract_context_from_results(self.results)
 
+  def _iter_requests(self, api_endpoint: str):
+    """
+    Yields (request_json, token_consumption, packed_inputs). Embedding inputs are packed into multi-input requests,
+    bounded by max_inputs_per_request and max_tokens_per_request; packed_inputs keeps the original prompts (in the
+    order of the request's `input` array) so the response can be unpacked by index. Other requests pass through.
+    """
+    if api_endpoint != "embeddings" or self.max_inputs_per_request <= 1:
+      for request_json in self.input_prompts_list:
+        yield request_json, num_tokens_consumed_from_request(request_json, api_endpoint, self.token_encoding_name), None
+      return
+
+    # count every single-string input in one batched call
+    inputs = [request_json['input'] for request_json in self.input_prompts_list]
+    if all(isinstance(input, str) for input in inputs):
+      token_counts = count_tokens_batch(inputs, encoding_name=self.token_encoding_name)
+    else:
+      token_counts = [
+          num_tokens_consumed_from_request(request_json, api_endpoint, self.token_encoding_name)
+          for request_json in self.input_prompts_list
+      ]
+
+    batch: List[dict] = []
+    batch_tokens = 0
+    batch_params = None
+    for request_json, num_tokens in zip(self.input_prompts_list, token_counts):
+      params = {key: value for key, value in request_json.items() if key not in ('input', 'metadata')}
+      if batch and (params != batch_params or len(batch) >= self.max_inputs_per_request or
+                    batch_tokens + num_tokens > self.max_tokens_per_request):
+        yield {**batch_params, 'input': [prompt['input'] for prompt in batch]}, batch_tokens, batch
+        batch, batch_tokens = [], 0
+      batch.append(request_json)
+      batch_tokens += num_tokens
+      batch_params = params
+    if batch:
+      yield {**batch_params, 'input': [prompt['input'] for prompt in batch]}, batch_tokens, batch
+
+
+def unpack_embeddings_result(packed_inputs: List[dict], result: list) -> List[list]:
+  """
+  Split a multi-input embeddings result into one [request, response] pair per original prompt, matched by each
+  embedding's `index`. A request that failed after all attempts yields its errors for every prompt it carried.
+  """
+  response = result[1]
+  if isinstance(response, dict) and 'data' in response:
+    embeddings_by_index = {item['index']: item for item in response['data']}
+    responses = [{**response, 'data': [{**embeddings_by_index[i], 'index': 0}]} for i in range(len(packed_inputs))]
+  else:
+    responses = [response] * len(packed_inputs)
+
+  unpacked = []
+  for prompt, prompt_response in zip(packed_inputs, responses):
+    metadata = prompt.get('metadata')
+    prompt_json = {key: value for key, value in prompt.items() if key != 'metadata'}
+    unpacked.append([prompt_json, prompt_response, metadata] if metadata else [prompt_json, prompt_response])
+  return unpacked
+
+
+# One event loop thread and one aiohttp session per process, shared by every OpenAIAPIProcessor.run() (and so by every
+# ingest thread): connections, DNS lookups and TLS sessions are reused across requests, documents and jobs.
+_shared_loop: Optional[asyncio.AbstractEventLoop] = None
+_shared_session: Optional[aiohttp.ClientSession] = None
+_shared_lock = threading.Lock()
+
+
+def _new_connector() -> aiohttp.TCPConnector:
+  return aiohttp.TCPConnector(
+      limit=int(os.getenv('OPENAI_HTTP_MAX_CONNECTIONS', 100)),
+      keepalive_timeout=float(os.getenv('OPENAI_HTTP_KEEPALIVE_SEC', 60)),
+      ttl_dns_cache=300,
+  )
+
+
+def _shared_event_loop() -> asyncio.AbstractEventLoop:
+  global _shared_loop
+  with _shared_lock:
+    if _shared_loop is None:
+      loop = asyncio.new_event_loop()
+      threading.Thread(target=loop.run_forever, name='openai-http', daemon=True).start()
+      _shared_loop = loop
+    return _shared_loop
+
+
+def _get_shared_session() -> aiohttp.ClientSession:
+  """Only call from the shared loop, which owns the session."""
+  global _shared_session
+  if _shared_session is None or _shared_session.closed:
+    _shared_session = aiohttp.ClientSession(connector=_new_connector())
+  return _shared_session
+
+
+def _reset_after_fork():
+  # The loop thread doesn't survive fork (e.g. an rq work horse), and the parent's sockets must not be shared.
+  global _shared_loop, _shared_session, _shared_lock
+  _shared_loop, _shared_session, _shared_lock = None, None, threading.Lock()
+
+
+def _close_shared_session():
+  if _shared_loop is not None and _shared_session is not None and not _shared_session.closed:
+    asyncio.run_coroutine_threadsafe(_shared_session.close(), _shared_loop).result(timeout=5)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(_close_shared_session)
+
 
 def extract_context_from_results(results: List[Any]) -> List[str]:
   assistant_contents = []
@@ -309,40 +387,68 @@ class APIRequest:
   token_consumption: int
   attempts_left: int
   metadata: dict
+  # Original prompts of a packed multi-input embeddings request, in `input` order. None for a single-prompt request.
+  packed_inputs: Optional[List[dict]] = None
   result: list = field(default_factory=list)
 
   async def call_api(
       self,
+      session: aiohttp.ClientSession,
       request_url: str,
       request_header: dict,
-      retry_queue: asyncio.Queue,
+      rate_limiter: 'RateLimiter',
       status_tracker: StatusTracker,
   ):
-    """Calls the OpenAI API and saves results."""
-    # logging.info(f"Starting request #{self.task_id}")
-    error = None
-    try:
-      async with aiohttp.ClientSession() as session:
+    """Calls the OpenAI API until it succeeds or attempts run out, and returns the saved result."""
+    while True:
+      await rate_limiter.acquire(self.token_consumption)
+      self.attempts_left -= 1
+      # logging.info(f"Starting request #{self.task_id}")
+      error = None
+      retry_after = None
+      paused = False
+      # network errors, timeouts, 429s and 5xx are transient. Other 4xx (bad input, bad key) fail at once.
+      is_retryable = True
+      try:
         async with session.post(url=request_url, headers=request_header, json=self.request_json) as response:
+          rate_limiter.observe_remaining(response.headers)
+          is_rate_limited = response.status == 429
+          is_retryable = is_rate_limited or response.status >= 500
+          if is_rate_limited:
+            retry_after = retry_after_from_headers(response.headers)
           response = await response.json()
-      if "error" in response:
-        logging.warning(f"Request {self.task_id} failed with error {response['error']}")
-        status_tracker.num_api_errors += 1
-        error = response
-        if "Rate limit" in response["error"].get("message", ""):
-          status_tracker.time_of_last_rate_limit_error = time.time()
-          status_tracker.num_rate_limit_errors += 1
-          status_tracker.num_api_errors -= 1  # rate limit errors are counted separately
-
-    except Exception as e:  # catching naked exceptions is bad practice, but in this case we'll log & save them
-      logging.warning(f"Request {self.task_id} failed with Exception {e}")
-      status_tracker.num_other_errors += 1
-      error = e
-    if error:
+        if "error" in response:
+          logging.warning(f"Request {self.task_id} failed with error {response['error']}")
+          status_tracker.num_api_errors += 1
+          error = response
+          if is_rate_limited or "Rate limit" in response["error"].get("message", ""):
+            status_tracker.time_of_last_rate_limit_error = time.time()
+            status_tracker.num_rate_limit_errors += 1
+            status_tracker.num_api_errors -= 1  # rate limit errors are counted separately
+            # Everyone holds off, not just this request: the limit is shared
+            rate_limiter.pause(retry_after if retry_after is not None else backoff_seconds(self.num_attempts))
+            paused = True
+            is_retryable = True
+
+      except Exception as e:  # catching naked exceptions is bad practice, but in this case we'll log & save them
+        logging.warning(f"Request {self.task_id} failed with Exception {e}")
+        status_tracker.num_other_errors += 1
+        error = e
+
+      if not error:
+        data = ([self.request_json, response, self.metadata] if self.metadata else [self.request_json, response]
+               )  # type: ignore
+        #append_to_jsonl(data, save_filepath)
+        status_tracker.num_tasks_in_progress -= 1
+        status_tracker.num_tasks_succeeded += 1
+        # logging.debug(f"Request {self.task_id} saved to {save_filepath}")
+        return data
+
       self.result.append(error)
-      if self.attempts_left:
-        retry_queue.put_nowait(self)
-      else:
+      if not is_retryable:
+        logging.error(f"Request {self.task_id} failed with a non-retryable error, not retrying.")
+        self.attempts_left = 0
+      if not self.attempts_left:
         logging.error(f"Request {self.request_json} failed after all attempts. Saving errors: {self.result}")
         data = ([self.request_json, [str(e) for e in self.result], self.metadata]
                 if self.metadata else [self.request_json, [str(e) for e in self.result]])
@@ -350,15 +456,75 @@ class APIRequest:
         status_tracker.num_tasks_in_progress -= 1
         status_tracker.num_tasks_failed += 1
         return data
-    else:
-      data = ([self.request_json, response, self.metadata] if self.metadata else [self.request_json, response]
-             )  # type: ignore
-      #append_to_jsonl(data, save_filepath)
-      status_tracker.num_tasks_in_progress -= 1
-      status_tracker.num_tasks_succeeded += 1
-      # logging.debug(f"Request {self.task_id} saved to {save_filepath}")
+      # rate limited requests wait in rate_limiter.acquire() instead
+      if not paused:
+        await asyncio.sleep(backoff_seconds(self.num_attempts))
+
+  @property
+  def num_attempts(self) -> int:
+    return len(self.result)
+
+
+class RateLimiter:
+  """
+  Token buckets for requests and tokens per minute, shared by every request of one run. acquire() sleeps for exactly
+  the time the buckets need to refill instead of polling, and callers are served in FIFO order.
+  pause() stops everyone until the API says the limit resets, observe_remaining() trusts the API's own counters
+  when they are lower than ours (e.g. other workers share the API key).
+  """
+
+  def __init__(self, max_requests_per_minute: float, max_tokens_per_minute: float):
+    self.max_requests = max_requests_per_minute
+    self.max_tokens = max_tokens_per_minute
+    self.available_requests = max_requests_per_minute
+    self.available_tokens = max_tokens_per_minute
+    self.last_update_time = time.monotonic()
+    self.paused_until = 0.0
+    self._lock: Optional[asyncio.Lock] = None
+
+  def _refill(self):
+    current_time = time.monotonic()
+    seconds_since_update = current_time - self.last_update_time
+    self.available_requests = min(self.available_requests + self.max_requests * seconds_since_update / 60.0, self.max_requests)
+    self.available_tokens = min(self.available_tokens + self.max_tokens * seconds_since_update / 60.0, self.max_tokens)
+    self.last_update_time = current_time
+
+  async def acquire(self, tokens: int):
+    # a request bigger than the whole bucket would otherwise wait forever
+    tokens = min(tokens, self.max_tokens)
+    if self._lock is None:
+      self._lock = asyncio.Lock()
+    async with self._lock:
+      while True:
+        seconds_paused = self.paused_until - time.monotonic()
+        if seconds_paused > 0:
+          logging.warning(f"Rate limited, pausing requests for {seconds_paused:.1f} seconds")
+          await asyncio.sleep(seconds_paused)
+          continue
+        self._refill()
+        seconds_to_wait = max(
+            (1 - self.available_requests) * 60.0 / self.max_requests,
+            (tokens - self.available_tokens) * 60.0 / self.max_tokens,
+        )
+        if seconds_to_wait <= 0:
+          self.available_requests -= 1
+          self.available_tokens -= tokens
+          return
+        await asyncio.sleep(seconds_to_wait)
+
+  def pause(self, seconds: float):
+    self.paused_until = max(self.paused_until, time.monotonic() + seconds)
 
-      return data
+  def observe_remaining(self, headers):
+    try:
+      if 'x-ratelimit-remaining-requests' in headers:
+        self._refill()
+        self.available_requests = min(self.available_requests, float(headers['x-ratelimit-remaining-requests']))
+      if 'x-ratelimit-remaining-tokens' in headers:
+        self._refill()
+        self.available_tokens = min(self.available_tokens, float(headers['x-ratelimit-remaining-tokens']))
+    except ValueError:
+      pass
 
 
 # functions
@@ -369,7 +535,7 @@ def api_endpoint_from_url(request_url: str):
   if 'text-embedding-ada-002' in request_url:
     return 'embeddings'
   else:
-    match = re.search('^https://[^/]+/v\\d+/(.+)$', request_url)
+    match = re.search('^https?://[^/]+/v\\d+/(.+)$', request_url)
     return match[1]  # type: ignore
 
 
@@ -386,7 +552,6 @@ def num_tokens_consumed_from_request(
     token_encoding_name: str,
 ):
   """Count the number of tokens in the request. Only supports completion and embedding requests."""
-  encoding = tiktoken.get_encoding(token_encoding_name)
   # if completions request, tokens = prompt + n * max_tokens
   if api_endpoint.endswith("completions"):
     max_tokens = request_json.get("max_tokens", 15)
@@ -399,7 +564,7 @@ def num_tokens_consumed_from_request(
       for message in request_json["messages"]:
         num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
         for key, value in message.items():
-          num_tokens += len(encoding.encode(value))
+          num_tokens += count_tokens(value, encoding_name=token_encoding_name)
           if key == "name":  # if there's a name, the role is omitted
             num_tokens -= 1  # role is always required and always 1 token
       num_tokens += 2  # every reply is primed with <im_start>assistant
@@ -408,11 +573,11 @@ def num_tokens_consumed_from_request(
     else:
       prompt = request_json["prompt"]
       if isinstance(prompt, str):  # single prompt
-        prompt_tokens = len(encoding.encode(prompt))
+        prompt_tokens = count_tokens(prompt, encoding_name=token_encoding_name)
         num_tokens = prompt_tokens + completion_tokens
         return num_tokens
       elif isinstance(prompt, list):  # multiple prompts
-        prompt_tokens = sum([len(encoding.encode(p)) for p in prompt])
+        prompt_tokens = sum(count_tokens_batch(prompt, encoding_name=token_encoding_name))
         num_tokens = prompt_tokens + completion_tokens * len(prompt)
         return num_tokens
       else:
@@ -421,10 +586,10 @@ def num_tokens_consumed_from_request(
   elif api_endpoint == "embeddings":
     input = request_json["input"]
     if isinstance(input, str):  # single input
-      num_tokens = len(encoding.encode(input))
+      num_tokens = count_tokens(input, encoding_name=token_encoding_name)
       return num_tokens
     elif isinstance(input, list):  # multiple inputs
-      num_tokens = sum([len(encoding.encode(i)) for i in input])
+      num_tokens = sum(count_tokens_batch(input, encoding_name=token_encoding_name))
       return num_tokens
     else:
       raise TypeError('Expecting either string or list of strings for "inputs" field in embedding request')
@@ -433,6 +598,36 @@ def num_tokens_consumed_from_request(
     raise NotImplementedError(f'API endpoint "{api_endpoint}" not implemented in this script')
 
 
+def parse_duration(value: str) -> Optional[float]:
+  """Seconds in an OpenAI duration header, e.g. '20ms', '1s', '6m0s' or '1h2m3.5s'."""
+  parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+  if not parts:
+    return None
+  units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+  return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def retry_after_from_headers(headers) -> Optional[float]:
+  """How long a 429 response asks us to wait, from retry-after-ms, Retry-After or the x-ratelimit-reset-* headers."""
+  try:
+    if 'retry-after-ms' in headers:
+      return float(headers['retry-after-ms']) / 1000
+    if 'retry-after' in headers:
+      return float(headers['retry-after'])
+  except ValueError:
+    pass  # an HTTP date, fall back to the reset headers
+  resets = [
+      parse_duration(headers[key]) for key in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens') if key in headers
+  ]
+  resets = [seconds for seconds in resets if seconds is not None]
+  return max(resets) if resets else None
+
+
+def backoff_seconds(num_attempts: int, base: float = 1.0, cap: float = 60.0) -> float:
+  """Exponential backoff with full jitter, so retries from many requests don't arrive in lockstep."""
+  return random.uniform(0, min(cap, base * 2**max(0, num_attempts - 1)))
+
+
 def task_id_generator_function():
   """Generate integers 0, 1, 2, and so on."""
   task_id = 0
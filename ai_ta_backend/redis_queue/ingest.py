@@ -1,5 +1,5 @@
 import os
-import asyncio
+import hashlib
 import inspect
 import json
 import logging
@@ -9,20 +9,23 @@ import shutil
 import subprocess
 import time
 import traceback
+import threading
+import unicodedata
 import uuid
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from urllib.parse import quote_plus
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 
-from typing import Any, Callable, Dict, List, Optional, Union, cast
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union, cast
 
-from PIL import Image
 from pydub import AudioSegment
 from bs4 import BeautifulSoup
 from git.repo import Repo
-import pdfplumber
-import pytesseract
 import fitz
+import httpx
 
 import openai
 from .OpenaiEmbeddings import OpenAIAPIProcessor
@@ -34,6 +37,7 @@ from posthog import Posthog
 
 from qdrant_client import QdrantClient, models
 from qdrant_client.models import PointStruct
+from qdrant_client.http.exceptions import ResponseHandlingException
 
 from langchain.document_loaders import (
       Docx2txtLoader,
@@ -49,13 +53,24 @@ from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.vectorstores import Qdrant
 
+from ai_ta_backend.database.qdrant_schema import ensure_collection
+from ai_ta_backend.redis_queue.ingest_cpu import extract_pdf_text
+from ai_ta_backend.redis_queue.ingest_cpu import get_cpu_pool
+from ai_ta_backend.redis_queue.ingest_cpu import ocr_image
+from ai_ta_backend.redis_queue.ingest_cpu import ocr_pdf_page
 from ai_ta_backend.redis_queue.ingestSQL import SQLAlchemyIngestDB
+from ai_ta_backend.utils.utils_tokenization import count_tokens_batch
+from ai_ta_backend.utils.utils_tokenization import token_length_function
 
 from dotenv import load_dotenv
+from rq import get_current_job
 
 load_dotenv()
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# bulk_ingest threads share one rq job, and save_meta() writes the whole meta dict
+_job_meta_lock = threading.Lock()
+
 class Ingest:
     """
     Class for ingesting documents into the vector database.
@@ -77,18 +92,8 @@ class Ingest:
         if self.qdrant_api_key and self.qdrant_url:
             self.qdrant_client = QdrantClient(url=self.qdrant_url, api_key=self.qdrant_api_key)
             
-            # Check if the collection exists
-            if not self.qdrant_client.get_collection(self.qdrant_collection_name):
-                # Create the collection if it doesn't exist
-                logging.info(f"Creating collection {self.qdrant_collection_name}")
-                self.qdrant_client.create_collection(
-                    collection_name=self.qdrant_collection_name,
-                    vectors_config={
-                        "size": 1536,  # Example size, adjust as needed
-                        "distance": "Cosine"  # Example distance metric, adjust as needed
-                    }
-                )
-                logging.info(f"Collection exists? {self.qdrant_client.get_collection(self.qdrant_collection_name)}")
+            # Create the collection if it doesn't exist (the worker may start before the web app), no-op otherwise
+            ensure_collection(self.qdrant_client, self.qdrant_collection_name)
             
             self.vectorstore = Qdrant(
                 client=self.qdrant_client,
@@ -181,14 +186,15 @@ class Ingest:
 
     
     def bulk_ingest(self, course_name: str, s3_paths: Union[str, List[str]],
-                  **kwargs) -> Dict[str, None | str | Dict[str, str]]:
+                  **kwargs) -> Dict[str, None | str | Dict[str, str] | List]:
         """
         Bulk ingest a list of s3 paths into the vectorstore, and also into the supabase database.
-        -> Dict[str, str | Dict[str, str]]
+        Files are ingested concurrently, up to INGEST_MAX_CONCURRENCY at a time.
+        -> Dict[str, str | Dict[str, str]] for a single file. For several files, lists of the per-file values.
         """
         print(f"Top of bulk_ingest: ", kwargs)
 
-        def _ingest_single(ingest_method: Callable, s3_path, *args, **kwargs):
+        def _ingest_single(ingest_method: Callable, s3_path, success_status, *args, **kwargs):
             """Handle running an arbitrary ingest function for an individual file."""
             # RUN INGEST METHOD
             ret = ingest_method(s3_path, *args, **kwargs)
@@ -235,77 +241,138 @@ class Ingest:
         }
         # 👆👆👆👆 ADD NEW INGEST METHODhe 👆👆👆👆🎉
 
-        print(f"Top of ingest, Course_name {course_name}. S3 paths {s3_paths}")
-        success_status: Dict[str, None | str | Dict[str, str]] = {"success_ingest": None, "failure_ingest": None}
-        try:
-            if isinstance(s3_paths, str):
-                s3_paths = [s3_paths]
-
-            for s3_path in s3_paths:
+        def _ingest_file(s3_path: str) -> Dict[str, None | str | Dict[str, str]]:
+            """Ingest one file. Runs on a worker thread, so it only touches its own status dict."""
+            success_status: Dict[str, None | str | Dict[str, str]] = {"success_ingest": None, "failure_ingest": None}
+            try:
                 file_extension = Path(s3_path).suffix
-                with NamedTemporaryFile(suffix=file_extension) as tmpfile:
-                    self.s3_client.download_fileobj(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_path, Fileobj=tmpfile)
-                    mime_type = str(mimetypes.guess_type(tmpfile.name, strict=False)[0])
-                    mime_category = mime_type.split('/')[0] if '/' in mime_type else mime_type
-
-                if file_extension in file_ingest_methods:
-                    # Use specialized functions when possible, fallback to mimetype. Else raise error.
-                    ingest_method = file_ingest_methods[file_extension]
-                    _ingest_single(ingest_method, s3_path, course_name, **kwargs)
-                elif mime_category in mimetype_ingest_methods:
-                    # fallback to MimeType
-                    print("mime category", mime_category)
-                    ingest_method = mimetype_ingest_methods[mime_category]
-                    _ingest_single(ingest_method, s3_path, course_name, **kwargs)
-                else:
-                    # No supported ingest... Fallback to attempting utf-8 decoding, otherwise fail.
-                    try:
-                        self._ingest_single_txt(s3_path, course_name, **kwargs)
-                        success_status['success_ingest'] = s3_path
-                        print(f"No ingest methods -- Falling back to UTF-8 INGEST... s3_path = {s3_path}")
-                    except Exception as e:
-                        print(
-                            f"We don't have a ingest method for this filetype: {file_extension}. As a last-ditch effort, we tried to ingest the file as utf-8 text, but that failed too. File is unsupported: {s3_path}. UTF-8 ingest error: {e}"
-                        )
-                        success_status['failure_ingest'] = {
-                            's3_path':
-                                s3_path,
-                            'error':
-                                f"We don't have a ingest method for this filetype: {file_extension} (with generic type {mime_type}), for file: {s3_path}"
-                        }
-                        if self.posthog:
-                            self.posthog.capture(
-                                'distinct_id_of_the_user',
-                                event='ingest_failure',
-                                properties={
-                                    'course_name':
-                                        course_name,
-                                    's3_path':
-                                        s3_paths,
-                                    'kwargs':
-                                        kwargs,
-                                    'error':
-                                        f"We don't have a ingest method for this filetype: {file_extension} (with generic type {mime_type}), for file: {s3_path}"
-                                })
-
-            return success_status
-        except Exception as e:
-            err = f"❌❌ Error in /ingest: `{inspect.currentframe().f_code.co_name}`: {e}\nTraceback:\n", traceback.format_exc()  # type: ignore
-
-            success_status['failure_ingest'] = {'s3_path': s3_path, 'error': f"MAJOR ERROR DURING INGEST: {err}"}
-            if self.posthog:
-                self.posthog.capture('distinct_id_of_the_user',
+                mime_type = self._guess_mime_type(s3_path)
+                mime_category = mime_type.split('/')[0] if '/' in mime_type else mime_type
+
+                # Download each object exactly once. Every ingest method (and the OCR fallback) reads this local copy,
+                # which lives until the file is fully ingested.
+                with self._local_copy(s3_path) as local_path:
+                    if file_extension in file_ingest_methods:
+                        # Use specialized functions when possible, fallback to mimetype. Else raise error.
+                        ingest_method = file_ingest_methods[file_extension]
+                        _ingest_single(ingest_method, s3_path, success_status, course_name, local_path=local_path, **kwargs)
+                    elif mime_category in mimetype_ingest_methods:
+                        # fallback to MimeType
+                        print("mime category", mime_category)
+                        ingest_method = mimetype_ingest_methods[mime_category]
+                        _ingest_single(ingest_method, s3_path, success_status, course_name, local_path=local_path, **kwargs)
+                    else:
+                        # No supported ingest... Fallback to attempting utf-8 decoding, otherwise fail.
+                        try:
+                            self._ingest_single_txt(s3_path, course_name, local_path=local_path, **kwargs)
+                            success_status['success_ingest'] = s3_path
+                            print(f"No ingest methods -- Falling back to UTF-8 INGEST... s3_path = {s3_path}")
+                        except Exception as e:
+                            print(
+                                f"We don't have a ingest method for this filetype: {file_extension}. As a last-ditch effort, we tried to ingest the file as utf-8 text, but that failed too. File is unsupported: {s3_path}. UTF-8 ingest error: {e}"
+                            )
+                            success_status['failure_ingest'] = {
+                                's3_path':
+                                    s3_path,
+                                'error':
+                                    f"We don't have a ingest method for this filetype: {file_extension} (with generic type {mime_type}), for file: {s3_path}"
+                            }
+                            if self.posthog:
+                                self.posthog.capture(
+                                    'distinct_id_of_the_user',
                                     event='ingest_failure',
                                     properties={
-                                        'course_name': course_name,
-                                        's3_path': s3_paths,
-                                        'kwargs': kwargs,
-                                        'error': err
+                                        'course_name':
+                                            course_name,
+                                        's3_path':
+                                            s3_paths,
+                                        'kwargs':
+                                            kwargs,
+                                        'error':
+                                            f"We don't have a ingest method for this filetype: {file_extension} (with generic type {mime_type}), for file: {s3_path}"
                                     })
+                return success_status
+            except Exception as e:
+                err = f"❌❌ Error in /ingest: `{inspect.currentframe().f_code.co_name}`: {e}\nTraceback:\n", traceback.format_exc()  # type: ignore
 
-            sentry_sdk.capture_exception(e)
-            print(f"MAJOR ERROR IN /bulk_ingest: {str(e)}")
-            return success_status
+                success_status['failure_ingest'] = {'s3_path': s3_path, 'error': f"MAJOR ERROR DURING INGEST: {err}"}
+                if self.posthog:
+                    self.posthog.capture('distinct_id_of_the_user',
+                                        event='ingest_failure',
+                                        properties={
+                                            'course_name': course_name,
+                                            's3_path': s3_paths,
+                                            'kwargs': kwargs,
+                                            'error': err
+                                        })
+
+                sentry_sdk.capture_exception(e)
+                print(f"MAJOR ERROR IN /bulk_ingest: {str(e)}")
+                return success_status
+
+        print(f"Top of ingest, Course_name {course_name}. S3 paths {s3_paths}")
+        if isinstance(s3_paths, str):
+            s3_paths = [s3_paths]
+
+        max_workers = min(len(s3_paths), int(os.getenv('INGEST_MAX_CONCURRENCY', 4)))
+        if max_workers <= 1:
+            statuses = [_ingest_file(s3_path) for s3_path in s3_paths]
+        else:
+            # Threads overlap the network round trips (S3, OpenAI, Qdrant, SQL), CPU-heavy parsing goes to ingest_cpu's process pool.
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bulk_ingest') as executor:
+                statuses = list(executor.map(_ingest_file, s3_paths))
+        return self._merge_ingest_statuses(statuses)
+
+    @staticmethod
+    def _merge_ingest_statuses(
+            statuses: List[Dict[str, None | str | Dict[str, str]]]) -> Dict[str, None | str | Dict[str, str] | List]:
+        """
+        A single file keeps the original shape. For several files, each key holds the list of per-file values
+        (None when empty), so callers checking `if result['failure_ingest']` keep working.
+        """
+        if len(statuses) == 1:
+            return statuses[0]  # type: ignore
+        successes = [status['success_ingest'] for status in statuses if status['success_ingest']]
+        failures = [status['failure_ingest'] for status in statuses if status['failure_ingest']]
+        return {"success_ingest": successes or None, "failure_ingest": failures or None}
+
+    def _guess_mime_type(self, s3_path: str) -> str:
+        """
+        MIME type from the file extension, falling back to the object's Content-Type via a HEAD request (no body download).
+        """
+        mime_type = mimetypes.guess_type(s3_path, strict=False)[0]
+        if mime_type is None:
+            try:
+                head = self.s3_client.head_object(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_path)
+                content_type = head.get('ContentType', '')
+                if content_type and content_type not in ('binary/octet-stream', 'application/octet-stream'):
+                    mime_type = content_type.split(';')[0].strip()
+            except Exception as e:
+                print(f"Could not HEAD {s3_path} for its Content-Type: {e}")
+        return str(mime_type)
+
+    @contextmanager
+    def _local_copy(self, s3_path: str, local_path: Optional[str] = None):
+        """
+        Yields a path to a local copy of the S3 object. Reuses `local_path` when the caller (bulk_ingest) already downloaded it,
+        otherwise downloads into a temp file that is deleted on exit.
+        """
+        if local_path:
+            yield local_path
+            return
+        with NamedTemporaryFile(suffix=Path(s3_path).suffix) as tmpfile:
+            self.s3_client.download_fileobj(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_path, Fileobj=tmpfile)
+            tmpfile.flush()
+            yield tmpfile.name
+
+    def _read_text(self, s3_path: str, local_path: Optional[str] = None) -> str:
+        """UTF-8 text of the S3 object, from the local copy if there is one."""
+        if local_path:
+            with open(local_path, 'rb') as f:
+                return f.read().decode('utf-8', errors='ignore')
+        # NOTE: no need for a temp file here, the text is the response 'body'
+        response = self.s3_client.get_object(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_path)
+        return response['Body'].read().decode('utf-8', errors='ignore')
 
     
     def ingest_single_web_text(self, course_name: str, base_url: str, url: str, content: str, readable_filename: str, **kwargs) -> Dict[str, None | str | Dict[str, str]]:
@@ -355,15 +422,11 @@ class Ingest:
             success_or_failure['failure_ingest'] = {'url': url, 'error': str(err)}
             return success_or_failure
     
-    def _ingest_single_py(self, s3_path: str, course_name: str, **kwargs):
+    def _ingest_single_py(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs):
         try:
-            file_name = s3_path.split("/")[-1]
-            file_path = "media/" + file_name  # download from s3 to local folder for ingest
-
-            self.s3_client.download_file(os.getenv('S3_BUCKET_NAME'), s3_path, file_path)
-
-            loader = PythonLoader(file_path)
-            documents = loader.load()
+            with self._local_copy(s3_path, local_path) as file_path:
+                loader = PythonLoader(file_path)
+                documents = loader.load()
 
             texts = [doc.page_content for doc in documents]
 
@@ -378,7 +441,6 @@ class Ingest:
                 'base_url': kwargs.get('base_url', ''),
             } for doc in documents]
             #print(texts)
-            os.remove(file_path)
 
             success_or_failure = self.split_and_upload(texts=texts, metadatas=metadatas)
             print("Python ingest: ", success_or_failure)
@@ -391,15 +453,13 @@ class Ingest:
             sentry_sdk.capture_exception(e)
             return err
     
-    def _ingest_single_vtt(self, s3_path: str, course_name: str, **kwargs):
+    def _ingest_single_vtt(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs):
         """
         Ingest a single .vtt file from S3.
         """
         try:
-            with NamedTemporaryFile() as tmpfile:
-                # download from S3 into vtt_tmpfile
-                self.s3_client.download_fileobj(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_path, Fileobj=tmpfile)
-                loader = TextLoader(tmpfile.name)
+            with self._local_copy(s3_path, local_path) as vtt_path:
+                loader = TextLoader(vtt_path)
                 documents = loader.load()
                 texts = [doc.page_content for doc in documents]
 
@@ -422,11 +482,10 @@ class Ingest:
             sentry_sdk.capture_exception(e)
             return err
     
-    def _ingest_html(self, s3_path: str, course_name: str, **kwargs) -> str:
+    def _ingest_html(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs) -> str:
         print(f"IN _ingest_html s3_path `{s3_path}` kwargs: {kwargs}")
         try:
-            response = self.s3_client.get_object(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_path)
-            raw_html = response['Body'].read().decode('utf-8', errors='ignore')
+            raw_html = self._read_text(s3_path, local_path)
 
             soup = BeautifulSoup(raw_html, 'html.parser')
             title = s3_path.replace("courses/" + course_name, "")
@@ -456,7 +515,7 @@ class Ingest:
             sentry_sdk.capture_exception(e)
             return err
         
-    def _ingest_single_video(self, s3_path: str, course_name: str, **kwargs) -> str:
+    def _ingest_single_video(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs) -> str:
         """
         Ingest a single video file from S3.
         """
@@ -471,20 +530,17 @@ class Ingest:
             file_ext = Path(s3_path).suffix
             openai.api_key = os.getenv('OPENAI_API_KEY')
             transcript_list = []
-            with NamedTemporaryFile(suffix=file_ext) as video_tmpfile:
-                # download from S3 into an video tmpfile
-                self.s3_client.download_fileobj(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_path, Fileobj=video_tmpfile)
-
+            with self._local_copy(s3_path, local_path) as video_path:
                 # try with original file first
                 try:
-                    mp4_version = AudioSegment.from_file(video_tmpfile.name, file_ext[1:])
+                    mp4_version = AudioSegment.from_file(video_path, file_ext[1:])
                 except Exception as e:
                     print("Applying moov atom fix and retrying...")
                     # Fix the moov atom issue using FFmpeg
                     fixed_video_tmpfile = NamedTemporaryFile(suffix=file_ext, delete=False)
                     try:
                         result = subprocess.run([
-                            'ffmpeg', '-y', '-i', video_tmpfile.name, '-c', 'copy', '-movflags', 'faststart',
+                            'ffmpeg', '-y', '-i', video_path, '-c', 'copy', '-movflags', 'faststart',
                             fixed_video_tmpfile.name
                         ],
                                                 check=True,
@@ -564,12 +620,10 @@ class Ingest:
             return str(err)
 
     
-    def _ingest_single_docx(self, s3_path: str, course_name: str, **kwargs) -> str:
+    def _ingest_single_docx(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs) -> str:
         try:
-            with NamedTemporaryFile() as tmpfile:
-                self.s3_client.download_fileobj(Bucket=os.getenv('S3_BUCKET_NAME'), Key=s3_path, Fileobj=tmpfile)
-
-                loader = Docx2txtLoader(tmpfile.name)
+            with self._local_copy(s3_path, local_path) as docx_path:
+                loader = Docx2txtLoader(docx_path)
                 documents = loader.load()
 
                 texts = [doc.page_content for doc in documents]
@@ -593,13 +647,11 @@ class Ingest:
             sentry_sdk.capture_exception(e)
             return str(err)
     
-    def _ingest_single_srt(self, s3_path: str, course_name: str, **kwargs) -> str:
+    def _ingest_single_srt(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs) -> str:
         try:
             import pysrt
 
-            # NOTE: slightly different method for .txt files, no need for download. It's part of the 'body'
-            response = self.s3_client.get_object(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_path)
-            raw_text = response['Body'].read().decode('utf-8', errors='ignore')
+            raw_text = self._read_text(s3_path, local_path)
 
             print("UTF-8 text to ingest as SRT:", raw_text)
             parsed_info = pysrt.from_string(raw_text)
@@ -629,13 +681,10 @@ class Ingest:
             sentry_sdk.capture_exception(e)
             return str(err)
     
-    def _ingest_single_excel(self, s3_path: str, course_name: str, **kwargs) -> str:
+    def _ingest_single_excel(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs) -> str:
         try:
-            with NamedTemporaryFile() as tmpfile:
-                # download from S3 into pdf_tmpfile
-                self.s3_client.download_fileobj(Bucket=os.getenv('S3_BUCKET_NAME'), Key=s3_path, Fileobj=tmpfile)
-
-                loader = UnstructuredExcelLoader(tmpfile.name, mode="elements")
+            with self._local_copy(s3_path, local_path) as excel_path:
+                loader = UnstructuredExcelLoader(excel_path, mode="elements")
                 # loader = SRTLoader(tmpfile.name)
                 documents = loader.load()
 
@@ -660,11 +709,9 @@ class Ingest:
             sentry_sdk.capture_exception(e)
             return str(err)
     
-    def _ingest_single_image(self, s3_path: str, course_name: str, **kwargs) -> str:
+    def _ingest_single_image(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs) -> str:
         try:
-            with NamedTemporaryFile() as tmpfile:
-                # download from S3 into pdf_tmpfile
-                self.s3_client.download_fileobj(Bucket=os.getenv('S3_BUCKET_NAME'), Key=s3_path, Fileobj=tmpfile)
+            with self._local_copy(s3_path, local_path) as image_path:
                 """
                 # Unstructured image loader makes the install too large (700MB --> 6GB. 3min -> 12 min build times). AND nobody uses it.
                 # The "hi_res" strategy will identify the layout of the document using detectron2. "ocr_only" uses pdfminer.six. https://unstructured-io.github.io/unstructured/core/partition.html#partition-image
@@ -672,7 +719,7 @@ class Ingest:
                 documents = loader.load()
                 """
 
-                res_str = pytesseract.image_to_string(Image.open(tmpfile.name))
+                res_str = get_cpu_pool().submit(ocr_image, image_path).result()
                 print("IMAGE PARSING RESULT:", res_str)
                 documents = [Document(page_content=res_str)]
 
@@ -697,13 +744,10 @@ class Ingest:
             sentry_sdk.capture_exception(e)
             return str(err)
     
-    def _ingest_single_csv(self, s3_path: str, course_name: str, **kwargs) -> str:
+    def _ingest_single_csv(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs) -> str:
         try:
-            with NamedTemporaryFile() as tmpfile:
-                # download from S3 into pdf_tmpfile
-                self.s3_client.download_fileobj(Bucket=os.getenv('S3_BUCKET_NAME'), Key=s3_path, Fileobj=tmpfile)
-
-                loader = CSVLoader(file_path=tmpfile.name)
+            with self._local_copy(s3_path, local_path) as csv_path:
+                loader = CSVLoader(file_path=csv_path)
                 documents = loader.load()
 
                 texts = [doc.page_content for doc in documents]
@@ -727,21 +771,19 @@ class Ingest:
             sentry_sdk.capture_exception(e)
             return str(err)
     
-    def _ingest_single_pdf(self, s3_path: str, course_name: str, **kwargs):
+    def _ingest_single_pdf(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs):
         """
-        Both OCR the PDF. And grab the first image as a PNG.
+        Extract the PDF's text layer, OCR only the pages that need it (see _page_needs_ocr), and grab the first page as a PNG.
         LangChain `Documents` have .metadata and .page_content attributes.
         Be sure to use TemporaryFile() to avoid memory leaks!
         """
         print("IN PDF ingest: s3_path: ", s3_path, "and kwargs:", kwargs)
 
         try:
-            with NamedTemporaryFile() as pdf_tmpfile:
-                # download from S3 into pdf_tmpfile
-                self.s3_client.download_fileobj(Bucket=os.getenv('S3_BUCKET_NAME'), Key=s3_path, Fileobj=pdf_tmpfile)
+            with self._local_copy(s3_path, local_path) as pdf_path:
                 ### READ OCR of PDF
                 try:
-                    doc = fitz.open(pdf_tmpfile.name)  # type: ignore
+                    doc = fitz.open(pdf_path)  # type: ignore
                 except fitz.fitz.EmptyFileError as e:
                     print(f"Empty PDF file: {s3_path}")
                     return "Failed ingest: Could not detect ANY text in the PDF. OCR did not help. PDF appears empty of text."
@@ -751,24 +793,46 @@ class Ingest:
                 zoom_y = 2.0  # vertical zoom
                 mat = fitz.Matrix(zoom_x, zoom_y)  # zoom factor 2 in each dimension
 
-                pdf_pages_no_OCR: List[Dict] = []
-                for i, page in enumerate(doc):  # type: ignore
-
-                    # UPLOAD FIRST PAGE IMAGE to S3
-                    if i == 0:
-                        with NamedTemporaryFile(suffix=".png") as first_page_png:
-                            pix = page.get_pixmap(matrix=mat)
-                            pix.save(first_page_png)  # store image as a PNG
-
-                            s3_upload_path = str(Path(s3_path)).rsplit('.pdf')[0] + "-pg1-thumb.png"
-                            first_page_png.seek(0)  # Seek the file pointer back to the beginning
-                            with open(first_page_png.name, 'rb') as f:
-                                print("Uploading image png to S3")
-                                self.s3_client.upload_fileobj(f, os.getenv('S3_BUCKET_NAME'), s3_upload_path)
-
-                    # Extract text
-                    text = page.get_text().encode("utf8").decode("utf8", errors='ignore')  # get plain text (is in UTF-8)
-                    pdf_pages_no_OCR.append(dict(text=text, page_number=i, readable_filename=Path(s3_path).name[37:]))
+                # Extract text in the CPU pool while this thread renders and uploads the thumbnail
+                page_texts = get_cpu_pool().submit(extract_pdf_text, pdf_path)
+
+                # UPLOAD FIRST PAGE IMAGE to S3
+                if len(doc) > 0:  # type: ignore
+                    with NamedTemporaryFile(suffix=".png") as first_page_png:
+                        pix = doc[0].get_pixmap(matrix=mat)  # type: ignore
+                        pix.save(first_page_png)  # store image as a PNG
+
+                        s3_upload_path = str(Path(s3_path)).rsplit('.pdf')[0] + "-pg1-thumb.png"
+                        first_page_png.seek(0)  # Seek the file pointer back to the beginning
+                        with open(first_page_png.name, 'rb') as f:
+                            print("Uploading image png to S3")
+                            self.s3_client.upload_fileobj(f, os.getenv('S3_BUCKET_NAME'), s3_upload_path)
+
+                # Classify pages on the already-open document (cheap: image bboxes only, nothing is decoded)
+                image_coverages = [self._image_coverage(page) for page in doc]  # type: ignore
+                doc.close()  # type: ignore
+
+                pdf_pages_no_OCR: List[Dict] = [
+                    dict(text=text, page_number=i, readable_filename=Path(s3_path).name[37:])
+                    for i, text in enumerate(page_texts.result())
+                ]
+                ocr_page_numbers = [
+                    page['page_number'] for page in pdf_pages_no_OCR
+                    if self._page_needs_ocr(page['text'], image_coverages[page['page_number']])
+                ]
+                if pdf_pages_no_OCR and not any(page['text'].strip() for page in pdf_pages_no_OCR):
+                    print("⚠️ PDF IS EMPTY -- OCR-ing the PDF.")
+                    return self._ocr_pdf(s3_path=s3_path, course_name=course_name, local_path=pdf_path, **kwargs)
+                if ocr_page_numbers:
+                    # OCR only the scanned pages and keep the text layer everywhere else
+                    print(f"OCR-ing {len(ocr_page_numbers)} of {len(pdf_pages_no_OCR)} pages: {ocr_page_numbers}")
+                    ocr_texts = self._ocr_pdf_pages(s3_path, pdf_path, ocr_page_numbers)
+                    for page_number, ocr_text in ocr_texts.items():
+                        page = pdf_pages_no_OCR[page_number]
+                        # The page's text layer is effectively empty (a stray caption or page number at most), and the
+                        # OCR text includes it, so keep whichever captured more
+                        if len(ocr_text.strip()) > len(page['text'].strip()):
+                            page['text'] = ocr_text
 
                 metadatas: List[Dict[str, Any]] = [{
                     'course_name': course_name,
@@ -782,14 +846,11 @@ class Ingest:
 
                 pdf_texts = [page['text'] for page in pdf_pages_no_OCR]
 
-                # count the total number of words in the pdf_texts. If it's less than 100, we'll OCR the PDF
                 has_words = any(text.strip() for text in pdf_texts)
-                if has_words:
-                    success_or_failure = self.split_and_upload(texts=pdf_texts, metadatas=metadatas, **kwargs)
-                else:
-                    print("⚠️ PDF IS EMPTY -- OCR-ing the PDF.")
-                    success_or_failure = self._ocr_pdf(s3_path=s3_path, course_name=course_name, **kwargs)
+                if not has_words:
+                    return "Failed ingest: Could not detect ANY text in the PDF. OCR did not help. PDF appears empty of text."
 
+                success_or_failure = self.split_and_upload(texts=pdf_texts, metadatas=metadatas, **kwargs)
                 return success_or_failure
         except Exception as e:
             err = f"❌❌ Error in PDF ingest (no OCR): `{inspect.currentframe().f_code.co_name}`: {e}\nTraceback:\n", traceback.format_exc(
@@ -799,7 +860,27 @@ class Ingest:
             return err
             
     
-    def _ocr_pdf(self, s3_path: str, course_name: str, **kwargs):
+    @staticmethod
+    def _image_coverage(page) -> float:
+        """Fraction of the page's area covered by images (capped at 1, overlapping images are counted twice)."""
+        page_area = abs(page.rect)
+        if not page_area:
+            return 0.0
+        image_area = sum(abs(fitz.Rect(image['bbox']) & page.rect) for image in page.get_image_info())
+        return min(1.0, image_area / page_area)
+
+    @staticmethod
+    def _page_needs_ocr(text: str, image_coverage: float) -> bool:
+        """
+        A page needs OCR when images cover most of it *and* its text layer is effectively empty, i.e. a scan or a
+        scanned figure whose words are only in the pixels. Text density is characters per image-covered page, so a
+        slide with a background image or a textbook page with a big figure keeps its exact text layer.
+        """
+        if image_coverage < float(os.getenv('OCR_MIN_IMAGE_COVERAGE', 0.5)):
+            return False
+        return len(text.strip()) / image_coverage < int(os.getenv('OCR_MIN_TEXT_CHARS', 50))
+
+    def _ocr_pdf(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs):
         if self.posthog:
             self.posthog.capture('distinct_id_of_the_user',
                                 event='ocr_pdf_invoked',
@@ -810,17 +891,12 @@ class Ingest:
 
         pdf_pages_OCRed: List[Dict] = []
         try:
-            with NamedTemporaryFile() as pdf_tmpfile:
-                # download from S3 into pdf_tmpfile
-                self.s3_client.download_fileobj(Bucket=os.getenv('S3_BUCKET_NAME'), Key=s3_path, Fileobj=pdf_tmpfile)
-
-                with pdfplumber.open(pdf_tmpfile.name) as pdf:
-                # for page in :
-                    for i, page in enumerate(pdf.pages):
-                        im = page.to_image()
-                        text = pytesseract.image_to_string(im.original)
-                        print("Page number: ", i, "Text: ", text[:100])
-                        pdf_pages_OCRed.append(dict(text=text, page_number=i, readable_filename=Path(s3_path).name[37:]))
+            with self._local_copy(s3_path, local_path) as pdf_path:
+                with fitz.open(pdf_path) as doc:  # type: ignore
+                    num_pages = len(doc)
+                page_texts = self._ocr_pdf_pages(s3_path, pdf_path, list(range(num_pages)))
+                for i in range(num_pages):
+                    pdf_pages_OCRed.append(dict(text=page_texts[i], page_number=i, readable_filename=Path(s3_path).name[37:]))
 
             metadatas: List[Dict[str, Any]] = [
                 {
@@ -855,20 +931,51 @@ class Ingest:
             sentry_sdk.capture_exception(e)
             return err
     
-    def _ingest_single_txt(self, s3_path: str, course_name: str, **kwargs) -> str:
+    def _ocr_pdf_pages(self, s3_path: str, pdf_path: str, page_numbers: List[int]) -> Dict[int, str]:
+        """
+        OCR the given pages in parallel on the CPU pool. Returns {page_number: text}.
+        A page that fails or times out (OCR_PAGE_TIMEOUT_SEC) comes back as '' instead of failing the whole document.
+        Progress is reported on the rq job, see _report_ocr_progress.
+        """
+        dpi = int(os.getenv('OCR_DPI', 300))
+        timeout_sec = float(os.getenv('OCR_PAGE_TIMEOUT_SEC', 120))
+        pool = get_cpu_pool()
+        futures = {pool.submit(ocr_pdf_page, pdf_path, page_number, dpi, timeout_sec): page_number for page_number in page_numbers}
+
+        page_texts: Dict[int, str] = {}
+        for future in as_completed(futures):
+            page_number = futures[future]
+            try:
+                page_texts[page_number] = future.result()
+            except Exception as e:
+                print(f"OCR failed on page {page_number} of {s3_path}, skipping the page: {e}")
+                page_texts[page_number] = ''
+            self._report_ocr_progress(s3_path, len(page_texts), len(page_numbers))
+        return page_texts
+
+    @staticmethod
+    def _report_ocr_progress(s3_path: str, pages_done: int, pages_total: int):
+        """Record OCR progress in the rq job's meta (job.meta['ocr_progress'][s3_path]), for the queue dashboard."""
+        job = get_current_job()
+        if job is None:
+            return
+        with _job_meta_lock:
+            job.meta.setdefault('ocr_progress', {})[s3_path] = {'pages_done': pages_done, 'pages_total': pages_total}
+            job.save_meta()
+
+    def _ingest_single_txt(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs) -> str:
         """Ingest a single .txt or .md file from S3.
         Args:
             s3_path (str): A path to a .txt file in S3
             course_name (str): The name of the course
+            local_path (str, optional): The file, if bulk_ingest already downloaded it
         Returns:
             str: "Success" or an error message
         """
         print("In text ingest, UTF-8")
         print("kwargs", kwargs)
         try:
-            # NOTE: slightly different method for .txt files, no need for download. It's part of the 'body'
-            response = self.s3_client.get_object(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_path)
-            text = response['Body'].read().decode('utf-8', errors='ignore')
+            text = self._read_text(s3_path, local_path)
             print("UTF-8 text to ignest (from s3)", text)
             text = [text]
 
@@ -892,17 +999,13 @@ class Ingest:
             sentry_sdk.capture_exception(e)
             return str(err)
         
-    def _ingest_single_ppt(self, s3_path: str, course_name: str, **kwargs) -> str:
+    def _ingest_single_ppt(self, s3_path: str, course_name: str, local_path: Optional[str] = None, **kwargs) -> str:
         """
         Ingest a single .ppt or .pptx file from S3.
         """
         try:
-            with NamedTemporaryFile() as tmpfile:
-                # download from S3 into pdf_tmpfile
-                #print("in ingest PPTX")
-                self.s3_client.download_fileobj(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_path, Fileobj=tmpfile)
-
-                loader = UnstructuredPowerPointLoader(tmpfile.name)
+            with self._local_copy(s3_path, local_path) as ppt_path:
+                loader = UnstructuredPowerPointLoader(ppt_path)
                 documents = loader.load()
 
                 texts = [doc.page_content for doc in documents]
@@ -949,17 +1052,32 @@ class Ingest:
             shutil.rmtree("media/cloned_repo")
             # create metadata for each file in data
 
-            for doc in data:
-                texts = doc.page_content
-                metadatas: Dict[str, Any] = {
-                    'course_name': course_name,
-                    's3_path': '',
-                    'readable_filename': doc.metadata['file_name'],
-                    'url': f"{github_url}/blob/main/{doc.metadata['file_path']}",
-                    'pagenumber': '',
-                    'timestamp': '',
-                }
-                self.split_and_upload(texts=[texts], metadatas=[metadatas])
+            # SQL rows are written in bulk, INGEST_SQL_BULK_BATCH_SIZE files per transaction, not one commit per file.
+            # Their points are already in Qdrant, so the batch also bounds what a crashed job leaves without SQL rows.
+            bulk_batch_size = int(os.getenv('INGEST_SQL_BULK_BATCH_SIZE', 100))
+            pending_documents: List[Tuple[dict, List[dict]]] = []
+            try:
+                for doc in data:
+                    texts = doc.page_content
+                    metadatas: Dict[str, Any] = {
+                        'course_name': course_name,
+                        's3_path': '',
+                        'readable_filename': doc.metadata['file_name'],
+                        'url': f"{github_url}/blob/main/{doc.metadata['file_path']}",
+                        'pagenumber': '',
+                        'timestamp': '',
+                    }
+                    self.split_and_upload(texts=[texts], metadatas=[metadatas], pending_documents=pending_documents)
+                    if len(pending_documents) >= bulk_batch_size:
+                        self._flush_pending_documents(pending_documents)
+            except Exception:
+                # files already in Qdrant still get their SQL rows, but the ingest error is the one reported
+                try:
+                    self._flush_pending_documents(pending_documents)
+                except Exception as flush_error:
+                    logging.error(f"Failed to write the documents ingested before the error: {flush_error}")
+                raise
+            self._flush_pending_documents(pending_documents)
             return "Success"
         except Exception as e:
             err = f"❌❌ Error in (GITHUB ingest): `{inspect.currentframe().f_code.co_name}`: {e}\nTraceback:\n{traceback.format_exc()}"
@@ -967,7 +1085,11 @@ class Ingest:
             sentry_sdk.capture_exception(e)
             return err
     
-    def split_and_upload(self, texts: List[str], metadatas: List[Dict[str, Any]], **kwargs):
+    def split_and_upload(self,
+                         texts: List[str],
+                         metadatas: List[Dict[str, Any]],
+                         pending_documents: Optional[List[Tuple[dict, List[dict]]]] = None,
+                         **kwargs):
         """ This is usually the last step of document ingest. Chunk & upload to Qdrant (and Supabase.. todo).
         Takes in Text and Metadata (from Langchain doc loaders) and splits / uploads to Qdrant.
 
@@ -976,6 +1098,8 @@ class Ingest:
         Args:
             texts (List[str]): _description_
             metadatas (List[Dict[str, Any]]): _description_
+            pending_documents: if given, the SQL document and its chunks are appended here for the caller to write
+                with insert_documents_bulk(), instead of being inserted now. Not used with doc groups.
         """
         # return "Success"
         logging.info(f"Split and upload invoked with {len(texts)} texts and {len(metadatas)} metadatas")
@@ -999,20 +1123,11 @@ class Ingest:
         ), f'must have equal number of text strings and metadata dicts. len(texts) is {len(texts)}. len(metadatas) is {len(metadatas)}'
 
         try:
-            logging.info("Before Text Splitter")
-            text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-                chunk_size=1000,
-                chunk_overlap=150,
-                separators=[
-                    "\n\n", "\n", ". ", " ", ""
-                ]  # try to split on paragraphs... fallback to sentences, then chars, ensure we always fit in context window
-            )
-            contexts: List[Document] = text_splitter.create_documents(texts=texts, metadatas=metadatas)
-            input_texts = [{'input': context.page_content, 'model': 'text-embedding-ada-002'} for context in contexts]
-
-            # check for duplicates
+            # check for duplicates, by a fingerprint of the extracted text: an unchanged re-upload stops here,
+            # before any splitting or embedding
             logging.info(f"Before checking for duplicates")
-            is_duplicate = self.check_for_duplicates(input_texts, metadatas)
+            content_hash = self._content_hash(texts)
+            is_duplicate = self.check_for_duplicates(content_hash, metadatas)
             if is_duplicate:
                 if self.posthog:
                     self.posthog.capture('distinct_id_of_the_user',
@@ -1027,50 +1142,69 @@ class Ingest:
                                         })
                 return "Success"
 
+            logging.info("Before Text Splitter")
+            text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=1000,
+                chunk_overlap=150,
+                length_function=token_length_function("gpt2"),  # shared encoder, same sizes as from_tiktoken_encoder()
+                separators=[
+                    "\n\n", "\n", ". ", " ", ""
+                ]  # try to split on paragraphs... fallback to sentences, then chars, ensure we always fit in context window
+            )
+            contexts: List[Document] = text_splitter.create_documents(texts=texts, metadatas=metadatas)
+
             # adding chunk index to metadata for parent doc retrieval
+            # and token counts, so retrieval doesn't have to re-tokenize every chunk on every query
+            chunk_num_tokens = count_tokens_batch([context.page_content for context in contexts])
             for i, context in enumerate(contexts):
                 context.metadata['chunk_index'] = i
                 context.metadata['doc_groups'] = kwargs.get('groups', [])
+                context.metadata['num_tokens'] = chunk_num_tokens[i]
 
+            ### Streaming embed -> upsert to Qdrant, one batch of chunks at a time ###
+            # Only `max_upserts_in_flight` batches of points are alive at once, so memory scales with the batch size,
+            # not the document. Vectors live in Qdrant only, unless DOCUMENTS_EMBEDDING_STORAGE=binary also keeps a
+            # float32 copy in the SQL row (~5x smaller than the same floats as JSON).
             logging.info("Before call to embeddings API")
             embeddings_start_time = time.monotonic()
-            oai = OpenAIAPIProcessor(
-                input_prompts_list=input_texts,
-                request_url='https://api.openai.com/v1/embeddings',
-                api_key=os.getenv('OPENAI_API_KEY'),
-                max_requests_per_minute=10_000,
-                max_tokens_per_minute=10_000_000,
-                max_attempts=1_000,
-                logging_level=logging.INFO,
-                token_encoding_name='cl100k_base')
-            asyncio.run(oai.process_api_requests_from_file())
-            print(f"⏰ embeddings runtime: {(time.monotonic() - embeddings_start_time):.2f} seconds")
-            # parse results into dict of shape page_content -> embedding
-            embeddings_dict: dict[str, List[float]] = {
-                item[0]['input']: item[1]['data'][0]['embedding'] for item in oai.results
-            }
-            logging.info("post embeddings API call")
-            
-            ### BULK upload to Qdrant ###
-            vectors: list[PointStruct] = []
-            for context in contexts:
-                # !DONE: Updated the payload so each key is top level (no more payload.metadata.course_name. Instead, use payload.course_name), great for creating indexes.
-                upload_metadata = {**context.metadata, "page_content": context.page_content}
-                vectors.append(
-                    PointStruct(id=str(uuid.uuid4()), vector=embeddings_dict[context.page_content], payload=upload_metadata))
-
+            batch_size = int(os.getenv('INGEST_EMBEDDING_BATCH_SIZE', 1024))
+            max_upserts_in_flight = int(os.getenv('QDRANT_UPSERT_MAX_IN_FLIGHT', 2))
+            store_embeddings_in_sql = os.getenv('DOCUMENTS_EMBEDDING_STORAGE', 'qdrant') == 'binary'
+            chunk_embeddings = array('f')
+            upserted_point_ids: List[str] = []
             try:
-                logging.info(f"Before Upsert to Qdrant")
-                self.qdrant_client.upsert(
-                    collection_name=os.environ['QDRANT_COLLECTION_NAME'],  # type: ignore
-                    points=vectors,  # type: ignore
-                )
-            except Exception as e:
-                # it's fine if this gets timeout error. it will still post, according to devs: https://github.com/qdrant/qdrant/issues/3654
-                print(
-                    "Warning: all update and/or upsert timeouts are fine (completed in background), but errors might not be: ",
-                    e)
-                pass
+                with ThreadPoolExecutor(max_workers=max_upserts_in_flight, thread_name_prefix='qdrant_upsert') as upsert_executor:
+                    upserts_in_flight: List[Future] = []
+                    for batch_start in range(0, len(contexts), batch_size):
+                        batch = contexts[batch_start:batch_start + batch_size]
+                        batch_embeddings = self._embed_chunks([context.page_content for context in batch])
+
+                        # !DONE: Updated the payload so each key is top level (no more payload.metadata.course_name. Instead, use payload.course_name), great for creating indexes.
+                        points = [
+                            PointStruct(id=str(uuid.uuid4()),
+                                        vector=embedding,
+                                        payload={**context.metadata, "page_content": context.page_content})
+                            for context, embedding in zip(batch, batch_embeddings)
+                        ]
+                        if len(upserts_in_flight) >= max_upserts_in_flight:
+                            self._wait_for_upsert(upserts_in_flight.pop(0))
+                        upserts_in_flight.append(
+                            upsert_executor.submit(self.qdrant_client.upsert,
+                                                   collection_name=os.environ['QDRANT_COLLECTION_NAME'],
+                                                   points=points))
+                        upserted_point_ids.extend(str(point.id) for point in points)
+                        if store_embeddings_in_sql:
+                            for embedding in batch_embeddings:
+                                chunk_embeddings.extend(embedding)
+                    for future in upserts_in_flight:
+                        self._wait_for_upsert(future)
+            except Exception:
+                # Don't leave a partial document in Qdrant, the retry would upload it again next to the leftovers
+                if upserted_point_ids:
+                    self.qdrant_client.delete(collection_name=os.environ['QDRANT_COLLECTION_NAME'],
+                                              points_selector=models.PointIdsList(points=upserted_point_ids))  # type: ignore
+                raise
+            print(f"⏰ embeddings + upsert runtime: {(time.monotonic() - embeddings_start_time):.2f} seconds")
 
             ### Supabase SQL ###
             contexts_for_supa = [{
@@ -1078,7 +1212,8 @@ class Ingest:
                 "pagenumber": context.metadata.get('pagenumber'),
                 "timestamp": context.metadata.get('timestamp'),
                 "chunk_index": context.metadata.get('chunk_index'),
-                "embedding": embeddings_dict[context.page_content]
+                "num_tokens": context.metadata.get('num_tokens'),
+                "chunk_hash": hashlib.sha256(context.page_content.encode('utf-8')).hexdigest(),
             } for context in contexts]
 
             document = {
@@ -1087,14 +1222,17 @@ class Ingest:
                 "readable_filename": contexts[0].metadata.get('readable_filename'),
                 "url": contexts[0].metadata.get('url'),
                 "base_url": contexts[0].metadata.get('base_url'),
-                "contexts": contexts_for_supa,
+                "content_hash": content_hash,
+                "contexts": [],  # chunks are rows of document_chunks now
             }
+            if store_embeddings_in_sql:
+                document["embeddings"] = chunk_embeddings.tobytes()
 
-            # Calculate the size of the document object in MB
-            document_size_mb = len(json.dumps(document).encode('utf-8')) / (1024 * 1024)
-            print(f"Document size: {document_size_mb:.2f} MB")
-
-            insert_status = self.sql_session.insert_document(document)
+            if pending_documents is not None and not kwargs.get('groups'):
+                pending_documents.append((document, contexts_for_supa))
+                insert_status = True
+            else:
+                insert_status = self.sql_session.insert_document(document, chunks=contexts_for_supa)
 
             # need to update Supabase tables with doc group info
             if insert_status:
@@ -1106,7 +1244,7 @@ class Ingest:
                         count = self.sql_session.add_document_to_group_url(contexts, groups)
                     else:
                         count = self.sql_session.add_document_to_group(contexts, groups)
-                    
+                        
                     if count == 0:
                         print("Error in adding to doc groups")
                         raise ValueError("Error in adding to doc groups")
@@ -1130,10 +1268,80 @@ class Ingest:
             sentry_sdk.flush(timeout=20)
             raise Exception(err)
     
-    def check_for_duplicates(self, texts: List[Dict], metadatas: List[Dict[str, Any]]) -> bool:
+    def _flush_pending_documents(self, pending_documents: List[Tuple[dict, List[dict]]]):
+        """Write the documents split_and_upload() deferred, and empty the list."""
+        if not pending_documents:
+            return
+        try:
+            if not self.sql_session.insert_documents_bulk(pending_documents):
+                raise ValueError(f"Bulk insert of {len(pending_documents)} documents failed")
+        finally:
+            pending_documents.clear()  # never write a batch twice, part of it may have been committed
+
+    def _embed_chunks(self, texts: List[str]) -> List[List[float]]:
+        """Embed one batch of chunks, in order."""
+        oai = OpenAIAPIProcessor(
+            input_prompts_list=[{'input': text, 'model': 'text-embedding-ada-002'} for text in texts],
+            request_url='https://api.openai.com/v1/embeddings',
+            api_key=os.getenv('OPENAI_API_KEY'),
+            max_requests_per_minute=10_000,
+            max_tokens_per_minute=10_000_000,
+            max_attempts=10,  # transient errors only, with backoff. Bad input or a bad key fails at once
+            logging_level=logging.INFO,
+            token_encoding_name='cl100k_base',
+            max_inputs_per_request=int(os.getenv('OPENAI_EMBEDDING_MAX_INPUTS_PER_REQUEST', 256)),
+            max_tokens_per_request=int(os.getenv('OPENAI_EMBEDDING_MAX_TOKENS_PER_REQUEST', 100_000)))
+        oai.run()
+        # parse results into dict of shape page_content -> embedding
+        embeddings_dict: dict[str, List[float]] = {}
+        for item in oai.results:
+            if item is None:
+                continue
+            request_json, response = item[0], item[1]
+            # a request that failed after all attempts carries its list of errors instead of a response
+            if not isinstance(response, dict) or 'data' not in response:
+                raise ValueError(f"Embeddings request failed, errors from the OpenAI API: {response}")
+            embeddings_dict[request_json['input']] = response['data'][0]['embedding']
+        return [embeddings_dict[text] for text in texts]
+
+    @staticmethod
+    def _wait_for_upsert(future: Future):
+        try:
+            future.result()
+        except Exception as e:
+            # it's fine if this gets timeout error. it will still post, according to devs: https://github.com/qdrant/qdrant/issues/3654
+            # Anything else failed for real: re-raise, so split_and_upload cleans up instead of writing a row with no vectors
+            source = e.source if isinstance(e, ResponseHandlingException) else e
+            if not isinstance(source, (TimeoutError, httpx.TimeoutException)):
+                raise
+            print("Warning: all update and/or upsert timeouts are fine (completed in background): ", e)
+
+    # uuid V4 pattern, and v4 only. Uploads are stored as `<uuid>-<original filename>`.
+    _UPLOAD_UUID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}', re.I)
+
+    @classmethod
+    def _original_filename(cls, s3_path: str) -> str:
+        """Filename of an S3 path without its upload uuid, if it has one -- not all s3_paths have uuids!"""
+        filename = s3_path.split('/')[-1]
+        return filename[37:] if cls._UPLOAD_UUID_PATTERN.search(filename) else filename
+
+    @staticmethod
+    def _content_hash(texts: List[str]) -> str:
+        """
+        SHA-256 of a document's extracted text, normalized (NFC, whitespace runs collapsed) so that re-extracting
+        an unchanged file gives the same hash.
+        """
+        digest = hashlib.sha256()
+        for text in texts:
+            digest.update(' '.join(unicodedata.normalize('NFC', text).split()).encode('utf-8'))
+            digest.update(b'\n')
+        return digest.hexdigest()
+
+    def check_for_duplicates(self, content_hash: str, metadatas: List[Dict[str, Any]]) -> bool:
         """
-        For given metadata, fetch docs from Supabase based on S3 path or URL.
-        If docs exists, concatenate the texts and compare with current texts, if same, return True.
+        True if this course already has the same S3 file (ignoring the upload uuid) or URL with the same content hash,
+        which is a single indexed lookup. Otherwise, if an older version with the same name exists (the file was
+        updated), it's deleted so the new version replaces it.
         """
         course_name = metadatas[0]['course_name']
         incoming_s3_path = metadatas[0]['s3_path']
@@ -1142,93 +1350,46 @@ class Ingest:
         logging.info(f"In check_for_duplicates")
 
         if incoming_s3_path:
-            # check if uuid exists in s3_path -- not all s3_paths have uuids!
-            incoming_filename = incoming_s3_path.split('/')[-1]
-            logging.debug(f"Full filename: {incoming_filename}")
-            pattern = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}',
-                                re.I)  # uuid V4 pattern, and v4 only.
-            if bool(pattern.search(incoming_filename)):
-                # uuid pattern exists -- remove the uuid and proceed with duplicate checking
-                original_filename = incoming_filename[37:]
-            else:
-                # do not remove anything and proceed with duplicate checking
-                original_filename = incoming_filename
+            original_filename = self._original_filename(incoming_s3_path)
             logging.info(f"Filename after removing uuid: {original_filename}")
-
-            supabase_contents = self.sql_session.get_like_docs_by_s3_path(course_name, original_filename)
-            supabase_contents = supabase_contents['data']
-            logging.info(f"No. of S3 path based records retrieved: {len(supabase_contents)}")  # multiple records can be retrieved: 3.pdf and 453.pdf
-
         elif url:
             original_filename = url
-            supabase_contents = self.sql_session.get_like_docs_by_url(course_name, url)
-            supabase_contents = supabase_contents['data']
-            logging.info(f"No. of URL-based records retrieved: {len(supabase_contents)}")
         else:
-            original_filename = None
-            supabase_contents = []
-
-        supabase_whole_text = ""
-        exact_doc_exists = False
-        if len(supabase_contents) > 0:  # a doc with same filename exists in Supabase
-            logging.info(f"Checking for Supabase contents: {supabase_contents}")
-            for record in supabase_contents:
-                logging.info(f"Record: {record}")
-                if incoming_s3_path:
-                    curr_filename = record['s3_path'].split('/')[-1]
-                    older_s3_path = record['s3_path']
-                    if bool(pattern.search(curr_filename)):
-                        # uuid pattern exists -- remove the uuid and proceed with duplicate checking
-                        sql_filename = curr_filename[37:]
-                    else:
-                        # do not remove anything and proceed with duplicate checking
-                        sql_filename = curr_filename
-                elif url:
-                    print("URL retrieved from SQL: ", record.keys())
-                    sql_filename = record['url']
-                else:
-                    continue
-                print("Original filename: ", original_filename, "Current SQL filename: ", sql_filename)
-
-                if original_filename == sql_filename:  # compare og s3_path/url with incoming s3_path/url
-                    supabase_contexts = record
-
-                    exact_doc_exists = True
-                    print("Exact doc exists in Supabase:", sql_filename)
-                    break
-
-            if exact_doc_exists:
-                # concatenate og texts
-                for text in supabase_contexts['contexts']:
-                    supabase_whole_text += text['text']
-
-                current_whole_text = ""
-                for text in texts:
-                    current_whole_text += text['input']
-
-                if supabase_whole_text == current_whole_text:  # matches the previous file
-                    print(f"Duplicate ingested! 📄 s3_path/url: {original_filename}.")
-                    return True
+            print("NOT a duplicate! No s3_path or url to compare.")
+            return False
 
-                else:  # the file is updated
-                    print(f"Updated file detected! Same filename, new contents. 📄s3_path/url: {original_filename}")
+        def is_same_file(record) -> bool:
+            if incoming_s3_path:
+                return bool(record['s3_path']) and self._original_filename(record['s3_path']) == original_filename
+            return record['url'] == url
 
-                    # call the delete function on older doc
-                    print("older s3_path/url to be deleted: ", sql_filename)
-                    if incoming_s3_path:
-                        delete_status = self.delete_data(course_name, older_s3_path, '')
-                    else:
-                        delete_status = self.delete_data(course_name, '', url)
-                print("delete_status: ", delete_status)
-                return False
-            else:
-                print(f"NOT a duplicate! 📄s3_path: {original_filename}")
-                return False
+        same_contents = self.sql_session.get_docs_by_content_hash(course_name, content_hash)['data']
+        if any(is_same_file(record) for record in same_contents):
+            print(f"Duplicate ingested! 📄 s3_path/url: {original_filename}.")
+            return True
 
-        else:  # filename does not already exist in Supabase, so its a brand new file
+        # Not a duplicate. Documents ingested before content hashes were stored land here too, and are replaced once.
+        if incoming_s3_path:
+            same_name = self.sql_session.get_like_docs_by_s3_path(course_name, original_filename)['data']
+        else:
+            same_name = self.sql_session.get_docs_by_url(course_name, url)['data']
+        logging.info(f"No. of records with the same S3 path/URL: {len(same_name)}")  # LIKE also matches 3.pdf for 453.pdf
+        older_record = next((record for record in same_name if is_same_file(record)), None)
+        if older_record is None:  # brand new file
             print(f"NOT a duplicate! 📄s3_path: {original_filename}")
             return False
-    
+
+        print(f"Updated file detected! Same filename, new contents. 📄s3_path/url: {original_filename}")
+        # call the delete function on older doc
+        if incoming_s3_path:
+            print("older s3_path/url to be deleted: ", older_record['s3_path'])
+            delete_status = self.delete_data(course_name, older_record['s3_path'], '')
+        else:
+            print("older s3_path/url to be deleted: ", url)
+            delete_status = self.delete_data(course_name, '', url)
+        print("delete_status: ", delete_status)
+        return False
+
     def delete_data(self, course_name: str, s3_path: str, source_url: str):
         """Delete file from S3, Qdrant, and Supabase."""
         print(f"Deleting {s3_path} from S3, Qdrant, and Supabase for course {course_name}")
@@ -1,10 +1,15 @@
+import functools
+import io
 import os
 import logging
+import threading
 from urllib.parse import quote_plus
 
 from ai_ta_backend.model import models
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import insert
 from sqlalchemy import delete
@@ -12,7 +17,7 @@ from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import text
 from sqlalchemy import select, desc
 
-from typing import List, TypeVar, Generic
+from typing import List, Optional, Tuple, TypeVar, Generic
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 from sqlalchemy import select, desc
 from sqlalchemy.orm import Session
@@ -35,47 +40,108 @@ class DatabaseResponse(Generic[T]):
         }
 
 
+# One engine (and connection pool) per process, shared by every SQLAlchemyIngestDB, so an rq worker reuses its
+# connections across jobs instead of connecting per ingest. Sessions are thread-local and closed after each call.
+_engine: Optional[Engine] = None
+_session_registry: Optional[scoped_session] = None
+_engine_lock = threading.Lock()
+
+
+def _database_uri() -> str:
+    # Define supported database configurations and their required env vars
+    DB_CONFIGS = {
+        'supabase': ['SUPABASE_USER', 'SUPABASE_PASSWORD', 'SUPABASE_URL'],
+        'sqlite': ['SQLITE_DB_NAME'],
+        'postgres': ['POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_HOST']
+    }
+
+    # Detect which database configuration is available
+    db_type = None
+    for db, required_vars in DB_CONFIGS.items():
+        if all(os.getenv(var) for var in required_vars):
+            db_type = db
+            break
+
+    if not db_type:
+        raise ValueError("No valid database configuration found in environment variables")
+
+    # Build the appropriate connection string
+    if db_type == 'supabase':
+        encoded_password = quote_plus(os.getenv('SUPABASE_PASSWORD'))
+        return f"postgresql://{os.getenv('SUPABASE_USER')}:{encoded_password}@{os.getenv('SUPABASE_URL')}"
+    elif db_type == 'sqlite':
+        return f"sqlite:///{os.getenv('SQLITE_DB_NAME')}"
+    else:
+        # postgres
+        return f"postgresql://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@{os.getenv('POSTGRES_HOST')}:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}"
+
+
+def _get_session_registry() -> scoped_session:
+    """The process-wide engine and thread-local session registry, created on first use."""
+    global _engine, _session_registry
+    with _engine_lock:
+        if _session_registry is None:
+            db_uri = _database_uri()
+            pool_options = {}
+            if not db_uri.startswith('sqlite'):
+                pool_options = {
+                    'pool_size': int(os.getenv('INGEST_SQL_POOL_SIZE', 5)),
+                    'max_overflow': int(os.getenv('INGEST_SQL_MAX_OVERFLOW', 10)),
+                }
+            # pre-ping replaces connections the server closed while the worker sat idle between jobs
+            _engine = create_engine(db_uri,
+                                    pool_pre_ping=True,
+                                    pool_recycle=int(os.getenv('INGEST_SQL_POOL_RECYCLE_SEC', 1800)),
+                                    **pool_options)
+            print("About to connect to DB from IngestSQL.py, with URI:", _engine.url)  # password masked
+            _session_registry = scoped_session(sessionmaker(bind=_engine))
+        return _session_registry
+
+
+def _reset_after_fork():
+    # A forked child (e.g. an rq work horse) must not share the parent's sockets: drop the inherited pool without
+    # closing its connections (the parent still uses them), and the inherited thread-local sessions.
+    global _session_registry
+    if _engine is not None:
+        _engine.dispose(close=False)
+        _session_registry = scoped_session(sessionmaker(bind=_engine))
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _copy_text_value(value) -> str:
+    r"""One field of COPY's text format: \N for NULL, and backslash, tab, newline and carriage return escaped."""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _unit_of_work(method):
+    """Close this thread's session when the call returns, so its connection goes back to the pool."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.session.remove()
+
+    return wrapper
+
+
 class SQLAlchemyIngestDB:
     def __init__(self) -> None:
-        # Define supported database configurations and their required env vars
-        DB_CONFIGS = {
-            'supabase': ['SUPABASE_USER', 'SUPABASE_PASSWORD', 'SUPABASE_URL'],
-            'sqlite': ['SQLITE_DB_NAME'],
-            'postgres': ['POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_HOST']
-        }
-
-        # Detect which database configuration is available
-        db_type = None
-        for db, required_vars in DB_CONFIGS.items():
-            if all(os.getenv(var) for var in required_vars):
-                db_type = db
-                break
-
-        if not db_type:
-            raise ValueError("No valid database configuration found in environment variables")
-
-        # Build the appropriate connection string
-        if db_type == 'supabase':
-            encoded_password = quote_plus(os.getenv('SUPABASE_PASSWORD'))
-            db_uri = f"postgresql://{os.getenv('SUPABASE_USER')}:{encoded_password}@{os.getenv('SUPABASE_URL')}"
-        elif db_type == 'sqlite':
-            db_uri = f"sqlite:///{os.getenv('SQLITE_DB_NAME')}"
-        else:
-            # postgres
-            db_uri = f"postgresql://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@{os.getenv('POSTGRES_HOST')}:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}"
-
-        # Create engine and session
-        print("About to connect to DB from IngestSQL.py, with URI:", db_uri)
-        engine = create_engine(db_uri)
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
-        print("Successfully connected to DB from IngestSQL.py")
+        # Cheap: connections come from the process-wide pool, the first one when a query needs it
+        self.session = _get_session_registry()
 
+    @_unit_of_work
     def insert_document_in_progress(self, doc_progress_payload: dict):
         insert_stmt = insert(models.DocumentsInProgress).values(doc_progress_payload)
         self.session.execute(insert_stmt)
         self.session.commit()
 
+    @_unit_of_work
     def insert_failed_document(self, failed_doc_payload: dict):
         try:
             insert_stmt = insert(models.DocumentsFailed).values(failed_doc_payload)
@@ -88,6 +154,7 @@ class SQLAlchemyIngestDB:
             return False
         
 
+    @_unit_of_work
     def delete_document_in_progress(self, beam_task_id: str):
         try:
             delete_stmt = delete(models.DocumentsInProgress).where(models.DocumentsInProgress.beam_task_id == beam_task_id)
@@ -99,10 +166,14 @@ class SQLAlchemyIngestDB:
             print(f"Deletion failed: {e}")
             return False
 
-    def insert_document(self, doc_payload: dict) -> bool:
+    @_unit_of_work
+    def insert_document(self, doc_payload: dict, chunks: Optional[List[dict]] = None) -> bool:
+        """Insert a document and its chunks (entries shaped like `contexts`) in one transaction."""
         try:
             insert_stmt = insert(models.Document).values(doc_payload)
-            self.session.execute(insert_stmt)
+            result = self.session.execute(insert_stmt)
+            if chunks:
+                self._insert_document_chunks(result.inserted_primary_key[0], chunks)
             self.session.commit()
             return True  # Insertion successful
         except SQLAlchemyError as e:
@@ -110,6 +181,56 @@ class SQLAlchemyIngestDB:
             print(f"Insertion failed: {e}")
             return False  # Insertion failed
         
+    def _insert_document_chunks(self, document_id: int, chunks: List[dict]):
+        # one executemany for all rows
+        self.session.execute(insert(models.DocumentChunk),
+                             [models.DocumentChunk.row_from_context(document_id, chunk) for chunk in chunks])
+
+    @_unit_of_work
+    def insert_documents_bulk(self, documents: List[Tuple[dict, List[dict]]]) -> bool:
+        """
+        Insert many (doc_payload, chunks) pairs, INGEST_SQL_BULK_BATCH_SIZE documents per transaction.
+        Document rows go in as multi-row INSERT ... VALUES ... RETURNING id pages (SQLAlchemy's "insertmanyvalues",
+        its replacement for psycopg2's execute_values), chunk rows through COPY FROM STDIN on Postgres and one
+        executemany elsewhere.
+        """
+        batch_size = int(os.getenv('INGEST_SQL_BULK_BATCH_SIZE', 100))
+        for batch_start in range(0, len(documents), batch_size):
+            batch = documents[batch_start:batch_start + batch_size]
+            try:
+                insert_stmt = insert(models.Document).returning(models.Document.id, sort_by_parameter_order=True)
+                document_ids = self.session.execute(insert_stmt, [doc_payload for doc_payload, _ in batch]).scalars().all()
+                chunk_rows = [
+                    models.DocumentChunk.row_from_context(document_id, chunk)
+                    for document_id, (_, chunks) in zip(document_ids, batch)
+                    for chunk in chunks
+                ]
+                if chunk_rows:
+                    if self.session.get_bind().dialect.name == 'postgresql':
+                        self._copy_document_chunks(chunk_rows)
+                    else:
+                        self.session.execute(insert(models.DocumentChunk), chunk_rows)
+                self.session.commit()
+            except Exception as e:  # COPY raises the driver's own errors, not SQLAlchemyError
+                self.session.rollback()
+                print(f"Bulk insertion failed after {batch_start} of {len(documents)} documents: {e}")
+                return False
+        return True
+
+    def _copy_document_chunks(self, chunk_rows: List[dict]):
+        # COPY through the session's own DBAPI connection, so it's part of the same transaction as the documents
+        columns = list(chunk_rows[0].keys())
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        buffer = io.StringIO()
+        for row in chunk_rows:
+            buffer.write('\t'.join(_copy_text_value(row[column]) for column in columns))
+            buffer.write('\n')
+        buffer.seek(0)
+        dbapi_connection = self.session.connection().connection.dbapi_connection
+        with dbapi_connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {models.DocumentChunk.__tablename__} ({column_list}) FROM STDIN", buffer)
+
+    @_unit_of_work
     def add_document_to_group_url(self, contexts, groups):
         params = {
             "p_course_name": contexts[0].metadata.get('course_name'),
@@ -129,6 +250,7 @@ class SQLAlchemyIngestDB:
             self.session.rollback()
             return None, 0
     
+    @_unit_of_work
     def add_document_to_group(self, contexts, groups):
         params = {
             "p_course_name": contexts[0].metadata.get('course_name'),
@@ -149,10 +271,23 @@ class SQLAlchemyIngestDB:
             self.session.rollback()
             return None, 0
         
+    @_unit_of_work
+    def get_docs_by_content_hash(self, course_name, content_hash):
+        query = (
+            select(models.Document.id, models.Document.s3_path, models.Document.url)
+            .where(models.Document.course_name == course_name)
+            .where(models.Document.content_hash == content_hash)
+            .order_by(desc(models.Document.id))
+        )
+        result = self.session.execute(query).mappings().all()
+        response = DatabaseResponse(data=result, count=len(result)).to_dict()
+        return response
+
+    @_unit_of_work
     def get_like_docs_by_s3_path(self, course_name, original_filename):
         logging.info(f"In get_like_docs_by_s3_path")
         query = (
-            select(models.Document.id, models.Document.contexts, models.Document.s3_path)
+            select(models.Document.id, models.Document.s3_path)
             .where(models.Document.course_name == course_name)
             .where(models.Document.s3_path.like(f"%{original_filename}%"))
             .order_by(desc(models.Document.id))
@@ -162,18 +297,25 @@ class SQLAlchemyIngestDB:
         response = DatabaseResponse(data=result, count=len(result)).to_dict()
         return response
     
-    def get_like_docs_by_url(self, course_name, url):
+    @_unit_of_work
+    def get_docs_by_url(self, course_name, url):
         query = (
-            select(models.Document.id, models.Document.contexts, models.Document.url)
+            select(models.Document.id, models.Document.url)
             .where(models.Document.course_name == course_name)
-            .where(models.Document.url.like(f"%{url}%"))
+            .where(models.Document.url == url)
             .order_by(desc(models.Document.id))
         )
         result = self.session.execute(query).mappings().all()
         response = DatabaseResponse(data=result, count=len(result)).to_dict()
         return response
     
+    @_unit_of_work
     def delete_document_by_s3_path(self, course_name: str, s3_path: str):        
+        self._delete_document_chunks(
+            select(models.Document.id)
+            .where(models.Document.s3_path == s3_path)
+            .where(models.Document.course_name == course_name)
+        )
         delete_stmt = (
             delete(models.Document)
             .where(models.Document.s3_path == s3_path)
@@ -184,7 +326,13 @@ class SQLAlchemyIngestDB:
         self.session.commit()
         return result.rowcount  # Number of rows deleted
     
+    @_unit_of_work
     def delete_document_by_url(self, course_name: str, url: str):
+        self._delete_document_chunks(
+            select(models.Document.id)
+            .where(models.Document.url == url)
+            .where(models.Document.course_name == course_name)
+        )
         delete_stmt = (
             delete(models.Document)
             .where(models.Document.url == url)
@@ -194,3 +342,7 @@ class SQLAlchemyIngestDB:
         result = self.session.execute(delete_stmt)
         self.session.commit()
         return result.rowcount  # Number of rows deleted
+
+    def _delete_document_chunks(self, document_ids):
+        # the foreign key cascades on Postgres, but not on SQLite (foreign keys are off by default)
+        self.session.execute(delete(models.DocumentChunk).where(models.DocumentChunk.document_id.in_(document_ids)))
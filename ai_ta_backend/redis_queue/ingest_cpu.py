@@ -0,0 +1,60 @@
+"""
+CPU-bound parsing steps of ingest, run in a process pool so that concurrent file ingests in bulk_ingest use every
+core instead of taking turns on the GIL. Everything here takes and returns picklable values (paths and strings),
+and this module stays light on imports because every pool process imports it on start.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+import fitz
+import pytesseract
+from PIL import Image
+
+_cpu_pool: Optional[ProcessPoolExecutor] = None
+_cpu_pool_lock = threading.Lock()
+
+
+def default_cpu_workers() -> int:
+    """
+    Pool size per rq worker process. worker.py starts INGEST_WORKER_COUNT of them (default: number of cores), and
+    each has its own pool, so the cores are split between them instead of every worker spawning one per core.
+    """
+    cpu_count = os.cpu_count() or 4
+    return max(1, cpu_count // int(os.getenv('INGEST_WORKER_COUNT', cpu_count)))
+
+
+def get_cpu_pool() -> ProcessPoolExecutor:
+    """
+    Process-wide pool, created on first use and sized by INGEST_CPU_WORKERS (default: default_cpu_workers()).
+    Uses spawn, not fork: the caller has ingest threads running, and forking a multi-threaded process can deadlock.
+    """
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            _cpu_pool = ProcessPoolExecutor(max_workers=int(os.getenv('INGEST_CPU_WORKERS', default_cpu_workers())),
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _cpu_pool
+
+
+def extract_pdf_text(pdf_path: str) -> List[str]:
+    """Plain text of every page, in page order."""
+    with fitz.open(pdf_path) as doc:  # type: ignore
+        return [page.get_text().encode("utf8").decode("utf8", errors='ignore') for page in doc]
+
+
+def ocr_image(image_path: str) -> str:
+    return pytesseract.image_to_string(Image.open(image_path))
+
+
+def ocr_pdf_page(pdf_path: str, page_number: int, dpi: int, timeout_sec: float) -> str:
+    """
+    Rasterize one page (grayscale, at `dpi`) and OCR it. Tesseract is killed after `timeout_sec`, which raises
+    RuntimeError. Each call opens the PDF itself, so pages can be spread over the pool independently.
+    """
+    with fitz.open(pdf_path) as doc:  # type: ignore
+        pix = doc[page_number].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)  # type: ignore
+        image = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    return pytesseract.image_to_string(image, timeout=timeout_sec)
@@ -5,10 +5,11 @@ import os
 import sys
 from multiprocessing import Process
 import signal
+import time
 import sys
 
 from redis import Redis
-from rq import Connection, Queue, Worker
+from rq import Connection, Queue, SimpleWorker, Worker
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -35,13 +36,20 @@ def start_worker():
                       password=os.environ["INGEST_REDIS_PASSWORD"],
                       socket_timeout=None)
 
+    # Jobs run in this process by default, so its SQL connection pool and embeddings HTTP session are reused across
+    # jobs. The trade-off is isolation: a crash or leak in one job (fitz, pydub, tesseract) hits this process, so it
+    # exits after INGEST_WORKER_MAX_JOBS jobs and the supervisor below starts a fresh one (also after a crash).
+    # INGEST_WORKER_FORK_PER_JOB=true uses the forking Worker instead: a fresh work horse, and fresh connections, per job.
+    fork_per_job = os.getenv("INGEST_WORKER_FORK_PER_JOB", "false").lower() == "true"
+    worker_class = Worker if fork_per_job else SimpleWorker
+    max_jobs = int(os.getenv("INGEST_WORKER_MAX_JOBS", 50)) or None  # 0: never recycle
     with Connection(redis_conn):
-        worker = Worker([Queue("default")])
-        worker.work()
+        worker = worker_class([Queue("default")])
+        worker.work(max_jobs=max_jobs)
 
 if __name__ == "__main__":
     workers = []  # Move this to global scope
-    worker_count = os.cpu_count() or 4
+    worker_count = int(os.getenv("INGEST_WORKER_COUNT", os.cpu_count() or 4))
 
     # Register signal handlers
     signal.signal(signal.SIGTERM, signal_handler)
@@ -53,10 +61,16 @@ if __name__ == "__main__":
         p.start()
         workers.append(p)
 
-    # Wait for all workers to complete
+    # Keep worker_count workers running: replace any that exited, after INGEST_WORKER_MAX_JOBS jobs or a crash
     try:
-        for worker in workers:
-            worker.join()
+        while True:
+            for i, worker in enumerate(workers):
+                if not worker.is_alive():
+                    worker.join()
+                    logging.info(f"Worker {worker.pid} exited with code {worker.exitcode}, starting a new one")
+                    workers[i] = Process(target=start_worker)
+                    workers[i].start()
+            time.sleep(1)
     except KeyboardInterrupt:
         print("Caught KeyboardInterrupt, shutting down workers...")
         for worker in workers:
@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import os
+import time
+import traceback
+from typing import Dict, List, Optional, Union
+
+import aiohttp
+from langchain.schema import Document
+from qdrant_client import AsyncQdrantClient
+from qdrant_client import models
+
+from ai_ta_backend.database.embedding_cache import EmbeddingCache
+from ai_ta_backend.database.qdrant import SEARCH_SUMMARY_PAYLOAD_FIELDS
+from ai_ta_backend.database.qdrant import VectorDatabase
+from ai_ta_backend.database.search_policy import FALLBACK_SEARCH_POLICY
+from ai_ta_backend.database.search_policy import resolve_search_policy
+from ai_ta_backend.database.search_policy import SearchPolicy
+from ai_ta_backend.service.posthog_service import PosthogService
+from ai_ta_backend.service.retrieval_service import RetrievalService
+from ai_ta_backend.service.sentry_service import SentryService
+
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+
+
+class AsyncRetrievalService:
+  """
+  Non-blocking version of the retrieval hot path (/getTopContexts and /getTopContextsBatch), served by asgi.py.
+
+  The embeddings call goes through a shared aiohttp session and the search through AsyncQdrantClient, so a request
+  waiting on the network costs a coroutine instead of a thread. Result processing, token packing and formatting
+  are delegated to the app's RetrievalService so both serving modes return identical responses.
+  Latencies are kept in locals, not on self: many requests are in flight on one instance at once.
+  """
+
+  def __init__(self, retrieval: RetrievalService, embedding_cache: EmbeddingCache, posthog: Optional[PosthogService],
+               sentry: Optional[SentryService]):
+    self.retrieval = retrieval
+    self.embedding_cache = embedding_cache
+    self.posthog = posthog
+    self.sentry = sentry
+
+    self.qdrant_client = AsyncQdrantClient(
+        url=os.getenv('QDRANT_URL', 'http://qdrant:6333'),
+        https=False,
+        api_key=os.getenv('QDRANT_API_KEY'),
+        timeout=20,
+    )
+    self.embeddings_url = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1').rstrip('/') + '/embeddings'
+    self.session: Optional[aiohttp.ClientSession] = None
+    self._default_search_policy: Optional[SearchPolicy] = None
+    self.two_phase_retrieval = retrieval.two_phase_retrieval
+    self.payload_fields = SEARCH_SUMMARY_PAYLOAD_FIELDS if self.two_phase_retrieval else None
+
+  async def startup(self):
+    """Open the pooled HTTP session. Must run inside the server's event loop (see the asgi.py lifespan)."""
+    self.session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=int(os.getenv('ASGI_EMBEDDINGS_MAX_CONNECTIONS', 200)), ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=30),
+        headers={'Authorization': f"Bearer {os.environ['OPENAI_API_KEY']}"},
+    )
+    await self.default_search_policy()
+
+  async def default_search_policy(self) -> SearchPolicy:
+    """Async VectorDatabase.default_search_policy: from the collection's config, cached once it could be read."""
+    if self._default_search_policy is None:
+      try:
+        info = await self.qdrant_client.get_collection(os.environ['QDRANT_COLLECTION_NAME'])
+        self._default_search_policy = SearchPolicy.from_collection_info(info)
+        logging.info(f"Default search policy: {self._default_search_policy}")
+      except Exception as e:
+        # Don't cache, retry on the next search
+        logging.error(f"Failed to read the Qdrant collection config, using the fallback search policy: {e}")
+        return FALLBACK_SEARCH_POLICY
+    return self._default_search_policy
+
+  async def aclose(self):
+    if self.session is not None:
+      await self.session.close()
+    await self.qdrant_client.close()
+
+  async def agetTopContexts(self,
+                            search_query: str,
+                            course_name: str,
+                            token_limit: int = 4_000,
+                            doc_groups: List[str] | None = None,
+                            search_policy: Dict | None = None) -> Union[List[Dict], str]:
+    """Async equivalent of RetrievalService.getTopContexts, same arguments and return value."""
+    if doc_groups is None:
+      doc_groups = []
+    try:
+      start_time_overall = time.monotonic()
+      policy = resolve_search_policy(await self.default_search_policy(), course_name, search_policy)
+
+      openai_start_time = time.monotonic()
+      [user_query_embedding], embedding_cache_tier = await self._aembed_queries([search_query])
+      openai_embedding_latency = time.monotonic() - openai_start_time
+
+      self.retrieval._capture_search_invoked_event(search_query, course_name, doc_groups)
+
+      qdrant_start_time = time.monotonic()
+      search_results = await self.qdrant_client.search(
+          collection_name=os.environ['QDRANT_COLLECTION_NAME'],
+          query_filter=models.Filter(must=VectorDatabase._create_search_conditions(course_name, doc_groups)),
+          with_vectors=False,
+          with_payload=models.PayloadSelectorInclude(include=self.payload_fields) if self.payload_fields else True,
+          query_vector=user_query_embedding,
+          limit=policy.limit,
+          search_params=policy.search_params())
+      if self.two_phase_retrieval:
+        self.retrieval._merge_summary_payloads(search_results, await self._aretrieve_points(self.retrieval._legacy_point_ids(search_results)))
+      qdrant_latency_sec = time.monotonic() - qdrant_start_time
+
+      found_docs: list[Document] = self.retrieval._process_search_results(search_results, course_name)
+      # tiktoken counting is CPU-bound, keep it off the event loop
+      valid_docs, token_counter = await asyncio.to_thread(self.retrieval._pack_contexts, found_docs, search_query, token_limit)
+      if self.two_phase_retrieval:
+        valid_docs = self.retrieval._hydrate_documents(valid_docs, await self._aretrieve_points(self.retrieval._unhydrated_point_ids(valid_docs)),
+                                             course_name)
+
+      logging.info(f"Total tokens used: {token_counter}. Docs used: {len(valid_docs)} of {len(found_docs)} docs retrieved")
+      logging.info(f"⏰ ^^ Runtime of async getTopContexts: {(time.monotonic() - start_time_overall):.2f} seconds")
+
+      if self.posthog:
+        max_vector_score, min_vector_score, avg_vector_score = self.retrieval._calculate_vector_scores(search_results)
+        self.posthog.capture(
+            event_name="getTopContexts_success_DI",
+            properties={
+                "user_query": search_query,
+                "course_name": course_name,
+                "token_limit": token_limit,
+                "total_tokens_used": token_counter,
+                "total_contexts_used": len(valid_docs),
+                "total_unique_docs_retrieved": len(found_docs),
+                "qdrant_latency_sec": qdrant_latency_sec,
+                "openai_embedding_latency_sec": openai_embedding_latency,
+                "max_vector_score": max_vector_score,
+                "min_vector_score": min_vector_score,
+                "avg_vector_score": avg_vector_score,
+                "embedding_cache_hit": embedding_cache_tier is not None,
+                "embedding_cache_tier": embedding_cache_tier,
+                "serving_mode": "asgi",
+                "getTopContext_total_latency_sec": time.monotonic() - start_time_overall,
+                **self.embedding_cache.stats(),
+            },
+        )
+
+      if len(valid_docs) == 0:
+        return []
+      return self.retrieval.format_for_json(valid_docs)
+    except Exception as e:
+      err: str = f"ERROR: In async /getTopContexts. Course: {course_name} ||| search_query: {search_query}\nTraceback: {traceback.format_exc()} \n{e}"  # type: ignore
+      logging.info(err)
+      if self.sentry:
+        self.sentry.capture_exception(e)
+      return err
+
+  async def agetTopContextsBatch(self, searches: List[Dict]) -> Union[List[List[Dict]], str]:
+    """Async equivalent of RetrievalService.getTopContextsBatch, same arguments and return value."""
+    try:
+      start_time_overall = time.monotonic()
+      default_search_policy = await self.default_search_policy()
+      policies = [
+          resolve_search_policy(default_search_policy, search['course_name'], search.get('search_policy')) for search in searches
+      ]
+
+      openai_start_time = time.monotonic()
+      query_embeddings, _ = await self._aembed_queries([search['search_query'] for search in searches])
+      openai_embedding_latency = time.monotonic() - openai_start_time
+
+      qdrant_start_time = time.monotonic()
+      batch_search_results = await self.qdrant_client.search_batch(
+          collection_name=os.environ['QDRANT_COLLECTION_NAME'],
+          requests=[
+              models.SearchRequest(
+                  vector=embedding,
+                  filter=models.Filter(
+                      must=VectorDatabase._create_search_conditions(search['course_name'], search.get('doc_groups') or [])),
+                  limit=policy.limit,
+                  with_payload=models.PayloadSelectorInclude(include=self.payload_fields) if self.payload_fields else True,
+                  with_vector=False,
+                  params=policy.search_params(),
+              ) for search, embedding, policy in zip(searches, query_embeddings, policies)
+          ],
+      )
+      if self.two_phase_retrieval:
+        legacy_records = await self._aretrieve_points(
+            list({point_id for search_results in batch_search_results for point_id in self.retrieval._legacy_point_ids(search_results)}))
+        for search_results in batch_search_results:
+          self.retrieval._merge_summary_payloads(search_results, legacy_records)
+      qdrant_latency_sec = time.monotonic() - qdrant_start_time
+
+      packed_docs = []
+      for search, search_results in zip(searches, batch_search_results):
+        found_docs = self.retrieval._process_search_results(search_results, search['course_name'])
+        valid_docs, _ = await asyncio.to_thread(self.retrieval._pack_contexts, found_docs, search['search_query'],
+                                                 search.get('token_limit', 3000))
+        packed_docs.append(valid_docs)
+
+      if self.two_phase_retrieval:
+        full_records = await self._aretrieve_points(
+            list({point_id for docs in packed_docs for point_id in self.retrieval._unhydrated_point_ids(docs)}))
+        packed_docs = [
+            self.retrieval._hydrate_documents(docs, full_records, search['course_name']) for search, docs in zip(searches, packed_docs)
+        ]
+      all_contexts = [self.retrieval.format_for_json(valid_docs) for valid_docs in packed_docs]
+
+      logging.info(
+          f"⏰ ^^ Runtime of async getTopContextsBatch ({len(searches)} queries): {(time.monotonic() - start_time_overall):.2f} seconds")
+      if self.posthog:
+        self.posthog.capture(
+            event_name="getTopContextsBatch_success",
+            properties={
+                "course_names": list({search['course_name'] for search in searches}),
+                "num_queries": len(searches),
+                "qdrant_latency_sec": qdrant_latency_sec,
+                "openai_embedding_latency_sec": openai_embedding_latency,
+                "serving_mode": "asgi",
+                "getTopContextsBatch_total_latency_sec": time.monotonic() - start_time_overall,
+                **self.embedding_cache.stats(),
+            },
+        )
+      return all_contexts
+    except Exception as e:
+      err: str = f"ERROR: In async /getTopContextsBatch. Num queries: {len(searches)}\nTraceback: {traceback.format_exc()} \n{e}"  # type: ignore
+      logging.info(err)
+      if self.sentry:
+        self.sentry.capture_exception(e)
+      return err
+
+  async def _aembed_queries(self, search_queries: List[str]):
+    """
+    Embed queries with one embeddings request, skipping any already in the embedding cache.
+    Returns (embeddings, cache tier of the first query).
+    """
+    # The Redis tier does blocking socket IO, keep it off the event loop.
+    if self.embedding_cache.redis is not None:
+      cached = await asyncio.gather(
+          *(asyncio.to_thread(self.embedding_cache.get, EMBEDDING_MODEL, search_query) for search_query in search_queries))
+    else:
+      cached = [self.embedding_cache.get(EMBEDDING_MODEL, search_query) for search_query in search_queries]
+
+    query_embeddings: List[Optional[List[float]]] = [embedding for embedding, _ in cached]
+    missing = [i for i, embedding in enumerate(query_embeddings) if embedding is None]
+    if missing:
+      new_embeddings = await self._aembed_documents([search_queries[i] for i in missing])
+      for i, embedding in zip(missing, new_embeddings):
+        query_embeddings[i] = embedding
+      if self.embedding_cache.redis is not None:
+        await asyncio.gather(*(asyncio.to_thread(self.embedding_cache.set, EMBEDDING_MODEL, search_queries[i], query_embeddings[i])
+                               for i in missing))
+      else:
+        for i in missing:
+          self.embedding_cache.set(EMBEDDING_MODEL, search_queries[i], query_embeddings[i])  # type: ignore
+    return query_embeddings, cached[0][1]
+
+  async def _aretrieve_points(self, point_ids: List) -> Dict:
+    """Async VectorDatabase.retrieve_points."""
+    if not point_ids:
+      return {}
+    records = await self.qdrant_client.retrieve(
+        collection_name=os.environ['QDRANT_COLLECTION_NAME'],
+        ids=point_ids,
+        with_payload=True,
+        with_vectors=False,
+    )
+    return {record.id: record for record in records}
+
+  async def _aembed_documents(self, texts: List[str]) -> List[List[float]]:
+    assert self.session is not None, "AsyncRetrievalService.startup() was never awaited"
+    async with self.session.post(self.embeddings_url, json={'model': EMBEDDING_MODEL, 'input': texts}) as response:
+      if response.status != 200:
+        raise RuntimeError(f"Embeddings request failed with status {response.status}: {await response.text()}")
+      body = await response.json()
+    return [item['embedding'] for item in sorted(body['data'], key=lambda item: item['index'])]
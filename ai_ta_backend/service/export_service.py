@@ -53,8 +53,8 @@ class ExportService:
       if response.count and response.count > 0:
         # batch download
         total_doc_count = response.count
-        first_id = int(str(response.data[0].id))
-        last_id = int(str(response.data[-1].id))
+        first_id = int(str(response.data[0]['id']))
+        last_id = int(str(response.data[-1]['id']))
 
         logging.info("total_doc_count: ", total_doc_count)
         logging.info("first_id: ", first_id)
@@ -78,7 +78,7 @@ class ExportService:
             df.to_json(file_path, orient='records', lines=True, mode='a')
 
           if len(response.data) > 0:
-            first_id = int(str(response.data[-1].id)) + 1
+            first_id = int(str(response.data[-1]['id'])) + 1
 
         # Download file
         try:
@@ -122,8 +122,8 @@ class ExportService:
     # Fetch data
     if response.count > 0:
       logging.info("id count greater than zero")
-      first_id = int(str(response.data[0].id))
-      last_id = int(str(response.data[-1].id))
+      first_id = int(str(response.data[0]['id']))
+      last_id = int(str(response.data[-1]['id']))
       total_count = response.count
 
       filename = course_name + '_' + str(uuid.uuid4()) + '_convo_history.jsonl'
@@ -145,7 +145,7 @@ class ExportService:
 
         # Update first_id
         if len(response.data) > 0:
-          first_id = int(str(response.data[-1].id)) + 1
+          first_id = int(str(response.data[-1]['id'])) + 1
           logging.info("updated first_id: ", first_id)
 
       # Download file
@@ -186,8 +186,8 @@ class ExportService:
     # Fetch data
     if response.count > 0:
       logging.info("id count greater than zero")
-      first_id = int(str(response.data[0].id))
-      last_id = int(str(response.data[-1].id))
+      first_id = int(str(response.data[0]['id']))
+      last_id = int(str(response.data[-1]['id']))
       total_count = response.count
 
       filename = course_name + '_' + str(uuid.uuid4()) + '_convo_history.jsonl'
@@ -209,7 +209,7 @@ class ExportService:
 
         # Update first_id
         if len(response.data) > 0:
-          first_id = int(str(response.data[-1].id)) + 1
+          first_id = int(str(response.data[-1]['id'])) + 1
           logging.info("updated first_id: ", first_id)
 
       # Download file
@@ -275,7 +275,7 @@ def export_data_in_bg(response, download_type, course_name, s3_path):
       df.to_json(file_path, orient='records', lines=True, mode='a')
 
     if len(response.data) > 0:
-      first_id = int(str(response.data[-1].id)) + 1
+      first_id = int(str(response.data[-1]['id'])) + 1
 
   # zip file
   zip_filename = filename.split('.')[0] + '.zip'
@@ -387,7 +387,7 @@ def export_data_in_bg_emails(response, download_type, course_name, s3_path, emai
       df.to_json(file_path, orient='records', lines=True, mode='a')
 
     if len(response.data) > 0:
-      first_id = int(str(response.data[-1].id)) + 1
+      first_id = int(str(response.data[-1]['id'])) + 1
 
   # zip file
   zip_filename = filename.split('.')[0] + '.zip'
@@ -3,8 +3,9 @@ import logging
 import os
 import time
 import traceback
-from typing import Dict, List, Optional, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
+import httpx
 from injector import inject
 from langchain.chat_models import AzureChatOpenAI
 from langchain.embeddings.openai import OpenAIEmbeddings
@@ -12,25 +13,36 @@ from langchain.schema import Document
 import openai
 
 from ai_ta_backend.database.aws import AWSStorage
+from ai_ta_backend.database.embedding_cache import EmbeddingCache
+from ai_ta_backend.database.qdrant import SEARCH_SUMMARY_PAYLOAD_FIELDS
 from ai_ta_backend.database.qdrant import VectorDatabase
 from ai_ta_backend.database.sql import SQLAlchemyDatabase
 from ai_ta_backend.service.nomic_service import NomicService
 from ai_ta_backend.service.posthog_service import PosthogService
 from ai_ta_backend.service.sentry_service import SentryService
-from ai_ta_backend.utils.utils_tokenization import count_tokens_and_cost
+from ai_ta_backend.utils.utils_tokenization import count_tokens_batch
+from ai_ta_backend.utils.utils_tokenization import select_within_token_budget
+
+
+PRE_PROMPT = "Please answer the following question. Use the context below, called your documents, only if it's helpful and don't use parts that are very irrelevant. It's good to quote from your documents directly, when you do always use Markdown footnotes for citations. Use react-markdown superscript to number the sources at the end of sentences (1, 2, 3...) and use react-markdown Footnotes to list the full document names for each number. Use ReactMarkdown aka 'react-markdown' formatting for super script citations, use semi-formal style. Feel free to say you don't know. \nHere's a few passages of the high quality documents:\n"
 
 
 class RetrievalService:
   """
     Contains all methods for business logic of the retrieval service.
+
+    Bound as a process-wide singleton and shared by every request thread, so per-request values
+    (latencies, cache tier) are passed around as locals, never stored on self.
   """
 
   @inject
-  def __init__(self, vdb: VectorDatabase, sqlDb: SQLAlchemyDatabase, aws: AWSStorage, posthog: Optional[PosthogService],
-               sentry: Optional[SentryService], nomicService: Optional[NomicService]):
+  def __init__(self, vdb: VectorDatabase, sqlDb: SQLAlchemyDatabase, aws: AWSStorage, embedding_cache: EmbeddingCache,
+               posthog: Optional[PosthogService], sentry: Optional[SentryService], nomicService: Optional[NomicService]):
+    init_start_time = time.monotonic()
     self.vdb = vdb
     self.sqlDb = sqlDb
     self.aws = aws
+    self.embedding_cache = embedding_cache
     self.sentry = sentry
     self.posthog = posthog
     self.nomicService = nomicService
@@ -40,9 +52,23 @@ class RetrievalService:
 
     openai.api_key = os.environ["OPENAI_API_KEY"]
 
+    # Two-phase retrieval: search for ids + small summary payloads, token-pack, then fetch page_content
+    # only for the chunks that fit the budget.
+    self.two_phase_retrieval = os.getenv('RETRIEVAL_TWO_PHASE', 'true').lower() == 'true'
+
+    # One pooled HTTP client for every embeddings call, so requests reuse warm keep-alive connections
+    # instead of paying a TLS handshake each time.
+    self.http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv('RETRIEVAL_HTTP_MAX_CONNECTIONS', 100)),
+            max_keepalive_connections=int(os.getenv('RETRIEVAL_HTTP_MAX_KEEPALIVE', 20)),
+        ),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
     self.embeddings = OpenAIEmbeddings(
         model='text-embedding-ada-002',
         openai_api_key=os.environ["OPENAI_API_KEY"],
+        client=openai.OpenAI(api_key=os.environ["OPENAI_API_KEY"], http_client=self.http_client).embeddings,
         # openai_api_key=os.environ["AZURE_OPENAI_KEY"],
         # openai_api_base=os.environ["AZURE_OPENAI_ENDPOINT"],
         # openai_api_type=os.environ['OPENAI_API_TYPE'],
@@ -57,12 +83,14 @@ class RetrievalService:
     #     openai_api_version=os.environ["OPENAI_API_VERSION"],
     #     openai_api_type=os.environ['OPENAI_API_TYPE'],
     # )
+    logging.info(f"⏰ RetrievalService initialized in {(time.monotonic() - init_start_time):.3f} seconds")
 
   def getTopContexts(self,
                      search_query: str,
                      course_name: str,
                      token_limit: int = 4_000,
-                     doc_groups: List[str] | None = None) -> Union[List[Dict], str]:
+                     doc_groups: List[str] | None = None,
+                     search_policy: Dict | None = None) -> Union[List[Dict], str]:
     """Here's a summary of the work.
 
         /GET arguments
@@ -78,28 +106,15 @@ class RetrievalService:
     try:
       start_time_overall = time.monotonic()
 
-      found_docs: list[Document] = self.vector_search(search_query=search_query, course_name=course_name, doc_groups=doc_groups)
-
-      pre_prompt = "Please answer the following question. Use the context below, called your documents, only if it's helpful and don't use parts that are very irrelevant. It's good to quote from your documents directly, when you do always use Markdown footnotes for citations. Use react-markdown superscript to number the sources at the end of sentences (1, 2, 3...) and use react-markdown Footnotes to list the full document names for each number. Use ReactMarkdown aka 'react-markdown' formatting for super script citations, use semi-formal style. Feel free to say you don't know. \nHere's a few passages of the high quality documents:\n"
-      # count tokens at start and end, then also count each context.
-      token_counter, _ = count_tokens_and_cost(pre_prompt + "\n\nNow please respond to my query: " +  # type: ignore
-                                               search_query)
+      found_docs: list[Document] = self.vector_search(search_query=search_query,
+                                                      course_name=course_name,
+                                                      doc_groups=doc_groups,
+                                                      search_policy=search_policy)
 
-      valid_docs = []
-      num_tokens = 0
-      for doc in found_docs:
-        doc_string = f"Document: {doc.metadata['readable_filename']}{', page: ' + str(doc.metadata['pagenumber']) if doc.metadata['pagenumber'] else ''}\n{str(doc.page_content)}\n"
-        num_tokens, prompt_cost = count_tokens_and_cost(doc_string)  # type: ignore
-
-        logging.info(
-            f"tokens used/limit: {token_counter}/{token_limit}, tokens in chunk: {num_tokens}, total prompt cost (of these contexts): {prompt_cost}. 📄 File: {doc.metadata['readable_filename']}"
-        )
-        if token_counter + num_tokens <= token_limit:
-          token_counter += num_tokens
-          valid_docs.append(doc)
-        else:
-          # filled our token size, time to return
-          break
+      valid_docs, token_counter = self._pack_contexts(found_docs, search_query, token_limit)
+      if self.two_phase_retrieval:
+        valid_docs = self._hydrate_documents(valid_docs, self.vdb.retrieve_points(self._unhydrated_point_ids(valid_docs)),
+                                             course_name)
 
       logging.info(f"Total tokens used: {token_counter}. Docs used: {len(valid_docs)} of {len(found_docs)} docs retrieved")
       logging.info(f"Course: {course_name} ||| search_query: {search_query}")
@@ -132,29 +147,128 @@ class RetrievalService:
         self.sentry.capture_exception(e)
       return err
 
-  def getAll(
-      self,
-      course_name: str,
-  ):
-    """Get all course materials based on course name.
+  def getTopContextsBatch(self, searches: List[Dict]) -> Union[List[List[Dict]], str]:
+    """Run many getTopContexts searches with one embeddings request and one Qdrant search_batch call.
+
     Args:
-        course_name (as uploaded on supabase)
+        searches: list of dicts, each with `search_query`, `course_name`, and optionally `token_limit`, `doc_groups`
+          and `search_policy` overrides.
+
     Returns:
-        list of dictionaries with distinct s3 path, readable_filename and course_name, url, base_url.
+        A list with one getTopContexts-shaped result per search, in the same order.
+        or
+        String: An error message with traceback.
     """
-    response = self.sqlDb.getAllMaterialsForCourse(course_name)
+    try:
+      start_time_overall = time.monotonic()
+      search_queries = [search['search_query'] for search in searches]
+      course_names = [search['course_name'] for search in searches]
+
+      query_embeddings, openai_embedding_latency = self._embed_queries_and_measure_latency(search_queries)
+
+      qdrant_start_time = time.monotonic()
+      batch_search_results = self.vdb.vector_search_batch(
+          [(search['course_name'], search.get('doc_groups') or [], embedding) for search, embedding in zip(searches, query_embeddings)],
+          top_n=80,
+          search_policies=[self.vdb.resolve_search_policy(search['course_name'], search.get('search_policy')) for search in searches],
+          payload_fields=SEARCH_SUMMARY_PAYLOAD_FIELDS if self.two_phase_retrieval else None)
+      if self.two_phase_retrieval:
+        legacy_records = self.vdb.retrieve_points(
+            list({point_id for search_results in batch_search_results for point_id in self._legacy_point_ids(search_results)}))
+        for search_results in batch_search_results:
+          self._merge_summary_payloads(search_results, legacy_records)
+      qdrant_latency_sec = time.monotonic() - qdrant_start_time
+
+      packed_docs = []
+      for search, search_results in zip(searches, batch_search_results):
+        found_docs = self._process_search_results(search_results, search['course_name'])
+        valid_docs, _ = self._pack_contexts(found_docs, search['search_query'], search.get('token_limit', 3000))
+        packed_docs.append(valid_docs)
+
+      if self.two_phase_retrieval:
+        # One fetch for every query's selected chunks
+        full_records = self.vdb.retrieve_points(list({point_id for docs in packed_docs for point_id in self._unhydrated_point_ids(docs)}))
+        packed_docs = [
+            self._hydrate_documents(docs, full_records, search['course_name']) for search, docs in zip(searches, packed_docs)
+        ]
+      all_contexts = [self.format_for_json(valid_docs) for valid_docs in packed_docs]
+
+      logging.info(f"⏰ ^^ Runtime of getTopContextsBatch ({len(searches)} queries): {(time.monotonic() - start_time_overall):.2f} seconds")
+      if self.posthog:
+        self.posthog.capture(
+            event_name="getTopContextsBatch_success",
+            properties={
+                "course_names": list(set(course_names)),
+                "num_queries": len(searches),
+                "qdrant_latency_sec": qdrant_latency_sec,
+                "openai_embedding_latency_sec": openai_embedding_latency,
+                "getTopContextsBatch_total_latency_sec": time.monotonic() - start_time_overall,
+                **self.embedding_cache.stats(),
+            },
+        )
+      return all_contexts
+    except Exception as e:
+      err: str = f"ERROR: In /getTopContextsBatch. Num queries: {len(searches)}\nTraceback: {traceback.format_exc()} \n{e}"  # type: ignore
+      logging.info(err)
+      if self.sentry:
+        self.sentry.capture_exception(e)
+      return err
 
-    data = response.data
-    unique_combinations = set()
-    distinct_dicts = []
+  def _pack_contexts(self, found_docs: List[Document], search_query: str, token_limit: int):
+    """Keep the highest ranked docs that fit in the token budget, alongside the prompt and query.
+    All candidate chunks are tokenized in one batch, then cut off where the cumulative sum exceeds the budget.
+    Chunks ingested with a `num_tokens` payload only need their short "Document: ..." header tokenized."""
+    strings_to_count = [PRE_PROMPT + "\n\nNow please respond to my query: " + search_query]
+    for doc in found_docs:
+      header = f"Document: {doc.metadata['readable_filename']}{', page: ' + str(doc.metadata['pagenumber']) if doc.metadata['pagenumber'] else ''}\n"
+      if isinstance(doc.metadata.get('num_tokens'), int):
+        strings_to_count.append(header + "\n")
+      else:
+        # legacy points, ingested before num_tokens was stored
+        strings_to_count.append(f"{header}{str(doc.page_content)}\n")
+
+    # count tokens at start and end, then also count each context.
+    prompt_tokens, *doc_tokens = count_tokens_batch(strings_to_count)
+    doc_tokens = [
+        count + doc.metadata['num_tokens'] if isinstance(doc.metadata.get('num_tokens'), int) else count
+        for doc, count in zip(found_docs, doc_tokens)
+    ]
 
-    for item in data:
-      combination = (item.s3_path, item.readable_filename, item.course_name, item.url, item.base_url)
-      if combination not in unique_combinations:
-        unique_combinations.add(combination)
-        distinct_dicts.append(item)
+    num_valid_docs = select_within_token_budget(doc_tokens, token_limit - prompt_tokens)
+    token_counter = prompt_tokens + sum(doc_tokens[:num_valid_docs])
+    logging.info(f"tokens used/limit: {token_counter}/{token_limit}, chunks kept: {num_valid_docs} of {len(found_docs)}")
+    return found_docs[:num_valid_docs], token_counter
 
-    return distinct_dicts
+  def getAll(self, course_name: str, after_id: Optional[int] = None, limit: Optional[int] = None) -> List[Dict]:
+    """Get all course materials based on course name.
+    Args:
+        course_name (as uploaded on supabase)
+        after_id: only materials after this id (the last `id` of the previous page)
+        limit: page size, default all
+    Returns:
+        list of dictionaries with distinct s3 path, readable_filename and course_name, url, base_url, with the id and
+        created_at of the first row of each, in id order. Deduplicated by SQL, without loading contexts.
+    """
+    return self.sqlDb.getDistinctMaterialsForCourse(course_name, after_id, limit).data
+
+  def iterAll(self, course_name: str, page_size: int = 1000) -> Iterator[Dict]:
+    """Same as getAll, fetched one keyset page at a time so memory doesn't grow with the course."""
+    after_id = None
+    while True:
+      page = self.getAll(course_name, after_id, page_size)
+      yield from page
+      if len(page) < page_size:
+        return
+      after_id = page[-1]['id']
+
+  def getAllVersion(self, course_name: str) -> str:
+    """Cheap version of a course's materials for /getAll ETags: max(id) and count, one indexed aggregate."""
+    max_id, count = self.sqlDb.getMaterialsVersion(course_name)
+    return f"{max_id}-{count}"
+
+  def getVectorIndexDiagnostics(self, course_name: str | None = None, course_limit: int = 100) -> Dict:
+    """Payload index coverage and per-course point counts for the Qdrant collection. See VectorDatabase.get_index_diagnostics."""
+    return self.vdb.get_index_diagnostics(os.environ['QDRANT_COLLECTION_NAME'], course_name, course_limit)
 
   def delete_data(self, course_name: str, s3_path: str, source_url: str):
     """Delete file from S3, Qdrant, and Supabase."""
@@ -255,7 +369,7 @@ class RetrievalService:
     #     return []
 
     #   # 5. TOP DOC CONTEXT PADDING // parent document retriever
-    #   final_docs = context_parent_doc_padding(filtered_docs, search_query, course_name)
+    #   final_docs = context_parent_doc_padding(filtered_docs, search_query, course_name, self.sqlDb)
     #   logging.info(f"Number of final docs after context padding: {len(final_docs)}")
 
     #   pre_prompt = "Please answer the following question. Use the context below, called your documents, only if it's helpful and don't use parts that are very irrelevant. It's good to quote from your documents directly, when you do always use Markdown footnotes for citations. Use react-markdown superscript to number the sources at the end of sentences (1, 2, 3...) and use react-markdown Footnotes to list the full document names for each number. Use ReactMarkdown aka 'react-markdown' formatting for super script citations, use semi-formal style. Feel free to say you don't know. \nHere's a few passages of the high quality documents:\n"
@@ -334,7 +448,9 @@ class RetrievalService:
         raise Exception(f"No materials found for {course_name} using {identifier_key}: {identifier_value}")
       data = data[0]  # single record fetched
       contexts_list = data.contexts if isinstance(data.contexts, list) else []
-      nomic_ids_to_delete = [str(data.id) + "_" + str(i) for i in range(1, len(contexts_list) + 1)]
+      # documents ingested before document_chunks keep their chunks in the contexts JSON
+      num_chunks = self.sqlDb.countDocumentChunks(data.id) or len(contexts_list)
+      nomic_ids_to_delete = [str(data.id) + "_" + str(i) for i in range(1, num_chunks + 1)]
 
       # delete from Nomic
       response = self.sqlDb.getProjectsMapForCourse(course_name)
@@ -357,32 +473,56 @@ class RetrievalService:
       if self.sentry:
         self.sentry.capture_exception(e)
 
-  def vector_search(self, search_query, course_name, doc_groups: List[str] | None = None):
+  def vector_search(self, search_query, course_name, doc_groups: List[str] | None = None, search_policy: Dict | None = None):
     """
     Search the vector database for a given query, course name, and document groups.
+    `search_policy` optionally overrides fields of the course's SearchPolicy (see database/search_policy.py).
     """
     # Return empty list if no search query is provided
     if doc_groups is None:
       doc_groups = []
+    policy = self.vdb.resolve_search_policy(course_name, search_policy)
     # Max number of search results to return
-    top_n = 80
+    top_n = policy.limit
     # Embed the user query and measure the latency
-    user_query_embedding = self._embed_query_and_measure_latency(search_query)
+    user_query_embedding, openai_embedding_latency, embedding_cache_tier = self._embed_query_and_measure_latency(search_query)
     # Capture the search invoked event to PostHog
     self._capture_search_invoked_event(search_query, course_name, doc_groups)
     # Perform the vector search
-    search_results = self._perform_vector_search(search_query, course_name, doc_groups, user_query_embedding, top_n)
+    search_results, qdrant_latency_sec = self._perform_vector_search(search_query, course_name, doc_groups, user_query_embedding,
+                                                                     top_n, policy)
+    if self.two_phase_retrieval:
+      self._merge_summary_payloads(search_results, self.vdb.retrieve_points(self._legacy_point_ids(search_results)))
     # Process the search results by extracting the page content and metadata
     found_docs = self._process_search_results(search_results, course_name)
     # Capture the search succeeded event to PostHog with the vector scores
-    self._capture_search_succeeded_event(search_query, course_name, search_results)
+    self._capture_search_succeeded_event(search_query, course_name, search_results, qdrant_latency_sec, openai_embedding_latency,
+                                         embedding_cache_tier)
     return found_docs
 
   def _embed_query_and_measure_latency(self, search_query):
+    """Returns (embedding, latency in seconds, embedding cache tier or None on a miss)."""
     openai_start_time = time.monotonic()
-    user_query_embedding = self.embeddings.embed_query(search_query)
-    self.openai_embedding_latency = time.monotonic() - openai_start_time
-    return user_query_embedding
+    user_query_embedding, embedding_cache_tier = self.embedding_cache.get(self.embeddings.model, search_query)
+    if user_query_embedding is None:
+      user_query_embedding = self.embeddings.embed_query(search_query)
+      self.embedding_cache.set(self.embeddings.model, search_query, user_query_embedding)
+    return user_query_embedding, time.monotonic() - openai_start_time, embedding_cache_tier
+
+  def _embed_queries_and_measure_latency(self, search_queries: List[str]) -> Tuple[List[List[float]], float]:
+    """Embed many queries in a single embeddings request, skipping any already in the embedding cache.
+    Returns (embeddings, latency in seconds)."""
+    openai_start_time = time.monotonic()
+    query_embeddings: List[Optional[List[float]]] = [
+        self.embedding_cache.get(self.embeddings.model, search_query)[0] for search_query in search_queries
+    ]
+    missing = [i for i, embedding in enumerate(query_embeddings) if embedding is None]
+    if missing:
+      new_embeddings = self.embeddings.embed_documents([search_queries[i] for i in missing])
+      for i, embedding in zip(missing, new_embeddings):
+        query_embeddings[i] = embedding
+        self.embedding_cache.set(self.embeddings.model, search_queries[i], embedding)
+    return query_embeddings, time.monotonic() - openai_start_time  # type: ignore
 
   def _capture_search_invoked_event(self, search_query, course_name, doc_groups):
     if self.posthog:
@@ -397,19 +537,24 @@ class RetrievalService:
     else:
       logging.info("Posthog service not available. Skipping event capture.")
 
-  def _perform_vector_search(self, search_query, course_name, doc_groups, user_query_embedding, top_n):
+  def _perform_vector_search(self, search_query, course_name, doc_groups, user_query_embedding, top_n, search_policy=None):
     qdrant_start_time = time.monotonic()
-    search_results = self.vdb.vector_search(search_query, course_name, doc_groups, user_query_embedding, top_n)
-    self.qdrant_latency_sec = time.monotonic() - qdrant_start_time
-    return search_results
+    search_results = self.vdb.vector_search(search_query,
+                                            course_name,
+                                            doc_groups,
+                                            user_query_embedding,
+                                            top_n,
+                                            search_policy,
+                                            payload_fields=SEARCH_SUMMARY_PAYLOAD_FIELDS if self.two_phase_retrieval else None)
+    return search_results, time.monotonic() - qdrant_start_time
 
   def _process_search_results(self, search_results, course_name):
     found_docs: list[Document] = []
     for d in search_results:
       try:
-        metadata = d.payload
-        page_content = metadata["page_content"]
-        del metadata["page_content"]
+        # copy, the same point can be in several searches' results (getTopContextsBatch)
+        metadata = dict(d.payload)
+        page_content = metadata.pop("page_content")
         if "pagenumber" not in metadata.keys() and "pagenumber_or_timestamp" in metadata.keys():
           metadata["pagenumber"] = metadata["pagenumber_or_timestamp"]
 
@@ -420,7 +565,40 @@ class RetrievalService:
           self.sentry.capture_exception(e)
     return found_docs
 
-  def _capture_search_succeeded_event(self, search_query, course_name, search_results):
+  @staticmethod
+  def _legacy_point_ids(search_results) -> List:
+    """Points ingested before num_tokens was stored can't be token-packed from their summary payload alone."""
+    return [point.id for point in search_results if not isinstance((point.payload or {}).get('num_tokens'), int)]
+
+  @staticmethod
+  def _merge_summary_payloads(search_results, full_records: Dict) -> None:
+    """
+    Make summary-only search results look like full ones for _process_search_results. Legacy points get their
+    full payload, the others an empty page_content and their `point_id`, to be hydrated after packing.
+    """
+    for point in search_results:
+      if point.id in full_records:
+        point.payload = full_records[point.id].payload
+      else:
+        point.payload = {**(point.payload or {}), 'page_content': '', 'point_id': point.id}
+
+  @staticmethod
+  def _unhydrated_point_ids(docs: List[Document]) -> List:
+    return [doc.metadata['point_id'] for doc in docs if 'point_id' in doc.metadata]
+
+  def _hydrate_documents(self, docs: List[Document], full_records: Dict, course_name: str) -> List[Document]:
+    """Swap summary-only docs for their full versions, keeping rank order. Points deleted meanwhile are dropped."""
+    hydrated = []
+    for doc in docs:
+      point_id = doc.metadata.get('point_id')
+      if point_id is None:
+        hydrated.append(doc)
+      elif point_id in full_records:
+        hydrated.extend(self._process_search_results([full_records[point_id]], course_name))
+    return hydrated
+
+  def _capture_search_succeeded_event(self, search_query, course_name, search_results, qdrant_latency_sec, openai_embedding_latency,
+                                      embedding_cache_tier):
     vector_score_calc_latency_sec = time.monotonic()
     max_vector_score, min_vector_score, avg_vector_score = self._calculate_vector_scores(search_results)
     if self.posthog:
@@ -429,12 +607,15 @@ class RetrievalService:
           properties={
               "user_query": search_query,
               "course_name": course_name,
-              "qdrant_latency_sec": self.qdrant_latency_sec,
-              "openai_embedding_latency_sec": self.openai_embedding_latency,
+              "qdrant_latency_sec": qdrant_latency_sec,
+              "openai_embedding_latency_sec": openai_embedding_latency,
               "max_vector_score": max_vector_score,
               "min_vector_score": min_vector_score,
               "avg_vector_score": avg_vector_score,
               "vector_score_calculation_latency_sec": time.monotonic() - vector_score_calc_latency_sec,
+              "embedding_cache_hit": embedding_cache_tier is not None,
+              "embedding_cache_tier": embedding_cache_tier,
+              **self.embedding_cache.stats(),
           },
       )
     else:
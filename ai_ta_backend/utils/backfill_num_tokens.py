@@ -0,0 +1,28 @@
+"""
+Populate the `num_tokens` payload field for points ingested before it was stored at ingest time,
+so /getTopContexts can skip re-tokenizing them.
+
+Usage:
+  python -m ai_ta_backend.utils.backfill_num_tokens [--collection_name NAME] [--batch_size 256]
+"""
+import argparse
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+from ai_ta_backend.database.qdrant import VectorDatabase
+
+if __name__ == '__main__':
+  load_dotenv()
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+  parser = argparse.ArgumentParser(description="Backfill num_tokens on existing Qdrant points.")
+  parser.add_argument('--collection_name', default=os.getenv('QDRANT_COLLECTION_NAME'))
+  parser.add_argument('--batch_size', type=int, default=256)
+  args = parser.parse_args()
+
+  start_time = time.monotonic()
+  num_updated = VectorDatabase().backfill_num_tokens(args.collection_name, batch_size=args.batch_size)
+  logging.info(f"⏰ Backfilled num_tokens on {num_updated} points in {(time.monotonic() - start_time):.2f} seconds")
@@ -1,42 +1,32 @@
-from concurrent.futures import ProcessPoolExecutor
-from functools import partial
 import logging
-from multiprocessing import Manager
-import os
 import time
+from typing import List
 
-DOCUMENTS_TABLE = os.environ['SUPABASE_DOCUMENTS_TABLE']
-# SUPABASE_CLIENT = supabase.create_client(supabase_url=os.environ['SUPABASE_URL'],
-#  supabase_key=os.environ['SUPABASE_API_KEY'])  # type: ignore
+from ai_ta_backend.database.sql import SQLAlchemyDatabase
 
 
-def context_parent_doc_padding(found_docs, search_query, course_name):
+def context_parent_doc_padding(found_docs, search_query, course_name, sql: SQLAlchemyDatabase):
   """
     Takes top N contexts acquired from QRANT similarity search and pads them
     """
   logging.info("inside main context padding")
   start_time = time.monotonic()
 
-  with Manager() as manager:
-    qdrant_contexts = manager.list()
-    supabase_contexts = manager.list()
-    partial_func1 = partial(qdrant_context_processing, course_name=course_name, result_contexts=qdrant_contexts)
-    partial_func2 = partial(supabase_context_padding, course_name=course_name, result_docs=supabase_contexts)
+  qdrant_contexts = []
+  for doc in found_docs[5:]:
+    qdrant_context_processing(doc, course_name, qdrant_contexts)
+  supabase_contexts = supabase_context_padding(found_docs[:5], course_name, sql)
 
-    with ProcessPoolExecutor() as executor:
-      executor.map(partial_func1, found_docs[5:])
-      executor.map(partial_func2, found_docs[:5])
+  supabase_contexts_no_duplicates = []
+  for context in supabase_contexts:
+    if context not in supabase_contexts_no_duplicates:
+      supabase_contexts_no_duplicates.append(context)
 
-    supabase_contexts_no_duplicates = []
-    for context in supabase_contexts:
-      if context not in supabase_contexts_no_duplicates:
-        supabase_contexts_no_duplicates.append(context)
+  result_contexts = supabase_contexts_no_duplicates + qdrant_contexts
 
-    result_contexts = supabase_contexts_no_duplicates + list(qdrant_contexts)
+  logging.info(f"⏰ Context padding runtime: {(time.monotonic() - start_time):.2f} seconds")
 
-    logging.info(f"⏰ Context padding runtime: {(time.monotonic() - start_time):.2f} seconds")
-
-    return result_contexts
+  return result_contexts
 
 
 def qdrant_context_processing(doc, course_name, result_contexts):
@@ -61,72 +51,66 @@ def qdrant_context_processing(doc, course_name, result_contexts):
   return result_contexts
 
 
-def supabase_context_padding(doc, course_name, result_docs):
+def supabase_context_padding(docs, course_name, sql: SQLAlchemyDatabase) -> List[dict]:
   """
-    Does context padding for given doc.
+    Does context padding for given docs: the chunks within chunk_index +-3 of each doc, or else its whole page.
+    Two queries in total, whatever the number of docs: their parent documents (without contexts), then only the
+    document_chunks rows inside the padding windows.
     """
-
   # query by url or s3_path
-  if 'url' in doc.metadata.keys() and doc.metadata['url']:
-    parent_doc_id = doc.metadata['url']
-    response = SUPABASE_CLIENT.table(DOCUMENTS_TABLE).select('*').eq('course_name', course_name).eq('url', parent_doc_id).execute()
-
-  else:
-    parent_doc_id = doc.metadata['s3_path']
-    response = SUPABASE_CLIENT.table(DOCUMENTS_TABLE).select('*').eq('course_name', course_name).eq('s3_path', parent_doc_id).execute()
-
-  data = response.data
-
-  if len(data) > 0:
-    # do the padding
-    filename = data[0]['readable_filename']
-    contexts = data[0]['contexts']
-    #logging.info("no of contexts within the og doc: ", len(contexts))
-
-    if 'chunk_index' in doc.metadata and 'chunk_index' in contexts[0].keys():
-      #logging.info("inside chunk index")
+  parents = sql.getDocumentsForCourseAndLocations(course_name,
+                                                  s3_paths=[doc.metadata['s3_path'] for doc in docs if not doc.metadata.get('url')],
+                                                  urls=[doc.metadata['url'] for doc in docs if doc.metadata.get('url')]).data
+  parents_by_url = {}
+  parents_by_s3_path = {}
+  for parent in parents:
+    if parent['url']:
+      parents_by_url.setdefault(parent['url'], parent)
+    if parent['s3_path']:
+      parents_by_s3_path.setdefault(parent['s3_path'], parent)
+
+  def parent_of(doc):
+    if doc.metadata.get('url'):
+      return parents_by_url.get(doc.metadata['url'])
+    return parents_by_s3_path.get(doc.metadata['s3_path'])
+
+  chunk_ranges = []
+  pages = []
+  for doc in docs:
+    parent = parent_of(doc)
+    if parent is None:
+      continue
+    if 'chunk_index' in doc.metadata:
       # pad contexts by chunk index + 3 and - 3
       target_chunk_index = doc.metadata['chunk_index']
-      for context in contexts:
-        curr_chunk_index = context['chunk_index']
-        if (target_chunk_index - 3 <= curr_chunk_index <= target_chunk_index + 3):
-          context['readable_filename'] = filename
-          context['course_name'] = course_name
-          context['s3_path'] = data[0]['s3_path']
-          context['url'] = data[0]['url']
-          context['base_url'] = data[0]['base_url']
-          result_docs.append(context)
-
+      chunk_ranges.append((parent['id'], target_chunk_index - 3, target_chunk_index + 3))
     elif doc.metadata['pagenumber'] != '':
-      #logging.info("inside page number")
       # pad contexts belonging to same page number
-      pagenumber = doc.metadata['pagenumber']
-
-      for context in contexts:
-        # pad contexts belonging to same page number
-        if int(context['pagenumber']) == pagenumber:
-          context['readable_filename'] = filename
-          context['course_name'] = course_name
-          context['s3_path'] = data[0]['s3_path']
-          context['url'] = data[0]['url']
-          context['base_url'] = data[0]['base_url']
-          result_docs.append(context)
-
+      pages.append((parent['id'], int(doc.metadata['pagenumber'])))
+  chunks_by_document = sql.getDocumentChunks(chunk_ranges=chunk_ranges, pages=pages)
+
+  result_docs = []
+  for doc in docs:
+    parent = parent_of(doc)
+    padded_chunks = chunks_by_document.get(parent['id'], []) if parent else []
+    if 'chunk_index' in doc.metadata:
+      target_chunk_index = doc.metadata['chunk_index']
+      padded_chunks = [chunk for chunk in padded_chunks if abs(chunk['chunk_index'] - target_chunk_index) <= 3]
+    elif doc.metadata['pagenumber'] != '':
+      padded_chunks = [chunk for chunk in padded_chunks if chunk['pagenumber'] == int(doc.metadata['pagenumber'])]
+    else:
+      padded_chunks = []
+
+    if padded_chunks:
+      for context in padded_chunks:
+        context = dict(context)
+        context['readable_filename'] = parent['readable_filename']
+        context['course_name'] = course_name
+        context['s3_path'] = parent['s3_path']
+        context['url'] = parent['url']
+        context['base_url'] = parent['base_url']
+        result_docs.append(context)
     else:
-      #logging.info("inside else")
       # refactor as a Supabase object and append
-      context_dict = {
-          'text': doc.page_content,
-          'embedding': '',
-          'pagenumber': doc.metadata['pagenumber'],
-          'readable_filename': doc.metadata['readable_filename'],
-          'course_name': course_name,
-          's3_path': doc.metadata['s3_path'],
-          'base_url': doc.metadata['base_url']
-      }
-      if 'url' in doc.metadata.keys():
-        context_dict['url'] = doc.metadata['url']
-      else:
-        context_dict['url'] = ''
-
-      result_docs.append(context_dict)
+      qdrant_context_processing(doc, course_name, result_docs)
+  return result_docs
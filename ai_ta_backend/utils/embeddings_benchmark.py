@@ -0,0 +1,125 @@
+"""
+Throughput / client CPU benchmark for ingest's embedding calls (redis_queue/OpenaiEmbeddings.py):
+  - session_per_request: a fresh aiohttp session per request, what APIRequest.call_api used to do,
+  - shared_session: the same requests over one pooled session, isolating the cost of connection setup,
+  - processor_run_N: OpenAIAPIProcessor.run() end to end, repeated to show the pool is reused across runs.
+
+By default it starts a local mock embeddings server in a child process, so only the client's CPU is measured:
+  python -m ai_ta_backend.utils.embeddings_benchmark --num_chunks 5000 --latency_ms 50
+
+Against plain HTTP the difference is TCP setup only. Point --url at an HTTPS endpoint (e.g. a TLS-terminating proxy
+in front of the mock, or the real API with OPENAI_API_KEY set) to include the TLS handshakes as well.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+
+from ai_ta_backend.redis_queue.OpenaiEmbeddings import OpenAIAPIProcessor
+
+
+def run_mock_server(port: int, latency_ms: float, dim: int):
+
+  async def embeddings(request: web.Request) -> web.Response:
+    body = await request.json()
+    inputs = [body['input']] if isinstance(body['input'], str) else body['input']
+    await asyncio.sleep(latency_ms / 1000)
+    data = [{'object': 'embedding', 'index': i, 'embedding': [random.random() for _ in range(dim)]} for i in range(len(inputs))]
+    return web.json_response({'object': 'list', 'data': data, 'model': body['model'], 'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+
+  app = web.Application(client_max_size=64 * 1024**2)
+  app.router.add_post('/v1/embeddings', embeddings)
+  web.run_app(app, port=port, print=None, access_log=None)
+
+
+async def send_all(url: str, api_key: str, requests: list, concurrency: int, shared_session: bool):
+  """
+  Send every request with at most `concurrency` in flight. shared_session=False is what APIRequest.call_api used to do:
+  open a new ClientSession (connector, DNS, TCP/TLS) for every request.
+  """
+  semaphore = asyncio.Semaphore(concurrency)
+  headers = {'Authorization': f'Bearer {api_key}'}
+
+  async def call(session: aiohttp.ClientSession, request_json):
+    async with session.post(url, headers=headers, json=request_json) as response:
+      return await response.json()
+
+  async def call_with_new_session(request_json):
+    async with semaphore:
+      async with aiohttp.ClientSession() as session:
+        return await call(session, request_json)
+
+  async def call_with_shared_session(session, request_json):
+    async with semaphore:
+      return await call(session, request_json)
+
+  if shared_session:
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)) as session:
+      return await asyncio.gather(*(call_with_shared_session(session, request_json) for request_json in requests))
+  return await asyncio.gather(*(call_with_new_session(request_json) for request_json in requests))
+
+
+def measure(name: str, fn, num_chunks: int) -> dict:
+  wall_start, cpu_start = time.monotonic(), time.process_time()
+  fn()
+  wall_sec, cpu_sec = time.monotonic() - wall_start, time.process_time() - cpu_start
+  row = {'mode': name, 'wall_sec': round(wall_sec, 2), 'client_cpu_sec': round(cpu_sec, 2), 'chunks_per_sec': round(num_chunks / wall_sec, 1)}
+  print("  ".join(f"{key}={value}" for key, value in row.items()))
+  return row
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Benchmark session-per-request vs. pooled embeddings requests.")
+  parser.add_argument('--url', default=None, help="Embeddings endpoint. Default: start a local mock server.")
+  parser.add_argument('--port', type=int, default=8765)
+  parser.add_argument('--latency_ms', type=float, default=50, help="Mock server latency per request.")
+  parser.add_argument('--dim', type=int, default=1536)
+  parser.add_argument('--num_chunks', type=int, default=2000)
+  parser.add_argument('--inputs_per_request', type=int, nargs='+', default=[1, 64])
+  parser.add_argument('--concurrency', type=int, default=100, help="Connection limit for both modes.")
+  parser.add_argument('--runs', type=int, default=3, help="OpenAIAPIProcessor runs per setting, to show reuse across runs.")
+  args = parser.parse_args()
+
+  server = None
+  url = args.url
+  if url is None:
+    server = multiprocessing.Process(target=run_mock_server, args=(args.port, args.latency_ms, args.dim), daemon=True)
+    server.start()
+    time.sleep(2)
+    url = f'http://127.0.0.1:{args.port}/v1/embeddings'
+  api_key = os.getenv('OPENAI_API_KEY', 'mock')
+  os.environ['OPENAI_HTTP_MAX_CONNECTIONS'] = str(args.concurrency)
+
+  chunks = [{'input': f"chunk {i} " + "lorem ipsum " * 100, 'model': 'text-embedding-ada-002'} for i in range(args.num_chunks)]
+  try:
+    for inputs_per_request in args.inputs_per_request:
+      print(f"--- {args.num_chunks} chunks, {inputs_per_request} inputs per request")
+      packed = [{
+          'input': [chunk['input'] for chunk in chunks[i:i + inputs_per_request]],
+          'model': 'text-embedding-ada-002'
+      } for i in range(0, len(chunks), inputs_per_request)]
+      measure('session_per_request',
+              lambda packed=packed: asyncio.run(send_all(url, api_key, packed, args.concurrency, False)), args.num_chunks)
+      measure('shared_session',
+              lambda packed=packed: asyncio.run(send_all(url, api_key, packed, args.concurrency, True)), args.num_chunks)
+      for run in range(args.runs):
+        oai = OpenAIAPIProcessor(input_prompts_list=[dict(chunk) for chunk in chunks],
+                                 request_url=url,
+                                 api_key=api_key,
+                                 max_requests_per_minute=1_000_000,
+                                 max_tokens_per_minute=1_000_000_000,
+                                 token_encoding_name='cl100k_base',
+                                 max_attempts=3,
+                                 logging_level=logging.WARNING,
+                                 max_inputs_per_request=inputs_per_request,
+                                 max_tokens_per_request=10_000_000)
+        measure(f'processor_run_{run + 1}', oai.run, args.num_chunks)
+  finally:
+    if server is not None:
+      server.terminate()
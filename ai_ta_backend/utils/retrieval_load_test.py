@@ -0,0 +1,92 @@
+r"""
+Closed-loop load test for /getTopContexts, to compare the gthread (run.sh) and ASGI (run-asgi.sh) serving modes.
+
+Start one mode, run this against it, then repeat with the other mode on the same hardware and the same queries:
+  ./run.sh        # or ./run-asgi.sh
+  python -m ai_ta_backend.utils.retrieval_load_test --url http://localhost:8000 --course_name my-course \\
+      --concurrency 50 100 500 1000 --requests 2000
+
+Each concurrency level keeps that many requests in flight and reports throughput, latency percentiles and errors.
+Send --queries_file (one query per line) to spread load across the embedding cache instead of hitting one key.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from typing import List
+
+import aiohttp
+
+DEFAULT_QUERIES = [
+    "What is a finite state machine?",
+    "Explain the difference between a mutex and a semaphore.",
+    "How does gradient descent work?",
+    "What are the main causes of the French Revolution?",
+    "Summarize the grading policy for this course.",
+]
+
+
+async def run_level(url: str, course_name: str, queries: List[str], concurrency: int, num_requests: int, endpoint: str):
+  latencies: List[float] = []
+  errors = 0
+  next_request = 0
+
+  async def worker(session: aiohttp.ClientSession):
+    nonlocal next_request, errors
+    while next_request < num_requests:
+      i = next_request
+      next_request += 1
+      start_time = time.monotonic()
+      try:
+        async with session.post(f"{url}{endpoint}",
+                                json={
+                                    'search_query': queries[i % len(queries)],
+                                    'course_name': course_name,
+                                    'token_limit': 3000,
+                                }) as response:
+          body = await response.read()
+          # Retrieval errors come back as a 200 with the error string as the body; only a list of contexts is a success.
+          if response.status != 200 or not isinstance(json.loads(body), list):
+            errors += 1
+            continue
+      except Exception:
+        errors += 1
+        continue
+      latencies.append(time.monotonic() - start_time)
+
+  connector = aiohttp.TCPConnector(limit=concurrency)
+  async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300)) as session:
+    start_time = time.monotonic()
+    await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    elapsed = time.monotonic() - start_time
+
+  if latencies:
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [latencies[0]] * 99
+    print(f"concurrency={concurrency:5d}  ok={len(latencies):6d}  errors={errors:5d}  "
+          f"throughput={len(latencies) / elapsed:8.1f} req/s  p50={quantiles[49] * 1000:7.0f}ms  "
+          f"p95={quantiles[94] * 1000:7.0f}ms  p99={quantiles[98] * 1000:7.0f}ms")
+  else:
+    print(f"concurrency={concurrency:5d}  ok=0  errors={errors}")
+
+
+async def main(args):
+  queries = DEFAULT_QUERIES
+  if args.queries_file:
+    with open(args.queries_file) as f:
+      queries = [line.strip() for line in f if line.strip()]
+
+  print(f"Target: {args.url}{args.endpoint} ({len(queries)} distinct queries)")
+  for concurrency in args.concurrency:
+    await run_level(args.url.rstrip('/'), args.course_name, queries, concurrency, args.requests, args.endpoint)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Load test /getTopContexts.")
+  parser.add_argument('--url', default='http://localhost:8000')
+  parser.add_argument('--endpoint', default='/getTopContexts')
+  parser.add_argument('--course_name', required=True)
+  parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 500])
+  parser.add_argument('--requests', type=int, default=1000, help="Requests per concurrency level.")
+  parser.add_argument('--queries_file', default=None)
+  asyncio.run(main(parser.parse_args()))
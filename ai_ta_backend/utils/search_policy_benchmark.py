@@ -0,0 +1,179 @@
+"""
+Recall / latency sweep over SearchPolicy knobs (quantization, rescore, oversampling, hnsw_ef), per course size.
+Use it to choose SEARCH_POLICY_OVERRIDES for big courses.
+
+By default it builds a throwaway synthetic collection (clustered vectors, courses of geometrically decreasing size)
+on a local Qdrant, e.g. `docker compose up qdrant`, and deletes it afterwards:
+  python -m ai_ta_backend.utils.search_policy_benchmark --url http://localhost:6333 --num_points 50000
+
+Or sweep the search-time knobs against a real collection, with queries sampled from its own points:
+  python -m ai_ta_backend.utils.search_policy_benchmark --collection uiuc-chat --courses course-a course-b
+
+Ground truth is an exact (brute force) search with the same course filter. `--url :memory:` runs against the
+in-process client for a smoke test only: it always searches exactly, so recall is trivially 1.
+"""
+import argparse
+import csv
+import itertools
+import os
+import statistics
+import sys
+import time
+import uuid
+from typing import Dict, List
+
+import numpy as np
+from qdrant_client import models
+from qdrant_client import QdrantClient
+
+from ai_ta_backend.database.qdrant import VectorDatabase
+from ai_ta_backend.database.qdrant_schema import CollectionSchema
+from ai_ta_backend.database.qdrant_schema import ensure_collection
+from ai_ta_backend.database.search_policy import SearchPolicy
+
+
+def build_synthetic_collection(client: QdrantClient, collection_name: str, args) -> Dict[str, int]:
+  """Upload clustered random vectors split across `num_courses` courses, halving in size each time."""
+  rng = np.random.default_rng(args.seed)
+  weights = np.array([0.5**i for i in range(args.num_courses)])
+  course_sizes = {f"course-{i}": int(n) for i, n in enumerate(np.maximum(1, weights / weights.sum() * args.num_points))}
+  centroids = rng.normal(size=(args.num_clusters, args.dim)).astype(np.float32)
+
+  point_id = 0
+  for course_name, size in course_sizes.items():
+    for start in range(0, size, 1000):
+      batch_size = min(1000, size - start)
+      vectors = centroids[rng.integers(0, args.num_clusters, batch_size)] + 0.3 * rng.normal(size=(batch_size, args.dim))
+      client.upsert(collection_name=collection_name,
+                    points=models.Batch(ids=list(range(point_id, point_id + batch_size)),
+                                        vectors=vectors.astype(np.float32).tolist(),
+                                        payloads=[{'course_name': course_name}] * batch_size),
+                    wait=True)
+      point_id += batch_size
+  return course_sizes
+
+
+def wait_until_indexed(client: QdrantClient, collection_name: str, timeout_sec: float = 600):
+  start_time = time.monotonic()
+  while client.get_collection(collection_name).status != models.CollectionStatus.GREEN:
+    if time.monotonic() - start_time > timeout_sec:
+      print(f"WARNING: {collection_name} still optimizing after {timeout_sec}s, results may be noisy", file=sys.stderr)
+      return
+    time.sleep(1)
+
+
+def sample_queries(client: QdrantClient, collection_name: str, course_name: str, num_queries: int, seed: int) -> List[List[float]]:
+  """Perturbed copies of the course's own vectors, so queries land where that course's data is."""
+  points, _ = client.scroll(collection_name=collection_name,
+                            scroll_filter=models.Filter(must=VectorDatabase._create_search_conditions(course_name, [])),
+                            limit=num_queries,
+                            with_payload=False,
+                            with_vectors=True)
+  rng = np.random.default_rng(seed)
+  return [(np.asarray(point.vector) + 0.05 * rng.normal(size=len(point.vector))).tolist() for point in points]  # type: ignore
+
+
+def run_queries(client: QdrantClient, collection_name: str, course_name: str, queries, policy: SearchPolicy):
+  query_filter = models.Filter(must=VectorDatabase._create_search_conditions(course_name, []))
+  results, latencies = [], []
+  for query in queries:
+    start_time = time.monotonic()
+    points = client.search(collection_name=collection_name,
+                           query_vector=query,
+                           query_filter=query_filter,
+                           limit=policy.limit,
+                           with_payload=False,
+                           search_params=policy.search_params())
+    latencies.append(time.monotonic() - start_time)
+    results.append([point.id for point in points])
+  return results, latencies
+
+
+def sweep(client: QdrantClient, collection_name: str, course_sizes: Dict[str, int], quantization: str, args) -> List[Dict]:
+  rows = []
+  if quantization == 'none':
+    policies = [SearchPolicy(limit=args.k, quantization='none', hnsw_ef=ef) for ef in args.hnsw_ef]
+  else:
+    policies = [
+        SearchPolicy(limit=args.k, quantization=quantization, hnsw_ef=ef, rescore=rescore, oversampling=oversampling)
+        for ef, rescore, oversampling in itertools.product(args.hnsw_ef, [True, False], args.oversampling)
+        # oversampling only matters when rescoring
+        if rescore or oversampling == args.oversampling[0]
+    ]
+
+  for course_name, course_points in course_sizes.items():
+    queries = sample_queries(client, collection_name, course_name, args.num_queries, args.seed)
+    ground_truth, _ = run_queries(client, collection_name, course_name, queries, SearchPolicy(limit=args.k, exact=True))
+    for policy in policies:
+      results, latencies = run_queries(client, collection_name, course_name, queries, policy)
+      recall = statistics.mean(
+          len(set(result) & set(truth)) / max(1, len(truth)) for result, truth in zip(results, ground_truth))
+      latencies_ms = sorted(latency * 1000 for latency in latencies)
+      row = {
+          'quantization': quantization,
+          'course_name': course_name,
+          'course_points': course_points,
+          'hnsw_ef': policy.hnsw_ef,
+          'rescore': policy.rescore,
+          'oversampling': policy.oversampling if policy.rescore else None,
+          f'recall@{args.k}': round(recall, 4),
+          'p50_ms': round(latencies_ms[len(latencies_ms) // 2], 2),
+          'p95_ms': round(latencies_ms[int(len(latencies_ms) * 0.95) - 1 if len(latencies_ms) > 1 else 0], 2),
+      }
+      rows.append(row)
+      print("  ".join(f"{key}={value}" for key, value in row.items()))
+  return rows
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Sweep vector search policies for recall and latency.")
+  parser.add_argument('--url', default=os.getenv('QDRANT_URL', 'http://localhost:6333'))
+  parser.add_argument('--api_key', default=os.getenv('QDRANT_API_KEY'))
+  parser.add_argument('--collection', default=None, help="Benchmark an existing collection instead of a synthetic one.")
+  parser.add_argument('--courses', nargs='*', default=None, help="Courses to benchmark in --collection.")
+  parser.add_argument('--num_points', type=int, default=20_000)
+  parser.add_argument('--num_courses', type=int, default=4)
+  parser.add_argument('--num_clusters', type=int, default=200)
+  parser.add_argument('--dim', type=int, default=1536)
+  parser.add_argument('--num_queries', type=int, default=100)
+  parser.add_argument('--k', type=int, default=80, help="Result limit, and the k in recall@k.")
+  parser.add_argument('--quantization', nargs='+', default=['none', 'scalar', 'binary'], choices=['none', 'scalar', 'binary'])
+  parser.add_argument('--hnsw_ef', type=int, nargs='+', default=[64, 128, 256])
+  parser.add_argument('--oversampling', type=float, nargs='+', default=[1.0, 2.0, 4.0])
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', default=None, help="Also write the results to this CSV file.")
+  args = parser.parse_args()
+
+  if args.url == ':memory:':
+    client = QdrantClient(':memory:')
+  else:
+    client = QdrantClient(url=args.url, api_key=args.api_key, https=False, timeout=60)
+  all_rows: List[Dict] = []
+
+  if args.collection:
+    info = client.get_collection(args.collection)
+    courses = args.courses or [hit.value for hit in client.facet(args.collection, key='course_name', limit=10).hits]
+    course_sizes = {
+        course_name: client.count(args.collection,
+                                  count_filter=models.Filter(must=VectorDatabase._create_search_conditions(course_name, [])),
+                                  exact=True).count for course_name in courses
+    }
+    all_rows += sweep(client, args.collection, course_sizes, SearchPolicy.from_collection_info(info).quantization, args)
+  else:
+    collection_name = f"search-policy-benchmark-{uuid.uuid4().hex[:8]}"
+    try:
+      ensure_collection(client, collection_name, CollectionSchema(vector_size=args.dim, quantization=args.quantization[0]))
+      course_sizes = build_synthetic_collection(client, collection_name, args)
+      for quantization in args.quantization:
+        # Reconfigures the quantization in place, like a QDRANT_QUANTIZATION change at startup would.
+        ensure_collection(client, collection_name, CollectionSchema(vector_size=args.dim, quantization=quantization))
+        wait_until_indexed(client, collection_name)
+        all_rows += sweep(client, collection_name, course_sizes, quantization, args)
+    finally:
+      client.delete_collection(collection_name)
+
+  if args.output and all_rows:
+    with open(args.output, 'w', newline='') as f:
+      writer = csv.DictWriter(f, fieldnames=list(all_rows[0].keys()))
+      writer.writeheader()
+      writer.writerows(all_rows)
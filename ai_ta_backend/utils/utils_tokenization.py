@@ -1,10 +1,75 @@
+import bisect
+import functools
+import itertools
 import logging
 import os
-from typing import Any
+from typing import Any, Callable, List, Optional
 
 import tiktoken
 
 
+# Below this many texts, encoding one by one beats encode_ordinary_batch(), which starts a thread pool per call.
+_MIN_TEXTS_FOR_THREADED_BATCH = 16
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name: str) -> tiktoken.Encoding:
+  """
+  Process-wide encoder registry, by encoding name (e.g. "cl100k_base", "gpt2"). Encoders are built once and shared by
+  every thread, so callers never pay for construction (or tiktoken's registry lock) per request or per chunk.
+  """
+  return tiktoken.get_encoding(encoding_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding_for_model(openai_model_name: str = "gpt-3.5-turbo") -> tiktoken.Encoding:
+  return get_encoding(tiktoken.encoding_name_for_model(openai_model_name))
+
+
+def _resolve_encoding(encoding_name: Optional[str], openai_model_name: str) -> tiktoken.Encoding:
+  return get_encoding(encoding_name) if encoding_name else get_encoding_for_model(openai_model_name)
+
+
+def count_tokens(text: str, encoding_name: Optional[str] = None, openai_model_name: str = "gpt-3.5-turbo") -> int:
+  """
+  Number of tokens in `text`, by encoding name or else by model name.
+
+  tiktoken has no count-only API, so the token list is still built, but encode_ordinary() skips encode()'s scan for
+  special tokens and the list is dropped right away. Special tokens (e.g. `<|endoftext|>`) count as ordinary text.
+  """
+  if not text:
+    return 0
+  return len(_resolve_encoding(encoding_name, openai_model_name).encode_ordinary(text))
+
+
+def count_tokens_batch(texts: List[str],
+                       openai_model_name: str = "gpt-3.5-turbo",
+                       encoding_name: Optional[str] = None) -> List[int]:
+  """
+  Count tokens for many strings in one call. Large batches are encoded on tiktoken's thread pool, outside the GIL.
+
+  Special tokens (e.g. `<|endoftext|>`) in the text are counted as ordinary text, instead of raising.
+  """
+  encoding = _resolve_encoding(encoding_name, openai_model_name)
+  if len(texts) < _MIN_TEXTS_FOR_THREADED_BATCH:
+    return [len(encoding.encode_ordinary(text)) if text else 0 for text in texts]
+  return [len(tokens) for tokens in encoding.encode_ordinary_batch(texts)]
+
+
+@functools.lru_cache(maxsize=None)
+def token_length_function(encoding_name: str) -> Callable[[str], int]:
+  """`length_function` for langchain text splitters, measuring chunk sizes in tokens of the shared encoder."""
+  return functools.partial(count_tokens, encoding_name=encoding_name)
+
+
+def select_within_token_budget(token_counts: List[int], token_budget: int) -> int:
+  """
+  Returns how many leading items fit in the token budget, i.e. the longest prefix whose cumulative sum is <= token_budget.
+  Same result as adding items one at a time and stopping at the first one that doesn't fit.
+  """
+  return bisect.bisect_right(list(itertools.accumulate(token_counts)), token_budget)
+
+
 def count_tokens_and_cost(prompt: str,
                           completion: str = '',
                           openai_model_name: str = "gpt-3.5-turbo"):  # -> tuple[int, float] | tuple[int, float, int, float]:
@@ -27,7 +92,7 @@ def count_tokens_and_cost(prompt: str,
   """
   # encoding = tiktoken.encoding_for_model(openai_model_name)
   openai_model_name = openai_model_name.lower()
-  encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")  # I think they all use the same encoding
+  encoding = get_encoding_for_model("gpt-3.5-turbo")  # I think they all use the same encoding
   prompt_cost = 0
   completion_cost = 0
 
@@ -61,16 +126,16 @@ def count_tokens_and_cost(prompt: str,
     completion_token_cost = 0
 
   if completion == '':
-    num_tokens_prompt: int = len(encoding.encode(prompt))
+    num_tokens_prompt: int = count_tokens(prompt, encoding_name=encoding.name)
     prompt_cost = float(prompt_token_cost * num_tokens_prompt)
     return num_tokens_prompt, prompt_cost
   elif prompt == '':
-    num_tokens_completion: int = len(encoding.encode(completion))
+    num_tokens_completion: int = count_tokens(completion, encoding_name=encoding.name)
     completion_cost = float(completion_token_cost * num_tokens_completion)
     return num_tokens_completion, completion_cost
   else:
-    num_tokens_prompt: int = len(encoding.encode(prompt))
-    num_tokens_completion: int = len(encoding.encode(completion))
+    num_tokens_prompt: int = count_tokens(prompt, encoding_name=encoding.name)
+    num_tokens_completion: int = count_tokens(completion, encoding_name=encoding.name)
     prompt_cost = float(prompt_token_cost * num_tokens_prompt)
     completion_cost = float(completion_token_cost * num_tokens_completion)
     return num_tokens_prompt, prompt_cost, num_tokens_completion, completion_cost
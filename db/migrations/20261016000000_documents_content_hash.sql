@@ -0,0 +1,9 @@
+-- Content fingerprint for ingest's duplicate detection (see Ingest.check_for_duplicates).
+-- Existing rows keep a NULL hash; re-uploading one of them replaces it once, and stores the hash.
+-- SQLite: ALTER TABLE documents ADD COLUMN content_hash TEXT; and the same CREATE INDEX without "USING btree".
+
+ALTER TABLE "public"."documents" ADD COLUMN IF NOT EXISTS "content_hash" "text";
+
+COMMENT ON COLUMN "public"."documents"."content_hash" IS 'SHA-256 of the normalized extracted text';
+
+CREATE INDEX IF NOT EXISTS "documents_course_name_content_hash_idx" ON "public"."documents" USING "btree" ("course_name", "content_hash");
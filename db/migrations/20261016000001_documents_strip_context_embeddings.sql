@@ -0,0 +1,20 @@
+-- Chunk vectors live in Qdrant; documents.contexts keeps chunk text and metadata only (see DOCUMENTS_EMBEDDING_STORAGE).
+-- Strips the 1536-float "embedding" of every existing context, which is most of each row's size.
+-- Afterwards, run `VACUUM FULL "public"."documents";` (outside a transaction) to give the space back to the OS.
+-- SQLite:
+--   ALTER TABLE documents ADD COLUMN embeddings BLOB;
+--   UPDATE documents SET contexts = (SELECT json_group_array(json_remove(value, '$.embedding'))
+--                                    FROM json_each(documents.contexts))
+--   WHERE contexts IS NOT NULL;
+
+ALTER TABLE "public"."documents" ADD COLUMN IF NOT EXISTS "embeddings" "bytea";
+
+COMMENT ON COLUMN "public"."documents"."embeddings" IS 'Optional float32 copy of the chunk vectors, in chunk_index order';
+
+UPDATE "public"."documents"
+SET "contexts" = (
+    SELECT "jsonb_agg"("context" - 'embedding' ORDER BY "position")
+    FROM "jsonb_array_elements"("documents"."contexts") WITH ORDINALITY AS "elements"("context", "position")
+)
+WHERE "jsonb_typeof"("contexts") = 'array'
+  AND EXISTS (SELECT 1 FROM "jsonb_array_elements"("documents"."contexts") AS "element" WHERE "element" ? 'embedding');
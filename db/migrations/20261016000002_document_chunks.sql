@@ -0,0 +1,35 @@
+-- One row per chunk, keyed by (document_id, chunk_index), replacing the per-document contexts JSON array.
+-- New ingests write document_chunks only (documents.contexts = []). This copies the chunks of existing documents;
+-- their contexts are left in place; readers prefer document_chunks rows when a document has any.
+-- Chunks without a chunk_index get their position in the array.
+
+CREATE TABLE IF NOT EXISTS "public"."document_chunks" (
+    "document_id" bigint NOT NULL,
+    "chunk_index" integer NOT NULL,
+    "pagenumber" integer,
+    "timestamp" "text",
+    "num_tokens" integer,
+    "chunk_hash" "text",
+    "text" "text",
+    CONSTRAINT "document_chunks_pkey" PRIMARY KEY ("document_id", "chunk_index"),
+    CONSTRAINT "document_chunks_document_id_fkey" FOREIGN KEY ("document_id") REFERENCES "public"."documents"("id") ON DELETE CASCADE
+);
+
+ALTER TABLE "public"."document_chunks" OWNER TO "postgres";
+
+COMMENT ON TABLE "public"."document_chunks" IS 'Chunks of each document: text, page, timestamp and token count';
+
+CREATE INDEX IF NOT EXISTS "document_chunks_document_id_pagenumber_idx" ON "public"."document_chunks" USING "btree" ("document_id", "pagenumber");
+
+INSERT INTO "public"."document_chunks" ("document_id", "chunk_index", "pagenumber", "timestamp", "num_tokens", "chunk_hash", "text")
+SELECT "documents"."id",
+       CASE WHEN "context"->>'chunk_index' ~ '^\d+$' THEN ("context"->>'chunk_index')::integer ELSE "position" - 1 END,
+       CASE WHEN "context"->>'pagenumber' ~ '^\d+$' THEN ("context"->>'pagenumber')::integer END,
+       "context"->>'timestamp',
+       CASE WHEN "context"->>'num_tokens' ~ '^\d+$' THEN ("context"->>'num_tokens')::integer END,
+       "context"->>'chunk_hash',
+       "context"->>'text'
+FROM "public"."documents",
+     "jsonb_array_elements"("documents"."contexts") WITH ORDINALITY AS "elements"("context", "position")
+WHERE "jsonb_typeof"("documents"."contexts") = 'array'
+ON CONFLICT ("document_id", "chunk_index") DO NOTHING;
@@ -0,0 +1,5 @@
+-- Index for /getAll's distinct materials (see SQLAlchemyDatabase.getDistinctMaterialsForCourse): each page walks the
+-- course's rows by id and probes for an earlier row with the same (s3_path, url, ...) through this index.
+-- SQLite: the same CREATE INDEX without "USING btree".
+
+CREATE INDEX IF NOT EXISTS "documents_course_name_s3_path_url_id_idx" ON "public"."documents" USING "btree" ("course_name", "s3_path", "url", "id");
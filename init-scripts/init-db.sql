@@ -7,9 +7,29 @@ CREATE TABLE public.documents (
   url TEXT NULL,
   contexts JSONB NULL,
   base_url TEXT NULL,
+  content_hash TEXT NULL,
+  embeddings BYTEA NULL,
   CONSTRAINT documents_pkey PRIMARY KEY (id)
 ) TABLESPACE pg_default;
 
 CREATE INDEX IF NOT EXISTS documents_course_name_idx ON public.documents USING hash (course_name) TABLESPACE pg_default;
 
 CREATE INDEX IF NOT EXISTS documents_created_at_idx ON public.documents USING btree (created_at) TABLESPACE pg_default;
+
+CREATE INDEX IF NOT EXISTS documents_course_name_content_hash_idx ON public.documents USING btree (course_name, content_hash) TABLESPACE pg_default;
+
+CREATE INDEX IF NOT EXISTS documents_course_name_s3_path_url_id_idx ON public.documents USING btree (course_name, s3_path, url, id) TABLESPACE pg_default;
+
+CREATE TABLE public.document_chunks (
+  document_id BIGINT NOT NULL,
+  chunk_index INTEGER NOT NULL,
+  pagenumber INTEGER NULL,
+  timestamp TEXT NULL,
+  num_tokens INTEGER NULL,
+  chunk_hash TEXT NULL,
+  text TEXT NULL,
+  CONSTRAINT document_chunks_pkey PRIMARY KEY (document_id, chunk_index),
+  CONSTRAINT document_chunks_document_id_fkey FOREIGN KEY (document_id) REFERENCES public.documents (id) ON DELETE CASCADE
+) TABLESPACE pg_default;
+
+CREATE INDEX IF NOT EXISTS document_chunks_document_id_pagenumber_idx ON public.document_chunks USING btree (document_id, pagenumber) TABLESPACE pg_default;
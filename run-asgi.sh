@@ -0,0 +1,7 @@
+#!/bin/bash
+
+# Async serving mode: /getTopContexts and /getTopContextsBatch run on the event loop, everything else is the same Flask app.
+# Compare against ./run.sh with: python -m ai_ta_backend.utils.retrieval_load_test --help
+
+export PYTHONPATH=${PYTHONPATH}:$(pwd)/ai_ta_backend
+exec gunicorn --workers=3 --worker-class=uvicorn.workers.UvicornWorker ai_ta_backend.asgi:app --timeout 1800